@@ -6,6 +6,10 @@ from typing import List, Dict, Any, Optional, Union
 from pydantic import BaseModel
 from datetime import datetime
 
+from inference_scheduler import AGENT as AGENT_PRIORITY
+from stream_bridge import iterate_in_thread
+from tokenizer_service import truncate_tokens
+
 # Logging setup
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("oonanji-agent")
@@ -61,55 +65,42 @@ class LocalLlamaBrain(BaseBrain):
 
     async def generate_stream(self, messages: List[AgentMessage], tools: Optional[List[Tool]] = None):
         print(f"DEBUG: Brain querying model (STREAM): {self.model_path} with {len(messages)} messages", flush=True)
-        loop = asyncio.get_event_loop()
-        import concurrent.futures
-        
-        # Stream Logic
-        queue = asyncio.Queue()
         
+        # Stream Logic: decoding runs on a generation thread (see stream_bridge)
         def _inference_stream():
-            try:
-                llm = self.model_manager.get_llm(self.model_path, n_gpu_layers=self.n_gpu_layers)
+            # Agent steps queue behind interactive chats on the same model
+            if hasattr(self.model_manager, 'enqueue_generation'):
+                turn = self.model_manager.enqueue_generation(self.model_path, AGENT_PRIORITY, "agent")
+            else:
+                import threading
+                turn = threading.RLock()
+
+            # Lease the model so a concurrent model switch can't unload it mid-stream
+            with turn, self.model_manager.llm_lease(self.model_path, n_gpu_layers=self.n_gpu_layers) as llm:
                 if not llm:
-                    queue.put_nowait(None) # Signal end
                     return
 
                 llama_messages = [{"role": m.role, "content": m.content} for m in messages]
                 
-                if hasattr(self.model_manager, 'thread_lock'):
-                    lock_obj = self.model_manager.thread_lock
-                else:
-                    import threading
-                    lock_obj = threading.RLock()
-
-                with lock_obj:
-                     # Using create_chat_completion with stream=True
-                     # Note: llama-cpp-python streaming returns an iterator
-                     stream_iter = llm.create_chat_completion(
-                        messages=llama_messages,
-                        max_tokens=1024,
-                        temperature=0.7, 
-                        stream=True
-                    )
-                     for chunk in stream_iter:
-                         delta = chunk['choices'][0]['delta']
-                         if 'content' in delta:
-                             queue.put_nowait(delta['content'])
-                
-                queue.put_nowait(None) # Signal end of stream
-            except Exception as e:
-                print(f"Inference Error: {e}", flush=True)
-                queue.put_nowait(f"[Error: {e}]")
-                queue.put_nowait(None)
-
-        # Run inference in thread
-        loop.run_in_executor(None, _inference_stream)
-        
-        while True:
-            chunk = await queue.get()
-            if chunk is None:
-                break
-            yield chunk
+                # Using create_chat_completion with stream=True
+                # Note: llama-cpp-python streaming returns an iterator
+                stream_iter = llm.create_chat_completion(
+                    messages=llama_messages,
+                    max_tokens=1024,
+                    temperature=0.7, 
+                    stream=True
+                )
+                for chunk in stream_iter:
+                    delta = chunk['choices'][0]['delta']
+                    if 'content' in delta:
+                        yield delta['content']
+
+        try:
+            async for chunk in iterate_in_thread(_inference_stream):
+                yield chunk
+        except Exception as e:
+            print(f"Inference Error: {e}", flush=True)
+            yield f"[Error: {e}]"
 
     async def generate_response(self, messages: List[AgentMessage], tools: Optional[List[Tool]] = None) -> AgentMessage:
         # Backward compatibility wrapper
@@ -130,8 +121,11 @@ class LocalLlamaBrain(BaseBrain):
 import os
 import glob
 
+# Tokens of a file the agent gets back from one read
+FILE_READ_MAX_TOKENS = 2500
+
 class FileTool(Tool):
-    def __init__(self):
+    def __init__(self, model_path: str = None):
         super().__init__(
             name="file_ops",
             description="Read, Write, List, or Edit files in the workspace.",
@@ -147,6 +141,7 @@ class FileTool(Tool):
             }
         )
         self.root_dir = "/opt/oonanji-vault"
+        self.model_path = model_path  # Whose tokenizer measures what read returns
 
     async def execute(self, **kwargs) -> str:
         args = kwargs.get("args", kwargs)
@@ -162,7 +157,11 @@ class FileTool(Tool):
             if action == "read":
                 if not os.path.exists(full_path): return "Error: File not found."
                 with open(full_path, 'r', encoding='utf-8') as f:
-                    return f.read()[:10000] # Limit output
+                    content = f.read()
+                if self.model_path:
+                    # May load the vocabulary and parse the model header: off the event loop
+                    return await asyncio.to_thread(truncate_tokens, self.model_path, content, FILE_READ_MAX_TOKENS)
+                return content[:10000] # Limit output
             
             elif action == "write":
                 content = args.get("content")
@@ -765,13 +764,14 @@ class AgentGateway:
         
         print(f"Agent using Reflex: {self.reflex_model_path}, Planner: {self.planner_model_path}", flush=True)
 
-        reflex_brain = LocalLlamaBrain(self.model_manager, self.reflex_model_path, n_gpu_layers=33)
-        planner_brain = LocalLlamaBrain(self.model_manager, self.planner_model_path, n_gpu_layers=33)
+        # GPU offload, threads and batch come from the model's header and its calibrated profile
+        reflex_brain = LocalLlamaBrain(self.model_manager, self.reflex_model_path)
+        planner_brain = LocalLlamaBrain(self.model_manager, self.planner_model_path)
         
         self.agent = OonanjiAgent(reflex_brain, planner_brain)
         
         # Register Core Tools
-        self.agent.register_tool(FileTool())
+        self.agent.register_tool(FileTool(model_path=self.planner_model_path))
         self.agent.register_tool(CanvasTool(db_handler=db_handler, db_save_handler=db_save_handler))
         self.agent.register_tool(MemoryTool(db_handler=db_memory_handler))
         
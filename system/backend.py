@@ -12,6 +12,7 @@ import sqlite3
 import logging
 import time
 import subprocess
+import threading
 import uuid
 from pathlib import Path
 from typing import List, Optional, Dict, Any, Generator
@@ -19,54 +20,58 @@ from datetime import datetime, timedelta
 from contextlib import asynccontextmanager
 import gc
 
-try:
-    import psutil
-except ImportError:
-    psutil = None
-
 from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, status, Body, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, JSONResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from passlib.context import CryptContext
-from jose import JWTError, jwt
 import asyncio
+from functools import lru_cache
 
 # Discord Bot Integration
 # Discord Bot Removed
 
 
+# Heavy libraries are imported on first use; optional ones are None when not installed
+from lazy_import import lazy, available
+
 # Llama.cpp
-try:
-    from llama_cpp import Llama
-except ImportError:
-    Llama = None
+llama_cpp = lazy("llama_cpp")
 
 # ChromaDB
-try:
-    import chromadb
-    from chromadb.config import Settings
-except ImportError:
-    chromadb = None
+chromadb = lazy("chromadb") if available("chromadb") else None
 
 # Document Loaders
-try:
-    import docx
-except ImportError:
-    docx = None
-try:
-    import openpyxl
-except ImportError:
-    openpyxl = None
+docx = lazy("docx") if available("docx") else None
+openpyxl = lazy("openpyxl") if available("openpyxl") else None
+pypdf = lazy("pypdf") if available("pypdf") else None
 
-try:
-    import pypdf
-except ImportError:
-    pypdf = None
+psutil = lazy("psutil") if available("psutil") else None
+
+# Auth
+passlib_context = lazy("passlib.context")
+jwt = lazy("jose.jwt")
 
 import hashlib
 
+import index_state
+from index_scheduler import IndexScheduler, validate_schedule
+from embedding_service import EmbeddingClient, EmbeddingServiceError
+from model_downloader import DownloadManager
+from gguf_metadata import model_info, runtime_params, embedding_dim, kv_bytes_per_token
+from benchmark import latest_results
+from hardware import hardware_fingerprint
+from tokenizer_service import count_tokens, count_message_tokens, truncate_tokens, tokenizer_stats
+from speculative import create_drafter, draft_bytes, draft_config, draft_model_path, drafter_stats, LOOKUP
+from model_store import (canonical_model_path, llama_memory_kwargs, pinned_models, warm_page_cache,
+                         ensure_user_view, sync_shared_models, publish_model, remove_user_view, store_status,
+                         USER_VIEWS_DIR)
+from inference_scheduler import InferenceScheduler, QueueFull, INTERACTIVE, SUMMARY, BUSY_MARKER
+from stream_bridge import iterate_in_thread, run_in_generation_thread
+from llama_context import prompt_tokens, keep_prefix, eval_in_slices
+from prompt_cache import attach_prompt_cache, session_chat_stream, session_states, PROMPT_CACHE_ENABLED, PROMPT_CACHE_RAM_BYTES
+
 # Setup Logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("oonanji-backend")
@@ -100,7 +105,11 @@ else:
 
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 30  # 30 days
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+@lru_cache(maxsize=None)
+def pwd_context():
+    # Built on first login rather than at import: passlib and its bcrypt backend are slow to import
+    return passlib_context.CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Global State
 class GlobalState:
@@ -108,27 +117,18 @@ class GlobalState:
     indexing_progress = 0.0
     indexing_status = "Idle"
     indexing_log: List[str] = []
-    stop_indexing_flag: bool = False
     current_storage_mode = "nas"  # 'nas' or 'internal'
     indexing_start_time = None
     indexing_total_files = 0
     indexing_processed_files = 0
     last_indexed_at: Optional[str] = None
+    embedding_service: Optional[subprocess.Popen] = None
+    benchmark_process: Optional[subprocess.Popen] = None
 
 state = GlobalState()
 
 def get_db_status():
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'indexing_status'")
-        result = cursor.fetchone()
-        conn.close()
-        if result:
-            return json.loads(result[0])
-        return {}
-    except Exception:
-        return {}
+    return index_state.get_status()
 
 def get_storage_mode():
     try:
@@ -143,47 +143,36 @@ def get_storage_mode():
     except Exception:
         return "nas"
 
-def ensure_user_models_dir(username: str) -> Path:
+def ensure_user_models_dir(username: str, shared_models: Optional[Dict[str, str]] = None) -> Path:
     if username == "adminuser":
         return MODELS_DIR
 
-    user_model_dir = BASE_DIR / f"models_{username}"
-    
-    # Check if needs migration from symlink to directory
-    if user_model_dir.is_symlink() or (user_model_dir.exists() and not user_model_dir.is_dir()):
-        logger.info(f"Removing existing symlink/file for {username} models to replace with copy...")
-        try:
-            os.unlink(user_model_dir)
-        except Exception as e:
-            logger.error(f"Failed to remove symlink for {username}: {e}")
+    # Existing views are kept current by the startup sync, downloads and user creation
+    view = USER_VIEWS_DIR / username
+    if shared_models is None and view.is_dir():
+        return view
+
+    # A view of hardlinks into the content-addressed blob store: instant to create, no extra disk
+    try:
+        return ensure_user_view(username, shared_models)
+    except Exception as e:
+        logger.error(f"Failed to setup models for {username}: {e}")
+        return MODELS_DIR
 
-    if not user_model_dir.exists():
-        logger.info(f"Creating model directory for {username}...")
-        try:
-            if not MODELS_DIR.exists():
-                logger.warning("Base models directory missing, creating empty user dir")
-                user_model_dir.mkdir(parents=True, exist_ok=True)
-            else:
-                # USER REQUEST: Physical copy of models for each user
-                # Warning: This consumes significant disk space
-                logger.info(f"Copying models for {username} (Physical Copy)...")
-                shutil.copytree(MODELS_DIR, user_model_dir, dirs_exist_ok=True)
-                
-        except Exception as e:
-            logger.error(f"Failed to setup models for {username}: {e}")
-            return MODELS_DIR
-    return user_model_dir
 
+def setup_new_user_models(username: str) -> Path:
+    # Picks up models dropped into models/ since startup, too
+    return ensure_user_models_dir(username, sync_shared_models())
 
 
 class RemoteLlama:
-    def __init__(self, base_url: str, model_path: str):
+    def __init__(self, base_url: str, model_path: str, extra_payload: Optional[dict] = None):
         self.base_url = base_url.rstrip('/')
         self.model_path = model_path
+        self.extra_payload = extra_payload or {}
         
-    def create_chat_completion(self, messages, max_tokens=1024, temperature=0.7, stream=True, **kwargs):
+    def create_chat_completion(self, messages, max_tokens=1024, temperature=0.7, stream=False, **kwargs):
         url = f"{self.base_url}/v1/chat/completions"
-        headers = {"Content-Type": "application/json"}
         
         # Extract system prompt if present to map to "model" if needed, 
         # but standard OpenAI API just takes messages. 
@@ -193,31 +182,49 @@ class RemoteLlama:
             "messages": messages,
             "max_tokens": max_tokens,
             "temperature": temperature,
-            "stream": stream
+            "stream": stream,
+            **self.extra_payload
         }
-        
-        if stream:
-            with httpx.stream("POST", url, json=payload, headers=headers, timeout=60.0) as response:
-                if response.status_code != 200:
-                    logger.error(f"Remote Worker Error: {response.text}")
-                    yield {"choices": [{"delta": {"content": f" Error: Remote worker returned {response.status_code}"}}]}
-                    return
+        return self._stream(url, payload, "delta") if stream else self._post(url, payload)
 
-                for line in response.iter_lines():
-                    if line.startswith("data: "):
-                        data_str = line[6:]
-                        if data_str.strip() == "[DONE]":
-                            break
-                        try:
-                            data = json.loads(data_str)
-                            yield data
-                        except json.JSONDecodeError:
-                            pass
-        else:
-            # Non-streaming fallback
-            response = httpx.post(url, json=payload, headers=headers, timeout=60.0)
-            if response.status_code == 200:
-                yield response.json()
+    def create_completion(self, prompt, max_tokens=256, temperature=0.7, stop=None, stream=False, **kwargs):
+        url = f"{self.base_url}/v1/completions"
+        payload = {
+            "model": "default",
+            "prompt": prompt,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "stop": stop or [],
+            "stream": stream,
+            **self.extra_payload
+        }
+        return self._stream(url, payload, "text") if stream else self._post(url, payload)
+
+    def _post(self, url: str, payload: dict) -> dict:
+        response = httpx.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=60.0)
+        if response.status_code != 200:
+            raise RuntimeError(f"Remote worker returned {response.status_code}: {response.text}")
+        return response.json()
+
+    def _stream(self, url: str, payload: dict, field: str):
+        headers = {"Content-Type": "application/json"}
+        with httpx.stream("POST", url, json=payload, headers=headers, timeout=60.0) as response:
+            if response.status_code != 200:
+                logger.error(f"Remote Worker Error: {response.read()}")
+                error = f" Error: Remote worker returned {response.status_code}"
+                yield {"choices": [{"delta": {"content": error}} if field == "delta" else {"text": error}]}
+                return
+
+            for line in response.iter_lines():
+                if line.startswith("data: "):
+                    data_str = line[6:]
+                    if data_str.strip() == "[DONE]":
+                        break
+                    try:
+                        data = json.loads(data_str)
+                        yield data
+                    except json.JSONDecodeError:
+                        pass
 
     def create_embedding(self, input):
         # Support remote embeddings if needed
@@ -234,13 +241,170 @@ class RemoteLlama:
             logger.error(f"Remote embedding failed: {e}")
         return {'data': [{'embedding': [0.0]*768}]}
 
+# Serving mode for local chat models: "inprocess" (llama-cpp-python) or "server"
+# (one managed llama.cpp server per model decoding several sequences in parallel)
+LLM_SERVING = os.environ.get("LLM_SERVING", "inprocess")
+LLAMA_SERVER_BIN = os.environ.get("LLAMA_SERVER_BIN", "llama-server")
+LLAMA_SERVER_SLOTS = int(os.environ.get("LLAMA_SERVER_SLOTS", "4"))
+LLAMA_SERVER_SLOT_CTX = int(os.environ.get("LLAMA_SERVER_SLOT_CTX", "2048"))
+LLAMA_SERVER_START_TIMEOUT = int(os.environ.get("LLAMA_SERVER_START_TIMEOUT", "120"))
+LLAMA_SERVER_LOG_DIR = BASE_DIR / "logs" / "llama-server"
+
+# Tokens of a chat model's context kept free for the answer when sizing reference material
+CHAT_RESPONSE_RESERVE_TOKENS = int(os.environ.get("CHAT_RESPONSE_RESERVE_TOKENS", "1024"))
+
+# Context to budget for one loaded chat model
+LLM_POOL_CTX = LLAMA_SERVER_SLOTS * LLAMA_SERVER_SLOT_CTX if LLM_SERVING == "server" else 2048
+
+class ManagedLlamaServer(RemoteLlama):
+    """A local llama.cpp server process serving one model, used through RemoteLlama.
+
+    The server keeps LLAMA_SERVER_SLOTS sequences (each with its own
+    LLAMA_SERVER_SLOT_CTX context) and decodes them together with continuous
+    batching, so concurrent chats share one copy of the weights and aggregate
+    throughput grows with the number of active slots.
+    """
+
+    def __init__(self, model_path: str, n_gpu_layers: int = -1,
+                 slots: int = LLAMA_SERVER_SLOTS, slot_ctx: int = LLAMA_SERVER_SLOT_CTX,
+                 threads: Optional[int] = None, threads_batch: Optional[int] = None,
+                 batch: Optional[int] = None, ubatch: Optional[int] = None):
+        import socket
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        # cache_prompt: reuse each slot's KV for the shared prefix of the next request
+        super().__init__(f"http://127.0.0.1:{port}", model_path, extra_payload={"cache_prompt": True})
+        self.slots = slots
+        cmd = [
+            LLAMA_SERVER_BIN, "-m", model_path,
+            "--host", "127.0.0.1", "--port", str(port),
+            "-c", str(slots * slot_ctx), "--parallel", str(slots), "--cont-batching",
+            "-ngl", str(999 if n_gpu_layers < 0 else n_gpu_layers)
+        ]
+        for flag, value in (("-t", threads), ("-tb", threads_batch), ("-b", batch), ("-ub", ubatch)):
+            if value:
+                cmd += [flag, str(value)]
+        spec = draft_config(model_path)
+        if spec and spec[0] != LOOKUP:
+            cmd += ["-md", draft_model_path(spec[0]), "--draft", str(spec[1]), "-ngld", "0"]
+        elif spec:
+            logger.info("llama.cpp server has no prompt-lookup drafting; serving without speculative decoding")
+        logger.info(f"Starting llama.cpp server for {model_path} on port {port} ({slots} slots x {slot_ctx} ctx)")
+        LLAMA_SERVER_LOG_DIR.mkdir(parents=True, exist_ok=True)
+        self.log_path = LLAMA_SERVER_LOG_DIR / f"{os.path.basename(model_path)}.log"
+        with open(self.log_path, "ab") as log:
+            self.process = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+        self._wait_ready()
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + LLAMA_SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"llama.cpp server exited with code {self.process.returncode}; "
+                                   f"see {self.log_path}")
+            try:
+                if httpx.get(f"{self.base_url}/health", timeout=2.0).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            time.sleep(0.5)
+        self.close()
+        raise RuntimeError(f"llama.cpp server did not become ready in time; see {self.log_path}")
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+# Model pool sizing. 0 = auto (60% of physical RAM)
+MODEL_RAM_BUDGET_MB = int(os.environ.get("MODEL_RAM_BUDGET_MB", "0"))
+MODEL_IDLE_TTL_SECONDS = int(os.environ.get("MODEL_IDLE_TTL_SECONDS", "1800"))
+# Rough KV-cache + compute buffer cost per context token when the GGUF header can't be read
+KV_BYTES_PER_CTX_TOKEN = 128 * 1024
+MODEL_OVERHEAD_BYTES = 64 * 1024 * 1024
+
+def default_model_budget_bytes() -> int:
+    if MODEL_RAM_BUDGET_MB > 0:
+        return MODEL_RAM_BUDGET_MB * 1024 * 1024
+    if psutil:
+        return int(psutil.virtual_memory().total * 0.6)
+    return 8 * 1024 * 1024 * 1024
+
+def estimate_model_bytes(model_path: str, n_ctx: int) -> int:
+    """Resident size of a loaded GGUF: weights plus KV cache for the context plus buffers."""
+    try:
+        weights = os.path.getsize(model_path)
+    except OSError:
+        weights = 0
+    # Plus the draft model, if speculative decoding is configured for this model
+    return (weights + n_ctx * kv_bytes_per_token(model_path, KV_BYTES_PER_CTX_TOKEN) + MODEL_OVERHEAD_BYTES
+            + draft_bytes(model_path, n_ctx, KV_BYTES_PER_CTX_TOKEN))
+
+class PooledModel:
+    def __init__(self, kind: str, path: str, model, size_bytes: int):
+        self.kind = kind  # "llm" or "embed"
+        self.path = path
+        self.model = model
+        self.size_bytes = size_bytes
+        self.last_used = time.monotonic()
+        self.active_users = 0
+        self.retiring = False  # Out of the pool; closed when the last lease is released
+        self.loading: Optional[threading.Event] = None  # Set while the model is being loaded
+
+class ModelLease:
+    """A held reference to a pooled model.
+
+    Use as a context manager; the model is not unloaded while any lease on it
+    is held.
+    """
+
+    def __init__(self, manager: "ModelManager", entry: Optional[PooledModel], model):
+        self.manager = manager
+        self.entry = entry
+        self.model = model
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            if self.entry:
+                self.manager._release(self.entry)
+
+    def __enter__(self):
+        return self.model
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
 class ModelManager:
+    """Pool of co-resident local models within a RAM budget.
+
+    Chat and embedding models stay loaded side by side as long as they fit.
+    Callers hold models through leases (`llm_lease` / `embed_lease`). When a
+    load would exceed the budget, unleased models are evicted in LRU order;
+    leased models are retired instead: new requests no longer get them, and
+    they are closed once the last in-flight lease is released. Models idle
+    longer than MODEL_IDLE_TTL_SECONDS are unloaded on the next pool access.
+    """
+
     def __init__(self):
-        self.llms = {}
-        self.embed_models = {}
+        self.pool: Dict[tuple, PooledModel] = {}
+        self.retiring: List[PooledModel] = []
+        self.budget_bytes = default_model_budget_bytes()
+        # Session KV snapshots live outside the pool; reserve their cap (at most a quarter) in the budget.
+        # llama-server keeps its own slots' state, so none are taken in server mode
+        session_states.max_bytes = 0 if LLM_SERVING == "server" else min(session_states.max_bytes, self.budget_bytes // 4)
+        self.budget_bytes -= session_states.max_bytes
+        self.idle_ttl = MODEL_IDLE_TTL_SECONDS
         self.lock = asyncio.Lock()
         import threading
+        # thread_lock serialises inference; pool_lock guards pool bookkeeping (loads run outside it)
         self.thread_lock = threading.RLock()
+        self.pool_lock = threading.RLock()
         
         # Load Cluster Nodes
         # Format: http://192.168.1.11:8000,http://192.168.1.12:8000
@@ -248,8 +412,162 @@ class ModelManager:
         self.workers = [n.strip() for n in nodes_env.split(',') if n.strip()]
         if self.workers:
             logger.info(f"AI Cluster Mode Enabled. Workers: {self.workers}")
+        # Admission control for generations; in cluster mode each worker is a slot
+        # The busy marker lets the indexer's own summarization pause during interactive work
+        slots = {"slots_per_model": len(self.workers)} if self.workers else {}
+        self.scheduler = InferenceScheduler(busy_marker=BUSY_MARKER, **slots)
+        logger.info(f"Model pool budget: {self.budget_bytes / 1024 / 1024:.0f} MB "
+                    f"(+{session_states.max_bytes / 1024 / 1024:.0f} MB session KV), idle TTL {self.idle_ttl}s")
+
+    @property
+    def llms(self) -> Dict[str, Any]:
+        return {e.path: e.model for e in self.pool.values() if e.kind == "llm" and not e.loading}
+
+    @property
+    def embed_models(self) -> Dict[str, Any]:
+        return {e.path: e.model for e in self.pool.values() if e.kind == "embed" and not e.loading}
+
+    def resident_bytes(self) -> int:
+        return sum(e.size_bytes for e in self.pool.values()) + sum(e.size_bytes for e in self.retiring)
+
+    def pool_status(self) -> List[dict]:
+        now = time.monotonic()
+        return [{
+            "kind": e.kind,
+            "path": e.path,
+            "size_mb": round(e.size_bytes / 1024 / 1024),
+            "idle_seconds": round(now - e.last_used),
+            "active_users": e.active_users,
+            "retiring": e.retiring,
+            "loading": e.loading is not None,
+            "prompt_cache": e.model.cache.stats() if hasattr(getattr(e.model, "cache", None), "stats") else None,
+            "speculative": drafter_stats(e.model)
+        } for e in list(self.pool.values()) + self.retiring]
+
+    def _evict(self, key: tuple):
+        entry = self.pool.pop(key)
+        self._close(entry)
+
+    def _close(self, entry: PooledModel):
+        logger.info(f"Unloading {entry.kind} model {entry.path} ({entry.size_bytes / 1024 / 1024:.0f} MB)")
+        try:
+            if hasattr(entry.model, 'close'):
+                entry.model.close()
+            if hasattr(getattr(entry.model, 'draft_model', None), 'close'):
+                entry.model.draft_model.close()
+        except Exception as ex:
+            logger.warning(f"Error closing model {entry.path}: {ex}")
+        del entry
+        gc.collect()
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for key, entry in list(self.pool.items()):
+            if entry.active_users == 0 and now - entry.last_used > self.idle_ttl:
+                logger.info(f"Model idle for {now - entry.last_used:.0f}s, unloading: {entry.path}")
+                self._evict(key)
+
+    def _make_room(self, needed: int):
+        # LRU eviction among models nobody is using
+        while self.resident_bytes() + needed > self.budget_bytes:
+            candidates = [(e.last_used, k) for k, e in self.pool.items() if e.active_users == 0]
+            if candidates:
+                self._evict(min(candidates)[1])
+                continue
+            # Everything left is leased: retire the least recently used so in-flight
+            # generations finish on it while new requests go to the new model
+            leased = [(e.last_used, k) for k, e in self.pool.items()]
+            pooled_bytes = sum(e.size_bytes for e in self.pool.values())
+            if not leased or pooled_bytes + needed <= self.budget_bytes:
+                if self.retiring:
+                    logger.warning(f"Model pool over budget until {len(self.retiring)} retiring model(s) are released")
+                return
+            entry = self.pool.pop(min(leased)[1])
+            entry.retiring = True
+            self.retiring.append(entry)
+            logger.info(f"Retiring {entry.kind} model {entry.path}; unloading after {entry.active_users} active lease(s) finish")
+
+    def _release(self, entry: PooledModel):
+        with self.pool_lock:
+            entry.active_users -= 1
+            entry.last_used = time.monotonic()
+            if entry.retiring and entry.active_users <= 0:
+                self.retiring.remove(entry)
+                self._close(entry)
+
+    def _acquire(self, kind: str, model_path: str, n_ctx: int, loader) -> PooledModel:
+        key = (kind, model_path)
+        while True:
+            with self.pool_lock:
+                self._evict_idle()
+                entry = self.pool.get(key)
+                if not entry:
+                    # A retiring copy that is still draining can simply be put back
+                    entry = next((e for e in self.retiring if e.kind == kind and e.path == model_path), None)
+                    if entry:
+                        self.retiring.remove(entry)
+                        entry.retiring = False
+                        self.pool[key] = entry
+                if entry and not entry.loading:
+                    entry.active_users += 1
+                    entry.last_used = time.monotonic()
+                    return entry
+                if not entry:
+                    # Reserve the budget with a placeholder and load without the lock, so
+                    # requests for models already in the pool aren't stuck behind the load
+                    size = estimate_model_bytes(model_path, n_ctx)
+                    if kind == "llm" and PROMPT_CACHE_ENABLED:
+                        size += PROMPT_CACHE_RAM_BYTES
+                    self._make_room(size)
+                    entry = PooledModel(kind, model_path, None, size)
+                    entry.loading = threading.Event()
+                    entry.active_users = 1  # The loading request's own use; keeps it from eviction
+                    self.pool[key] = entry
+                    break
+                loading = entry.loading
+            # Someone else is loading this model: wait, then look again (the load may have failed)
+            loading.wait()
+
+        try:
+            model = loader()
+        except BaseException:
+            with self.pool_lock:
+                if self.pool.get(key) is entry:
+                    del self.pool[key]
+                elif entry in self.retiring:
+                    self.retiring.remove(entry)
+                loading, entry.loading = entry.loading, None
+            loading.set()
+            raise
+        with self.pool_lock:
+            entry.model = model
+            entry.last_used = time.monotonic()
+            loading, entry.loading = entry.loading, None
+        loading.set()
+        return entry
+
+    def _get_pooled(self, kind: str, model_path: str, n_ctx: int, loader):
+        # Unleased access: the model stays in the pool but may be evicted once idle
+        entry = self._acquire(kind, model_path, n_ctx, loader)
+        self._release(entry)
+        return entry.model
+
+    def enqueue_generation(self, model_path: str, priority: int, user: Any = "system", preemptible: bool = False):
+        """Take a scheduler ticket for one generation on this model (raises QueueFull)."""
+        resource = model_path if self.workers else canonical_model_path(model_path)
+        if LLM_SERVING == "server" and not self.workers:
+            entry = self.pool.get(("llm", resource))
+            self.scheduler.set_slots(resource, self._generation_slots(entry.model if entry else None))
+        return self.scheduler.enqueue(resource, priority, user, preemptible)
+
+    @staticmethod
+    def _generation_slots(model) -> int:
+        # Parallel generations follow what is actually loaded: a llama.cpp server's slots, or
+        # one for an in-process Llama (also when the server failed to start); one until loaded
+        return getattr(model, "slots", 1) if isinstance(model, ManagedLlamaServer) else 1
 
     def get_llm(self, model_path: str, n_gpu_layers: int = None):
+        """Return a chat model without holding it; prefer `llm_lease` for generation."""
         # 1. Cluster Distribution Logic
         if self.workers:
             # Simple Random Load Balancing
@@ -258,120 +576,127 @@ class ModelManager:
             return RemoteLlama(worker_url, model_path)
 
         # 2. Local Logic
-        # Thread-safe access for checking cache
-        with self.thread_lock:
-             # Exclusive Policy: Unload Embed Models if exists to free VRAM
-             if self.embed_models:
-                 logger.info("Unloading embedding models to free VRAM for LLM...")
-                 keys = list(self.embed_models.keys())
-                 for k in keys:
-                     try:
-                         if hasattr(self.embed_models[k], 'close'):
-                             self.embed_models[k].close()
-                     except: pass
-                     del self.embed_models[k]
-                 self.embed_models.clear()
-                 gc.collect()
-
-             if model_path in self.llms:
-                 return self.llms[model_path]
-        
-             # If not found, load it (using lock to prevent double loading)
-             # Double check pattern
-             if model_path in self.llms:
-                  return self.llms[model_path]
-              
-             # Unload other models ONLY if it's NOT the discord model or we are loading main model over discord model
-             is_discord_model = "discord_" in str(model_path)
-             
-             if not is_discord_model and self.llms:
-                # If loading main model, we might need to unload previous main models.
-                # But try to keep discord model if it exists
-                logger.info("Cleaning up previous LLMs...")
-                keys = list(self.llms.keys())
-                for k in keys:
-                    if "discord_" in str(k): continue # Keep discord model
-                    try:
-                        if hasattr(self.llms[k], 'close'):
-                            self.llms[k].close()
-                        del self.llms[k]
-                    except Exception as ex:
-                        logger.warning(f"Error closing model {k}: {ex}")
-                gc.collect()
-            
-             logger.info(f"Loading LLM: {model_path}")
-             
-             # Determine GPU layers based on model size hints
-             layers = -1
-             if n_gpu_layers is not None:
-                 layers = n_gpu_layers
-             elif "7b" in model_path.lower() or "8b" in model_path.lower():
-                  # For larger models, force CPU to avoid VRAM OOM on limited hardware
-                  logger.info("Forcing CPU for large model to ensure stability.")
-                  layers = 0 
+        model_path = canonical_model_path(model_path)
+        params = self._llm_params(model_path)
+        return self._get_pooled("llm", model_path, params["pool_ctx"], self._llm_loader(model_path, params, n_gpu_layers))
+
+    def llm_lease(self, model_path: str, n_gpu_layers: int = None) -> ModelLease:
+        """Lease a chat model; it stays loaded until the lease is released."""
+        if self.workers:
+            return ModelLease(self, None, self.get_llm(model_path, n_gpu_layers))
+        model_path = canonical_model_path(model_path)
+        params = self._llm_params(model_path)
+        entry = self._acquire("llm", model_path, params["pool_ctx"], self._llm_loader(model_path, params, n_gpu_layers))
+        return ModelLease(self, entry, entry.model)
+
+    def context_size(self, model_path: str) -> int:
+        """Tokens one request to this chat model can use, prompt and answer together."""
+        if LLM_SERVING == "server":
+            return LLAMA_SERVER_SLOT_CTX
+        return self._llm_params(canonical_model_path(model_path))["n_ctx"]
+
+    def _llm_params(self, model_path: str) -> Dict[str, Any]:
+        """Context, batch and threads from the GGUF header and the pool budget."""
+        params = runtime_params(model_path, "chat", self.budget_bytes)
+        params["pool_ctx"] = LLM_POOL_CTX if LLM_SERVING == "server" else params["n_ctx"]
+        return params
+
+    def _llm_loader(self, model_path: str, params: Dict[str, Any], n_gpu_layers: int = None):
+        params = dict(params)
+        params.pop("pool_ctx", None)
+        # Large models (by parameter count) run on CPU to avoid VRAM OOM on limited hardware
+        auto_layers = params.pop("n_gpu_layers", -1)
+
+        def load():
+            logger.info(f"Loading LLM: {model_path} ({params})")
              
-             try:
-                 llm = Llama(
-                     model_path=model_path, 
-                     n_ctx=2048, # Reduced to 2048 to prevent OOM
-                     n_batch=64, 
-                     n_gpu_layers=layers,
-                     verbose=True
-                 )
-                 self.llms[model_path] = llm
-                 return llm
-             except Exception as e:
-                 logger.error(f"Failed to load LLM {model_path} with GPU: {e}")
-                 logger.info("Retrying with CPU fallback...")
-                 try:
-                     llm = Llama(
-                         model_path=model_path, 
-                         n_ctx=2048,
-                         n_batch=64, 
-                         n_gpu_layers=0, # Force CPU
-                         verbose=True
-                     )
-                     self.llms[model_path] = llm
-                     return llm
-                 except Exception as e2:
-                     logger.error(f"Failed to load LLM {model_path} with CPU: {e2}")
-                     raise e2
+            layers = n_gpu_layers if n_gpu_layers is not None else auto_layers
+            if layers == 0 and n_gpu_layers is None:
+                logger.info("Forcing CPU for large model to ensure stability.")
 
-    def get_embed_model(self, model_path: str):
-        with self.thread_lock:
-            # Exclusive Policy: Unload LLMs if exists to free VRAM for Embedding
-            if self.llms:
-                logger.info("Unloading LLMs to free VRAM for Embedding...")
-                keys = list(self.llms.keys())
-                for k in keys:
-                    try:
-                        if hasattr(self.llms[k], 'close'):
-                            self.llms[k].close()
-                    except: pass
-                    del self.llms[k]
-                self.llms.clear()
-                gc.collect()
+            if LLM_SERVING == "server":
+                try:
+                    return ManagedLlamaServer(model_path, n_gpu_layers=layers, threads=params["n_threads"],
+                                              threads_batch=params["n_threads_batch"], batch=params["n_batch"],
+                                              ubatch=params.get("n_ubatch"))
+                except Exception as e:
+                    logger.error(f"llama.cpp server unavailable for {model_path} ({e}); loading in-process")
+             
+            try:
+                drafter = create_drafter(model_path, params["n_ctx"])
+            except Exception as e:
+                logger.error(f"Could not set up speculative decoding for {model_path}: {e}")
+                drafter = None
 
-            if model_path in self.embed_models:
-                return self.embed_models[model_path]
+            try:
+                llm = llama_cpp.Llama(
+                    model_path=model_path, 
+                    n_gpu_layers=layers,
+                    verbose=True,
+                    draft_model=drafter,
+                    **params,
+                    **llama_memory_kwargs(model_path)
+                )
+                return attach_prompt_cache(llm, model_path)
+            except Exception as e:
+                logger.error(f"Failed to load LLM {model_path} with GPU: {e}")
+                logger.info("Retrying with CPU fallback...")
+                try:
+                    llm = llama_cpp.Llama(
+                        model_path=model_path, 
+                        n_gpu_layers=0, # Force CPU
+                        verbose=True,
+                        draft_model=drafter,
+                        **params,
+                        **llama_memory_kwargs(model_path)
+                    )
+                    return attach_prompt_cache(llm, model_path)
+                except Exception as e2:
+                    logger.error(f"Failed to load LLM {model_path} with CPU: {e2}")
+                    # Nothing owns the draft model now; free it rather than wait for GC
+                    if hasattr(drafter, "close"):
+                        drafter.close()
+                    raise e2
+
+        def load_and_open_slots():
+            llm = load()
+            if LLM_SERVING == "server":
+                self.scheduler.set_slots(model_path, self._generation_slots(llm))
+            return llm
+
+        return load_and_open_slots
 
+    def get_embed_model(self, model_path: str):
+        model_path = canonical_model_path(model_path)
+        params = runtime_params(model_path, "embed", self.budget_bytes)
+        return self._get_pooled("embed", model_path, params["n_ctx"], self._embed_loader(model_path, params))
+
+    def embed_lease(self, model_path: str) -> ModelLease:
+        model_path = canonical_model_path(model_path)
+        params = runtime_params(model_path, "embed", self.budget_bytes)
+        entry = self._acquire("embed", model_path, params["n_ctx"], self._embed_loader(model_path, params))
+        return ModelLease(self, entry, entry.model)
+
+    def _embed_loader(self, model_path: str, params: Dict[str, Any]):
+        def load():
             logger.info(f"Loading Embedding Model: {model_path}")
             try:
                 # For embeddings, we prefer local processing for speed if possible,
                 # unless offloading is strictly required. For now, keep local CPU/GPU mixed.
-                embed_model = Llama(
+                return llama_cpp.Llama(
                     model_path=model_path,
                     embedding=True,
                     n_gpu_layers=0, # Use CPU for embeddings to save VRAM for chat
-                    n_ctx=2048, # 8192 is too large for embeddings alongside chat model and causes OOM crashes
-                    verbose=False
+                    verbose=False,
+                    **params, # n_ctx capped by EMBED_MAX_CTX: 8192 alongside a chat model caused OOM crashes
+                    **llama_memory_kwargs(model_path)
                 )
-                self.embed_models[model_path] = embed_model
-                return embed_model
             except Exception as e:
                 logger.error(f"Failed to load embedding model: {e}")
                 raise e
 
+        return load
+
 model_manager = ModelManager()
 
 # --- Database Setup (SQLite) ---
@@ -430,15 +755,6 @@ def init_db():
     )
     ''')
 
-    # File Index State Table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS file_index_state (
-        path TEXT PRIMARY KEY,
-        modified_time REAL NOT NULL,
-        last_seen REAL NOT NULL
-    )
-    ''')
-    
     # User Memory Table
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS user_memory (
@@ -481,14 +797,14 @@ def init_db():
     # Create default users if they don't exist
     cursor.execute('SELECT * FROM users WHERE username = ?', ('adminuser',))
     if not cursor.fetchone():
-        hashed = pwd_context.hash('admin')
+        hashed = pwd_context().hash('admin')
         cursor.execute('INSERT INTO users (username, display_name, password_hash, role) VALUES (?, ?, ?, ?)', 
                       ('adminuser', 'Administrator', hashed, 'admin'))
         logger.info("Created default admin user: adminuser / admin")
         
     cursor.execute('SELECT * FROM users WHERE username = ?', ('user',))
     if not cursor.fetchone():
-        hashed = pwd_context.hash('admin')
+        hashed = pwd_context().hash('admin')
         cursor.execute('INSERT INTO users (username, display_name, password_hash, role) VALUES (?, ?, ?, ?)', 
                       ('user', 'General User', hashed, 'user'))
         logger.info("Created default general user: user / admin")
@@ -500,10 +816,10 @@ def init_db():
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return pwd_context().hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
@@ -526,7 +842,7 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
-    except JWTError:
+    except jwt.JWTError:
         raise credentials_exception
         
     conn = sqlite3.connect(DB_PATH, check_same_thread=False)
@@ -596,6 +912,12 @@ class IndexedDocument(BaseModel):
     chunk_count: int
     modified_at: str
 
+class PartialIndexRequest(BaseModel):
+    storage_mode: str = "nas"
+    prefixes: List[str] = []  # directories relative to the storage root
+    files: List[str] = []  # explicit files relative to the storage root
+    modified_since: Optional[str] = None  # ISO datetime or UNIX timestamp
+
 class ChunkSearchRequest(BaseModel):
     query: str = ""
 
@@ -639,32 +961,40 @@ def get_chroma_client():
     return chromadb.PersistentClient(path=str(CHROMA_DB_DIR))
 
 class GGUFEmbeddingFunction:
-    def __init__(self, model_path):
+    def __init__(self, model_path, priority: str = "query"):
         self.model_path = model_path
+        self.service = EmbeddingClient(priority)
         
     def __call__(self, input: List[str]) -> List[List[float]]:
+        # Prefer the shared embedding service (one warm model for backend and indexer)
+        if self.service.available():
+            try:
+                return self.service.embed(self.model_path, input)
+            except EmbeddingServiceError as e:
+                logger.warning(f"{e}; embedding in-process instead")
+
         # Use the global lock to prevent concurrent GPU/CPU usage during inference
         with model_manager.thread_lock:
             try:
-                llm = model_manager.get_embed_model(self.model_path)
-                if not llm:
-                    logger.error("Embedding model not loaded")
-                    return [[] for _ in input] # Return empty if failed
-                    
-                embeddings = []
-                for i, text in enumerate(input):
-                    try:
-                        # Llama.cpp embedding
-                        embed = llm.create_embedding(text)
-                        embeddings.append(embed['data'][0]['embedding'])
-                    except Exception as e:
-                        logger.error(f"Failed to create embedding for text {i}: {e}")
-                        # Return zero vector as fallback
-                        embeddings.append([0.0] * 768)  # nomic-embed has 768 dimensions
-                return embeddings
+                with model_manager.embed_lease(self.model_path) as llm:
+                    if not llm:
+                        logger.error("Embedding model not loaded")
+                        return [[] for _ in input] # Return empty if failed
+                        
+                    embeddings = []
+                    for i, text in enumerate(input):
+                        try:
+                            # Llama.cpp embedding
+                            embed = llm.create_embedding(text)
+                            embeddings.append(embed['data'][0]['embedding'])
+                        except Exception as e:
+                            logger.error(f"Failed to create embedding for text {i}: {e}")
+                            # Return zero vector as fallback
+                            embeddings.append([0.0] * embedding_dim(self.model_path))
+                    return embeddings
             except Exception as e:
                 logger.error(f"Critical error in embedding function: {e}")
-                return [[0.0] * 768 for _ in input]
+                return [[0.0] * embedding_dim(self.model_path) for _ in input]
 
 def read_docx_file(path: Path) -> str:
     if not docx: return ""
@@ -751,248 +1081,114 @@ def recursive_character_text_splitter(text: str, chunk_size: int = 1000, chunk_o
 
     return _split_text(text, separators)
 
-import psutil
-try:
-    import psutil
-except ImportError:
-    psutil = None
-
-def index_documents_task():
-    """Background task for indexing with DB-backed state and stop capability"""
-    state.is_indexing = True
-    state.stop_indexing_flag = False
-    state.indexing_status = "Starting..."
-    state.indexing_progress = 0
-    state.indexing_log = []
-    state.indexing_start_time = datetime.now()
-    state.indexing_processed_files = 0
-    state.indexing_total_files = 0
-    
-    process = psutil.Process(os.getpid()) if psutil else None
-
-    def log(msg):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        mem_usage = f"{process.memory_info().rss / 1024 / 1024:.2f} MB" if process else "N/A"
-        entry = f"[{timestamp}][{mem_usage}] {msg}"
-        state.indexing_log.append(entry)
-        if len(state.indexing_log) > 2000:
-            state.indexing_log.pop(0)
-        logger.info(entry)
-
-    log("Starting indexing task...")
-    
-    db_conn = None
-    try:
-        # --- Setup Phase ---
-        scan_start_time = time.time()
-        
-        source_dir = MNT_DIR if state.current_storage_mode == "nas" else INTERNAL_NAS_DIR
-        log(f"Source directory: {source_dir}")
+# Discord Agent Logic Removed
 
-        db_conn = sqlite3.connect(DB_PATH, timeout=60, check_same_thread=False)
-        db_cursor = db_conn.cursor()
-        log("Database connection established.")
 
-        embed_model_name = "nomic-embed-text-v1.5.f16.gguf"
-        embed_model_path = MODELS_DIR / embed_model_name
-        if not embed_model_path.exists():
-            log(f"CRITICAL: Embedding model {embed_model_name} missing.")
-            state.indexing_status = "Error: Model missing"
-            return
-        
-        log("Initializing embedding function...")
-        embedding_fn = GGUFEmbeddingFunction(str(embed_model_path))
-        log("Embedding function initialized.")
-        
-        log("Initializing ChromaDB...")
-        client = get_chroma_client()
-        collection = client.get_or_create_collection(name="nas_documents", embedding_function=embedding_fn)
-        log("ChromaDB collection loaded.")
+# --- Startup Warm-up ---
 
-        # --- Scanning & Indexing Phase ---
-        log("Starting scan and index process...")
-        
-        batch_size = 10
-        current_batch_ids, current_batch_docs, current_batch_metadatas = [], [], []
-        scanned_count, processed_count = 0, 0
-        
-        for root, _, files in os.walk(source_dir):
-            if state.stop_indexing_flag:
-                log("Stop flag received, breaking scan loop.")
-                break
-                
-            for file in files:
-                if state.stop_indexing_flag: break
-                
-                scanned_count += 1
-                file_path = Path(root) / file
-                file_key = str(file_path)
-                
-                if scanned_count % 100 == 0:
-                    state.indexing_status = f"Scanned {scanned_count}, Processed {processed_count}..."
-                    db_conn.commit()  # Periodically commit updates
+FAST_MODEL_NAME = "qwen2-1.5b-instruct-q8_0.gguf"
+EMBED_SERVICE_START_TIMEOUT = int(os.environ.get("EMBED_SERVICE_START_TIMEOUT", "300"))
 
+class WarmupState:
+    """Readiness of the components warmed up after the API has started serving.
 
-                if not file.endswith(('.txt', '.md', '.json', '.py', '.js', '.ts', '.html', '.css', '.csv', '.docx', '.xlsx')):
-                    continue
-                
-                log(f"[{scanned_count}] Checking: {file_key}")
-                    
-                try:
-                    stat = file_path.stat()
-                    mod_time = stat.st_mtime
+    Each component is "pending", "warming", "ready", "skipped" (nothing to
+    warm, e.g. the model isn't installed) or "failed". Requests that need a
+    component before it is warm still work; they just load it themselves.
+    """
 
-                    if stat.st_size > 1024 * 1024 * 1024:
-                        continue
+    COMPONENTS = ["user_models", "chat_model", "embedding", "chroma"]
 
-                    db_cursor.execute("SELECT modified_time FROM file_index_state WHERE path = ?", (file_key,))
-                    result = db_cursor.fetchone()
-                    
-                    if result and result[0] == mod_time:
-                        db_cursor.execute("UPDATE file_index_state SET last_seen = ? WHERE path = ?", (scan_start_time, file_key))
-                        continue
-                        
-                    log(f"  -> Processing required for: {file_key}")
-                    state.indexing_status = f"Indexing: {file}..."
-                    
-                    content = ""
-                    log(f"    - Reading content...")
-                    if file_path.suffix == '.docx':
-                        content = read_docx_file(file_path)
-                    elif file_path.suffix == '.xlsx':
-                        content = read_excel_file(file_path)
-                    else:
-                        if stat.st_size > 10 * 1024 * 1024:
-                            log(f"    - Skipping text read >10MB for: {file}")
-                            continue
-                        try:
-                            content = file_path.read_text(encoding='utf-8', errors='ignore')
-                        except Exception as read_err:
-                            log(f"    - Read error: {read_err}")
-                            continue
-                    log(f"    - Content read. Length: {len(content)}")
-
-                    if not content or not content.strip():
-                        db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen) VALUES (?, ?, ?)",
-                                          (file_key, mod_time, scan_start_time))
-                        log(f"    - Empty content. Skipping.")
-                        continue
-
-                    log(f"    - Chunking content...")
-                    chunks = recursive_character_text_splitter(content, chunk_size=1000, chunk_overlap=200)
-                    log(f"    - Content chunked into {len(chunks)} parts.")
-                    
-                    file_hash = hashlib.md5(file_key.encode()).hexdigest()
-                    mod_time_iso = datetime.fromtimestamp(mod_time).isoformat()
-
-                    log(f"    - Deleting old chunks from ChromaDB...")
-                    collection.delete(where={"path": file_key})
-                    log(f"    - Old chunks deleted.")
-
-                    for j, chunk in enumerate(chunks):
-                        chunk_id = f"{file_hash}_{j}"
-                        current_batch_ids.append(chunk_id)
-                        current_batch_docs.append(chunk)
-                        current_batch_metadatas.append({"filename": file_path.name, "path": file_key, "modified_at": mod_time_iso, "chunk_index": j, "total_chunks": len(chunks)})
-                        
-                        # Process batch if it reaches batch_size, even within a single file
-                        if len(current_batch_ids) >= batch_size:
-                            log(f"    - Adding batch of {len(current_batch_ids)} chunks to ChromaDB...")
-                            try:
-                                collection.add(ids=current_batch_ids, documents=current_batch_docs, metadatas=current_batch_metadatas)
-                                log(f"    - Batch added successfully.")
-                            except Exception as add_err:
-                                log(f"    - ERROR adding batch to ChromaDB: {add_err}")
-                                # Continue processing despite error
-                            current_batch_ids, current_batch_docs, current_batch_metadatas = [], [], []
-
-                    db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen) VALUES (?, ?, ?)",
-                                      (file_key, mod_time, scan_start_time))
-                    db_conn.commit()
-                    
-                    processed_count += 1
-                    state.indexing_processed_files = processed_count
-                    state.indexing_total_files = scanned_count
+    def __init__(self):
+        self.started_at = time.time()
+        self.components: Dict[str, Dict[str, Any]] = {name: {"status": "pending"} for name in self.COMPONENTS}
+        self.task: Optional[asyncio.Task] = None
+
+    async def run(self, name: str, fn):
+        """Run blocking warm-up step `fn` off the event loop; it returns False to mean skipped."""
+        self.components[name] = {"status": "warming"}
+        start = time.monotonic()
+        try:
+            result = await run_in_threadpool(fn)
+        except Exception as e:
+            logger.error(f"Warm-up of {name} failed: {e}")
+            self.components[name] = {"status": "failed", "error": str(e),
+                                     "seconds": round(time.monotonic() - start, 2)}
+            return
+        status = "skipped" if result is False else "ready"
+        self.components[name] = {"status": status, "seconds": round(time.monotonic() - start, 2)}
+        logger.info(f"Warm-up of {name}: {status} in {self.components[name]['seconds']}s")
 
-                except Exception as e:
-                    log(f"  -> CRITICAL ERROR processing {file}: {e}")
+    def ready(self) -> bool:
+        return all(c["status"] in ("ready", "skipped") for c in self.components.values())
 
-        # Final Batch
-        if current_batch_ids and not state.stop_indexing_flag:
-            log(f"Adding final batch of {len(current_batch_ids)} chunks...")
-            try:
-                collection.add(ids=current_batch_ids, documents=current_batch_docs, metadatas=current_batch_metadatas)
-                db_conn.commit()
-                log("Final batch added and DB committed.")
-            except Exception as e:
-                log(f"ERROR adding final batch: {e}")
+warmup = WarmupState()
 
-        # --- Deletion Handling Phase ---
-        if not state.stop_indexing_flag:
-            log("Checking for deleted files...")
-            db_cursor.execute("SELECT path FROM file_index_state WHERE last_seen < ?", (scan_start_time,))
-            deleted_files = db_cursor.fetchall()
-            
-            if deleted_files:
-                deleted_paths = [row[0] for row in deleted_files]
-                log(f"Found {len(deleted_paths)} deleted files. Removing from index...")
-                
-                for i in range(0, len(deleted_paths), 100):
-                    batch_paths = deleted_paths[i:i+100]
-                    log(f"  - Deleting batch of {len(batch_paths)} from ChromaDB.")
-                    collection.delete(where={"path": {"$in": batch_paths}})
-                
-                log("  - Deleting records from state DB.")
-                db_cursor.execute("DELETE FROM file_index_state WHERE last_seen < ?", (scan_start_time,))
-                db_conn.commit()
-                log("Finished removing deleted files.")
-
-        if state.stop_indexing_flag:
-            state.indexing_status = "Stopped"
-            log("Indexing process stopped by user.")
-        else:
-            state.indexing_status = "Completed"
-            state.last_indexed_at = datetime.now().isoformat()
-            log(f"Indexing completed successfully. Scanned {scanned_count} files.")
-            db_cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('last_indexed_at', state.last_indexed_at))
-            db_conn.commit()
-            
-    except Exception as e:
-        log(f"--- !!! CRITICAL INDEXING FAILURE !!! --- : {e}")
-        state.indexing_status = f"Failed: {str(e)}"
-        if db_conn:
-            db_conn.rollback()
-    finally:
-        log("Indexing task finished. Closing DB connection.")
-        if db_conn:
-            db_conn.close()
-        state.is_indexing = False
+def warm_user_models():
+    # Views of the blob store for every user (ingests new shared models first)
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.execute('SELECT username FROM users')
+    all_users = cursor.fetchall()
+    conn.close()
+    shared_models = sync_shared_models()
+    for (u_name,) in all_users:
+        ensure_user_models_dir(u_name, shared_models)
 
-# Discord Agent Logic Removed
+def warm_chat_model():
+    fast_model_path = MODELS_DIR / FAST_MODEL_NAME
+    if not fast_model_path.exists():
+        logger.warning(f"Fast model not found at {fast_model_path}, skipping preload.")
+        return False
+    logger.info(f"Preloading Fast model: {fast_model_path}")
+    model_manager.get_llm(str(fast_model_path))
+
+def warm_embedding():
+    if state.embedding_service:
+        # The service loads and exercises the model before it opens its socket
+        client = EmbeddingClient()
+        deadline = time.monotonic() + EMBED_SERVICE_START_TIMEOUT
+        while not client.available():
+            if state.embedding_service.poll() is not None:
+                raise RuntimeError(f"embedding service exited with code {state.embedding_service.returncode}")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"embedding service not up after {EMBED_SERVICE_START_TIMEOUT}s")
+            time.sleep(0.5)
+        return
+    embed_model_path = MODELS_DIR / "nomic-embed-text-v1.5.f16.gguf"
+    if not embed_model_path.exists():
+        return False
+    model_manager.get_embed_model(str(embed_model_path))
+
+def warm_chroma():
+    if chromadb is None:
+        return False
+    client = get_chroma_client()
+    try:
+        collection = client.get_collection(f"documents_{get_storage_mode()}")
+    except Exception:
+        return False  # Nothing indexed yet
+    collection.count()
 
+async def warm_up():
+    async def models():
+        # Views first: ingesting hashes new model files, so the preload then reads from the page cache
+        await warmup.run("user_models", warm_user_models)
+        await warmup.run("chat_model", warm_chat_model)
+    await asyncio.gather(models(), warmup.run("embedding", warm_embedding), warmup.run("chroma", warm_chroma))
+    logger.info(f"Warm-up finished {time.time() - warmup.started_at:.1f}s after startup")
 
 # --- FastAPI App ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     init_db()
+    index_state.init_index_db()
 
     # Reset stuck indexing state if present
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'indexing_status'")
-        row = cursor.fetchone()
-        if row:
-            status = json.loads(row[0])
-            if status.get("is_indexing"):
-                logger.warning("Found stuck indexing state on startup. Resetting to Idle.")
-                status["is_indexing"] = False
-                status["status"] = "Interrupted"
-                cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", 
-                              ("indexing_status", json.dumps(status)))
-                conn.commit()
-        conn.close()
+        if index_state.reset_stuck_status():
+            logger.warning("Found stuck indexing state on startup. Resetting to Idle.")
     except Exception as e:
         logger.error(f"Failed to reset indexing state: {e}")
     
@@ -1004,40 +1200,40 @@ async def lifespan(app: FastAPI):
     if row:
         state.current_storage_mode = row[0]
         
-    cursor.execute('SELECT value FROM settings WHERE key = ?', ('last_indexed_at',))
-    row = cursor.fetchone()
-    if row:
-        state.last_indexed_at = row[0]
-    
     conn.close()
 
-    # Ensure model directories for all users
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute('SELECT username FROM users')
-    all_users = cursor.fetchall()
-    conn.close()
-    
-    for (u_name,) in all_users:
-        ensure_user_models_dir(u_name)
+    state.last_indexed_at = index_state.get_last_indexed_at()
 
-    # Preload Fast model for adminuser as a warm-up (optional)
-    admin_models = ensure_user_models_dir("adminuser")
-    fast_model_path = admin_models / "qwen2-1.5b-instruct-q8_0.gguf"
-    if fast_model_path.exists():
-        logger.info(f"Preloading Fast model: {fast_model_path}")
-        try:
-            model_manager.get_llm(str(fast_model_path))
-            logger.info("Fast model preloaded successfully.")
-        except Exception as e:
-            logger.error(f"Failed to preload Fast model: {e}")
-    else:
-        logger.warning(f"Fast model not found at {fast_model_path}, skipping preload.")
-    
+    # Pull pinned (MODEL_PIN) models into the page cache in the background
+    for pinned in pinned_models():
+        asyncio.get_running_loop().run_in_executor(None, warm_page_cache, pinned)
+
+    # Shared embedding service for search, uploads and the indexer
+    if os.environ.get("EMBED_SERVICE", "1") != "0":
+        logger.info("Starting embedding service...")
+        state.embedding_service = subprocess.Popen([sys.executable, "embedding_service.py"])
+
+    # Recurring off-peak indexing windows
+    index_scheduler.start()
+
+    # Continue model downloads interrupted by the last shutdown
+    download_manager.resume_pending()
+
+    # Everything slow happens after we start serving; /readyz reports progress
+    warmup.task = asyncio.create_task(warm_up())
     
     yield
     
     # Shutdown
+    warmup.task.cancel()
+    await index_scheduler.stop()
+    await download_manager.shutdown()
+    if state.embedding_service and state.embedding_service.poll() is None:
+        state.embedding_service.terminate()
+        try:
+            state.embedding_service.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            state.embedding_service.kill()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -1060,6 +1256,20 @@ app.add_middleware(
 
 # --- Endpoints ---
 
+# --- Health Endpoints (unauthenticated, for container and load balancer probes) ---
+
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and its event loop answers."""
+    return {"status": "ok", "uptime_seconds": round(time.time() - warmup.started_at, 1)}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness per component; 503 until every warm-up step is done."""
+    components = {"database": {"status": "ready"}, **warmup.components}
+    ready = warmup.ready()
+    return JSONResponse(status_code=200 if ready else 503, content={"ready": ready, "components": components})
+
 # --- Canvas Endpoints ---
 
 @app.get("/api/canvases", response_model=List[Canvas])
@@ -1322,17 +1532,16 @@ async def ai_greet(req: GreetRequest, current_user: dict = Depends(get_current_u
         if not model_path:
              return {"greeting": f"{req.time_of_day}。今日も素晴らしい一日になりますように。"}
 
-        llm = model_manager.get_llm(model_path)
-        res = llm.create_chat_completion(
+        # Runs on every dashboard load, so it gives way to chats that arrive meanwhile
+        greeting = (await background_completion(
+            model_path, current_user['id'],
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ],
             max_tokens=64,
             temperature=0.8
-        )
-        
-        greeting = res['choices'][0]['message']['content'].strip()
+        )).strip()
         return {"greeting": greeting}
     except Exception as e:
         logger.error(f"Greet Error: {e}")
@@ -1367,7 +1576,7 @@ async def create_user(user: UserCreate, background_tasks: BackgroundTasks, admin
         conn.commit()
         
         # Trigger model directory creation in background
-        background_tasks.add_task(ensure_user_models_dir, user.username)
+        background_tasks.add_task(setup_new_user_models, user.username)
         
         return {"id": user_id, "username": user.username, "display_name": user.display_name, "role": user.role, "created_at": datetime.now().isoformat()}
     except sqlite3.IntegrityError:
@@ -1428,14 +1637,12 @@ async def delete_user(user_id: int, admin: dict = Depends(get_current_admin)):
     conn.commit()
     conn.close()
     
-    # Clean up user's model directory
-    user_model_dir = BASE_DIR / f"models_{username}"
-    if user_model_dir.exists() and user_model_dir != MODELS_DIR:
-        try:
-            shutil.rmtree(user_model_dir)
-            logger.info(f"Deleted model directory for {username}: {user_model_dir}")
-        except Exception as e:
-            logger.error(f"Failed to delete model directory for {username}: {e}")
+    # Clean up user's model directory (links only; blobs go once nothing refers to them)
+    try:
+        await run_in_threadpool(remove_user_view, username)
+        logger.info(f"Deleted model directory for {username}")
+    except Exception as e:
+        logger.error(f"Failed to delete model directory for {username}: {e}")
             
     return {"status": "success"}
 
@@ -1468,19 +1675,11 @@ async def get_nas_status(admin: dict = Depends(get_current_admin)):
                 pass
 
 
-    # Get total indexed documents count from DB
+    # Get total indexed documents count from the index state DB
     total_indexed_documents = 0
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM file_index_state")
-        total_indexed_documents = cursor.fetchone()[0]
-        
-        # Get correct last_indexed_at
-        cursor.execute("SELECT value FROM settings WHERE key = 'last_indexed_at'")
-        last_indexed_row = cursor.fetchone()
-        last_indexed_at = last_indexed_row[0] if last_indexed_row else None
-        conn.close()
+        total_indexed_documents = index_state.count_indexed_files()
+        last_indexed_at = index_state.get_last_indexed_at()
     except Exception as e:
         logger.error(f"Error fetching stats: {e}")
         last_indexed_at = None
@@ -1530,55 +1729,114 @@ async def trigger_indexing(background_tasks: BackgroundTasks, storage_mode: str
         raise HTTPException(status_code=400, detail="Indexing already in progress")
     
     logger.info("Triggering indexing process...")
-    # Run indexer.py in a separate process
-    subprocess.Popen([sys.executable, "indexer.py", storage_mode])
+    start_indexer_process(storage_mode)
     
     return {"status": "started", "storage_mode": storage_mode}
 
+def start_indexer_process(storage_mode: str, extra_args: Optional[List[str]] = None) -> subprocess.Popen:
+    # Run indexer.py in a separate process
+    return subprocess.Popen([sys.executable, "indexer.py", storage_mode] + (extra_args or []))
+
+@app.post("/api/admin/index/partial")
+async def trigger_partial_indexing(req: PartialIndexRequest, admin: dict = Depends(get_current_admin)):
+    """Reindex only a subtree, an explicit file list and/or files modified since a point in time"""
+    if req.storage_mode not in ["nas", "internal"]:
+        raise HTTPException(status_code=400, detail="Invalid mode")
+    if not req.prefixes and not req.files and not req.modified_since:
+        raise HTTPException(status_code=400, detail="Specify prefixes, files or modified_since")
+    if len(req.files) > 1000:
+        raise HTTPException(status_code=400, detail="Too many files (max 1000); use prefixes instead")
+
+    status = get_db_status()
+    if status.get("is_indexing"):
+        raise HTTPException(status_code=400, detail="Indexing already in progress")
+
+    for rel in req.prefixes + req.files:
+        if ".." in Path(rel).parts:
+            raise HTTPException(status_code=400, detail=f"Invalid path: {rel}")
+
+    args = []
+    for prefix in req.prefixes:
+        args += ["--prefix", prefix]
+    for f in req.files:
+        args += ["--file", f]
+    if req.modified_since:
+        try:
+            since = float(req.modified_since)
+        except ValueError:
+            try:
+                since = datetime.fromisoformat(req.modified_since).timestamp()
+            except ValueError:
+                raise HTTPException(status_code=400, detail="modified_since must be ISO datetime or UNIX timestamp")
+        args += ["--since", str(since)]
+
+    logger.info(f"Triggering partial indexing: {args}")
+    start_indexer_process(req.storage_mode, args)
+    return {"status": "started", "storage_mode": req.storage_mode, "prefixes": req.prefixes,
+            "files": len(req.files), "modified_since": req.modified_since}
+
 @app.post("/api/admin/index/stop")
 async def stop_indexing(admin: dict = Depends(get_current_admin)):
     try:
-        # Immediately signal the running task to stop in memory
-        state.stop_indexing_flag = True
-        
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ("stop_indexing_flag", "true"))
-        conn.commit()
-        conn.close()
+        index_state.request_stop()
         return {"status": "stopping"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+index_scheduler = IndexScheduler(
+    start_indexer=lambda storage_mode: start_indexer_process(storage_mode),
+    is_indexing=lambda: bool(get_db_status().get("is_indexing"))
+)
+
+class IndexSchedule(BaseModel):
+    id: Optional[int] = None
+    name: Optional[str] = None
+    days: str = "*"  # cron day-of-week field, e.g. "1-5"
+    start_time: str  # "HH:MM"
+    end_time: str  # "HH:MM", may be earlier than start_time to cross midnight
+    max_runtime_minutes: Optional[int] = None
+    storage_mode: str = "nas"
+    enabled: bool = True
+
+@app.get("/api/admin/index/schedules")
+async def list_index_schedules(admin: dict = Depends(get_current_admin)):
+    return index_state.get_schedules()
+
+@app.post("/api/admin/index/schedules")
+async def save_index_schedule(schedule: IndexSchedule, admin: dict = Depends(get_current_admin)):
+    data = schedule.dict()
+    try:
+        validate_schedule(data)
+    except (ValueError, KeyError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid schedule: {e}")
+    schedule_id = index_state.save_schedule(data)
+    return {"status": "saved", "id": schedule_id}
+
+@app.delete("/api/admin/index/schedules/{schedule_id}")
+async def delete_index_schedule(schedule_id: int, admin: dict = Depends(get_current_admin)):
+    if not index_state.delete_schedule(schedule_id):
+        raise HTTPException(status_code=404, detail="Schedule not found")
+    return {"status": "deleted"}
+
+@app.get("/api/admin/index/jobs")
+async def list_index_jobs(limit: int = 50, admin: dict = Depends(get_current_admin)):
+    return index_state.get_jobs(limit)
+
+@app.get("/api/admin/index/runs")
+async def get_indexing_runs(limit: int = 20, admin: dict = Depends(get_current_admin)):
+    return index_state.get_runs(limit)
+
 @app.post("/api/admin/index/clear")
 async def clear_indexing_status(admin: dict = Depends(get_current_admin)):
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # 1. Clear SQLite Status
-        # Also clear in-memory state to reflect immediately
+        # 1. Clear in-memory state to reflect immediately
         state.indexing_log = []
         state.indexing_processed_files = 0
         state.indexing_total_files = 0
-        
-        empty_status = {
-            "status": "Idle",
-            "progress": 0,
-            "is_indexing": False,
-            "processed_files": 0,
-            "total_files": 0,
-            "last_updated": datetime.now().isoformat(),
-            "indexing_log": []
-        }
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", 
-                      ("indexing_status", json.dumps(empty_status)))
-                      
-        # 2. Clear File Index State (to force re-scan)
-        cursor.execute("DELETE FROM file_index_state")
-        cursor.execute("DELETE FROM settings WHERE key = 'last_indexed_at'")
-        conn.commit()
-        conn.close()
+        state.last_indexed_at = None
+
+        # 2. Clear status, log and file index state (to force re-scan)
+        index_state.clear_index_state()
 
         # 3. Clear ChromaDB Collections
         try:
@@ -1681,71 +1939,53 @@ async def agent_chat(request: ChatRequest, current_user: dict = Depends(get_curr
         return {"role": "assistant", "content": f"I crashed: {e}", "session_id": session_id}
 
 # --- Model Management APIs ---
-MODEL_DOWNLOAD_TASKS = {} # task_id -> {status, progress, total, filename, error}
-
 class ModelDownloadRequest(BaseModel):
     url: str
     filename: str
-
-async def download_model_background(task_id: str, url: str, filename: str):
-    MODEL_DOWNLOAD_TASKS[task_id] = {
-        "status": "downloading",
-        "progress": 0,
-        "total": 0,
-        "filename": filename
+    sha256: Optional[str] = None  # Expected digest; the download fails if it doesn't match
+    max_mbps: Optional[float] = None
+
+async def publish_download(path: Path, sha256: str):
+    # Store once and link into every user's model directory
+    logger.info(f"Publishing {path.name} to all user directories...")
+    await run_in_threadpool(publish_model, path, sha256)
+
+download_manager = DownloadManager(DB_PATH, MODELS_DIR, on_complete=publish_download)
+
+class ModelBenchmarkRequest(BaseModel):
+    models: List[str] = []  # Filenames in models/; empty = all installed models
+
+@app.post("/api/admin/models/benchmark")
+async def start_model_benchmark(req: ModelBenchmarkRequest, admin: dict = Depends(get_current_admin)):
+    """Benchmark models in a separate process; results appear in /api/admin/models/benchmarks"""
+    if state.benchmark_process and state.benchmark_process.poll() is None:
+        raise HTTPException(status_code=409, detail="A benchmark is already running")
+    args = []
+    for name in req.models:
+        if os.path.basename(name) != name or not (MODELS_DIR / name).exists():
+            raise HTTPException(status_code=400, detail=f"Unknown model: {name}")
+        args += ["--model", name]
+    state.benchmark_process = subprocess.Popen([sys.executable, "benchmark.py"] + args)
+    return {"status": "started"}
+
+@app.get("/api/admin/models/benchmarks")
+async def get_model_benchmarks(admin: dict = Depends(get_current_admin)):
+    running = bool(state.benchmark_process and state.benchmark_process.poll() is None)
+    hardware = await run_in_threadpool(hardware_fingerprint)
+    results = await run_in_threadpool(latest_results, DB_PATH, hardware)
+    return {"running": running, "hardware": hardware, "results": results}
+
+@app.get("/api/admin/models/pool")
+async def get_model_pool(admin: dict = Depends(get_current_admin)):
+    return {
+        "budget_mb": round(model_manager.budget_bytes / 1024 / 1024),
+        "resident_mb": round(model_manager.resident_bytes() / 1024 / 1024),
+        "models": model_manager.pool_status(),
+        "session_states": session_states.stats(),
+        "queues": model_manager.scheduler.status(),
+        "store": store_status(),
+        "tokenizers": tokenizer_stats()
     }
-    
-    target_path = MODELS_DIR / filename
-    temp_path = target_path.with_suffix(".tmp")
-    
-    try:
-        async with httpx.AsyncClient(timeout=None) as client:
-            async with client.stream("GET", url, follow_redirects=True) as resp:
-                if resp.status_code != 200:
-                    raise Exception(f"HTTP {resp.status_code}")
-                
-                total = int(resp.headers.get("content-length", 0))
-                MODEL_DOWNLOAD_TASKS[task_id]["total"] = total
-                
-                downloaded = 0
-                with open(temp_path, "wb") as f:
-                    async for chunk in resp.aiter_bytes(chunk_size=1024*1024): # 1MB chunks
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        
-                        if total > 0:
-                            progress = int((downloaded / total) * 100)
-                            MODEL_DOWNLOAD_TASKS[task_id]["progress"] = progress
-                            
-        # Rename on success
-        if target_path.exists():
-            target_path.unlink() # Overwrite if exists
-        temp_path.rename(target_path)
-        
-        # Sync to all existing user directories
-        logger.info(f"Syncing {filename} to all user directories...")
-        for user_dir in BASE_DIR.glob("models_*"):
-            if user_dir.is_dir():
-                # Admin uses base MODELS_DIR, so no need to copy to models_adminuser (which shouldn't exist ideally)
-                if user_dir.name == "models_adminuser":
-                    continue
-                    
-                try:
-                    user_model_path = user_dir / filename
-                    logger.info(f"Copying to {user_dir.name}...")
-                    shutil.copy2(target_path, user_model_path)
-                except Exception as sync_err:
-                    logger.error(f"Failed to sync to {user_dir.name}: {sync_err}")
-
-        MODEL_DOWNLOAD_TASKS[task_id]["status"] = "completed"
-        MODEL_DOWNLOAD_TASKS[task_id]["progress"] = 100
-        
-    except Exception as e:
-        logger.error(f"Download failed: {e}")
-        MODEL_DOWNLOAD_TASKS[task_id]["status"] = "error"
-        MODEL_DOWNLOAD_TASKS[task_id]["error"] = str(e)
-        if temp_path.exists():
-            temp_path.unlink()
 
 @app.get("/api/models/list")
 async def list_models_api(current_user: dict = Depends(get_current_user)):
@@ -1753,54 +1993,68 @@ async def list_models_api(current_user: dict = Depends(get_current_user)):
     if not MODELS_DIR.exists():
         return []
     
-    models = []
-    for f in MODELS_DIR.glob("*.gguf"):
-        models.append({
+    def describe(f: Path) -> dict:
+        info = model_info(f) or {}
+        return {
             "name": f.name,
             "size": f.stat().st_size,
-            "modified": datetime.fromtimestamp(f.stat().st_mtime).isoformat()
-        })
-    return models
+            "modified": datetime.fromtimestamp(f.stat().st_mtime).isoformat(),
+            "architecture": info.get("architecture"),
+            "parameters": info.get("parameters"),
+            "quantization": info.get("quantization"),
+            "context_length": info.get("context_length"),
+            "embedding_length": info.get("embedding_length")
+        }
+
+    # Headers are cached by file hash, but a new file is hashed once on first listing
+    return await run_in_threadpool(lambda: [describe(f) for f in sorted(MODELS_DIR.glob("*.gguf"))])
 
 @app.post("/api/models/download")
-async def start_model_download(req: ModelDownloadRequest, background_tasks: BackgroundTasks, current_user: dict = Depends(get_current_user)):
+async def start_model_download(req: ModelDownloadRequest, current_user: dict = Depends(get_current_user)):
     # Check if already exists
     if (MODELS_DIR / req.filename).exists():
         raise HTTPException(status_code=409, detail="Model already exists")
 
-    task_id = str(uuid.uuid4())
-    background_tasks.add_task(download_model_background, task_id, req.url, req.filename)
+    try:
+        task_id = download_manager.start(req.url, req.filename, req.sha256, req.max_mbps)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     return {"task_id": task_id, "status": "started"}
 
 @app.get("/api/models/download/{task_id}")
 async def get_download_status(task_id: str, current_user: dict = Depends(get_current_user)):
-    return MODEL_DOWNLOAD_TASKS.get(task_id, {"status": "not_found"})
+    return download_manager.status(task_id)
+
+@app.post("/api/models/download/{task_id}/retry")
+async def retry_model_download(task_id: str, current_user: dict = Depends(get_current_user)):
+    try:
+        download_manager.retry(task_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"task_id": task_id, "status": "started"}
 
 @app.get("/api/admin/index/documents", response_model=List[IndexedDocument])
 async def get_indexed_documents(admin: dict = Depends(get_current_admin)):
     try:
-        client = get_chroma_client()
-        collection = client.get_collection("nas_documents")
-        
-        # Get all metadata
-        # Note: This might be heavy if millions of chunks. 
-        # For now, we'll aggregate from metadata.
-        result = collection.get(include=['metadatas'])
-        metadatas = result['metadatas']
-        
+        # Every recorded path is listed, including copies whose chunks carry another path
+        # in their metadata since content dedup; pre-dedup entries are counted by chunk
+        rows = await run_in_threadpool(index_state.indexed_files)
         files = {}
-        for m in metadatas:
-            path = m['path']
-            if path not in files:
-                files[path] = {
-                    "id": hashlib.md5(path.encode()).hexdigest(),
-                    "filename": m['filename'],
-                    "path": path,
-                    "chunk_count": 0,
-                    "modified_at": m.get('modified_at', '')
-                }
-            files[path]['chunk_count'] += 1
-            
+        for row in rows:
+            files[row["path"]] = {
+                "id": hashlib.md5(row["path"].encode()).hexdigest(),
+                "filename": os.path.basename(row["path"]),
+                "path": row["path"],
+                "chunk_count": row["chunk_count"],
+                "modified_at": row["modified_at"]
+            }
+        legacy = [r["path"] for r in rows if not r["content_hash"]]
+        if legacy:
+            collection = get_chroma_client().get_collection("nas_documents")
+            result = collection.get(where={"path": {"$in": legacy}}, include=['metadatas'])
+            for m in result['metadatas']:
+                files[m['path']]['chunk_count'] += 1
+
         return list(files.values())
     except Exception as e:
         logger.error(f"Error fetching documents: {e}")
@@ -1813,9 +2067,10 @@ async def search_indexed_chunks(request: ChunkSearchRequest, admin: dict = Depen
         collection = client.get_collection("nas_documents")
         
         if request.file_path:
-            # Filter by specific file
+            # Chunks are stored once per content, under one of its paths; pre-dedup entries by path
+            content_hash = await run_in_threadpool(index_state.content_hash_for_path, request.file_path)
             result = collection.get(
-                where={"path": request.file_path},
+                where={"content_hash": content_hash} if content_hash else {"path": request.file_path},
                 limit=request.limit,
                 include=['documents', 'metadatas']
             )
@@ -1933,8 +2188,55 @@ async def delete_session(session_id: str, current_user: dict = Depends(get_curre
     cursor.execute('DELETE FROM chat_sessions WHERE id = ?', (session_id,))
     conn.commit()
     conn.close()
+    session_states.drop(session_id)
     return {"status": "success"}
 
+# Cancel flags of the generations currently streaming, per session (set by the stop endpoint)
+active_generations: Dict[str, List[threading.Event]] = {}
+
+def register_generation(session_id: str) -> threading.Event:
+    cancel = threading.Event()
+    active_generations.setdefault(session_id, []).append(cancel)
+    return cancel
+
+def unregister_generation(session_id: str, cancel: threading.Event):
+    flags = active_generations.get(session_id, [])
+    if cancel in flags:
+        flags.remove(cancel)
+    if not flags:
+        active_generations.pop(session_id, None)
+
+def save_assistant_message(session_id: str, content: str):
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    cursor = conn.cursor()
+    
+    # Update session timestamp
+    cursor.execute('UPDATE chat_sessions SET updated_at = ? WHERE id = ?', 
+                  (datetime.utcnow().isoformat(), session_id))
+                  
+    ts = datetime.utcnow().isoformat()
+    cursor.execute('INSERT INTO chat_messages (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)', 
+                  (session_id, 'assistant', content, ts))
+                  
+    conn.commit()
+    conn.close()
+
+@app.post("/api/chat/sessions/{session_id}/stop")
+async def stop_generation(session_id: str, current_user: dict = Depends(get_current_user)):
+    """Stop the answer currently being generated for a session; the partial answer is kept"""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    cursor = conn.cursor()
+    cursor.execute('SELECT user_id FROM chat_sessions WHERE id = ?', (session_id,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row or row[0] != current_user['id']:
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    flags = active_generations.get(session_id, [])
+    for cancel in flags:
+        cancel.set()
+    return {"status": "stopping" if flags else "idle"}
+
 # Helper function to get conversation history
 def get_conversation_history(session_id: str, limit: int = 5) -> List[dict]:
     """Get last N messages from a session for context"""
@@ -2119,6 +2421,61 @@ def get_recent_summaries(session_id: str, limit: int = 5) -> str:
         summary_block += f"- {r[0]}\n"
     return summary_block + "\n"
 
+# Longest an interactive request waits for a running background generation to hand over the model
+BACKGROUND_PREEMPT_MAX_DELAY = float(os.environ.get("BACKGROUND_PREEMPT_MAX_DELAY_MS", "200")) / 1000
+
+def prefill_preemptible(llm, prompt: str, preempt: threading.Event) -> bool:
+    """Evaluate a completion prompt in slices of about BACKGROUND_PREEMPT_MAX_DELAY each.
+
+    The completion that follows finds the prompt in the context and only
+    evaluates its last token. Returns False when preempted between slices.
+    """
+    if not hasattr(llm, "eval"):
+        return True  # Remote models prefill server-side
+    tokens = prompt_tokens(llm, prompt)
+    prefix = keep_prefix(llm, tokens, min_new=1)
+    return eval_in_slices(llm, tokens[prefix:-1], preempt.is_set, max_delay=BACKGROUND_PREEMPT_MAX_DELAY)
+
+async def background_completion(model_path: str, user: str, prompt: str = None, messages: List[dict] = None,
+                                max_tokens: int = 256, priority: int = SUMMARY, **kwargs) -> str:
+    """Text of a background generation that gives way to interactive and agent requests.
+
+    Once urgent work waits for the model, decoding stops at the next token
+    (or prefill slice) and the model is handed over. Afterwards a completion
+    (`prompt`) resumes from the text generated so far; a chat completion
+    (`messages`) is short and simply restarts.
+    """
+    ticket = model_manager.enqueue_generation(model_path, priority, user, preemptible=True)
+    text = ""
+    try:
+        while True:
+            await ticket.wait_granted()
+            finished = False
+            with await run_in_threadpool(model_manager.llm_lease, model_path) as llm:
+                if prompt is not None:
+                    # Chunks aren't tokens (incomplete UTF-8 is held back), so count what was generated
+                    generated = await run_in_threadpool(count_tokens, model_path, text) if text else 0
+                    if generated >= max_tokens:
+                        return text
+                    make_stream = lambda: llm.create_completion(
+                        prompt=prompt + text, max_tokens=max_tokens - generated, stream=True, **kwargs)
+                    ready = await run_in_generation_thread(prefill_preemptible, llm, prompt + text, ticket.preempt)
+                else:
+                    text = ""
+                    make_stream = lambda: llm.create_chat_completion(
+                        messages=messages, max_tokens=max_tokens, stream=True, **kwargs)
+                    ready = True
+                if ready:
+                    async for chunk in iterate_in_thread(make_stream, cancel=ticket.preempt):
+                        choice = chunk['choices'][0]
+                        text += choice.get('text') or choice.get('delta', {}).get('content') or ""
+                        finished = finished or bool(choice.get('finish_reason'))
+            if finished or not ticket.preempt.is_set():
+                return text
+            ticket.yield_turn()
+    finally:
+        ticket.release()
+
 async def summarize_old_messages(session_id: str, model_path: Path):
     """
     Background Task: Check if message count > threshold, then summarize oldest chunk and move to summaries table.
@@ -2178,20 +2535,19 @@ async def summarize_old_messages(session_id: str, model_path: Path):
             else:
                 return 
 
-        llm = model_manager.get_llm(str(fast_model))
-        
         prompt = f"""Summarize the following conversation segment concisely in 2-3 sentences. Capture key facts and topics.
 
 {text_to_summary}
 
 Summary:"""
 
-        output = llm.create_completion(
+        # Background work: hands the model to interactive and agent generations mid-summary
+        summary = (await background_completion(
+            str(fast_model), "summarizer",
             prompt=prompt,
             max_tokens=200,
             stop=["\n\n"]
-        )
-        summary = output['choices'][0]['text'].strip()
+        )).strip()
         
         # Save to DB
         conn = sqlite3.connect(DB_PATH)
@@ -2221,7 +2577,11 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
     async def generate():
         try:
             # 1. Model Selection & Context Setup
-            user_models_dir = ensure_user_models_dir(current_user['username'])
+            if warmup.components["user_models"]["status"] == "ready":
+                user_models_dir = await run_in_threadpool(ensure_user_models_dir, current_user['username'])
+            else:
+                # Views are still being built at startup: use the shared models they will link to
+                user_models_dir = MODELS_DIR
             
             model_filename = request.model_id
             model_filename = request.model_id
@@ -2380,8 +2740,18 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
                 context = agent_gateway.sessions[session_id]
                 
                 # Execute the new Async Generator Loop
+                agent_cancel = register_generation(session_id)
+                agent_stream = agent.run_solo_loop(context, request.message)
+                streamed = ""
                 try:
-                    async for event in agent.run_solo_loop(context, request.message):
+                    async for event in agent_stream:
+                        if agent_cancel.is_set():
+                            # Stop pressed: closing the loop (below) stops the model within a token
+                            if streamed:
+                                save_assistant_message(session_id, streamed)
+                            yield f"data: {json.dumps({'session_id': session_id, 'done': True, 'stopped': True})}\n\n"
+                            return
+
                         if "status" in event:
                              yield f"data: {json.dumps({'status': event['status']})}\n\n"
                         
@@ -2397,6 +2767,7 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
                              # Let's stream as raw content. The user will see:
                              # "Thought: ... Action: ..."
                              chunk = event['thought_chunk']
+                             streamed += chunk
                              yield f"data: {json.dumps({'content': chunk})}\n\n"
 
                         if "thought" in event:
@@ -2449,6 +2820,14 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
                     error_json = json.dumps({'content': f'\n\n[System Error: {str(e)}]\n\n'})
                     yield f"data: {error_json}\n\n"
                     return
+                except BaseException:
+                    # Client disconnected: keep the partial answer
+                    if streamed:
+                        save_assistant_message(session_id, streamed)
+                    raise
+                finally:
+                    await agent_stream.aclose()
+                    unregister_generation(session_id, agent_cancel)
 
             session_id = request.session_id
             new_session = False
@@ -2586,14 +2965,13 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
                             # Extract nouns/keywords from message for vector search
                             keywords = " ".join(re.findall(r'[一-龠ぁ-んァ-ヶa-zA-Z0-9]+', request.message))
                             query_text = f"search_query: {keywords}"
-                            query_embed = embedding_fn([query_text])[0]
+                            query_embed = (await run_in_threadpool(embedding_fn, [query_text]))[0]
                             
                             # Yield heartbeat before long search
                             yield f"data: {json.dumps({'status': '最良の資料を抽出中...'})}\n\n"
-                            await asyncio.sleep(0.01)
 
                             # Safe number of results for 8k context window
-                            results = collection.query(query_embeddings=[query_embed], n_results=12)
+                            results = await run_in_threadpool(collection.query, query_embeddings=[query_embed], n_results=12)
                             
                             if results['documents']:
                                 doc_texts = results['documents'][0]
@@ -2625,11 +3003,16 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
             if summaries_block:
                 full_system_content += summaries_block + "\n"
             if nas_context:
-                # Safety Truncate nas_context if it looks too big
-                # With n_ctx=4096, assume approx 3000 chars for context + 1000 for log/system is safe-ish
-                if len(nas_context) > 3500:
-                    logger.warning("Truncating NAS context to prevent overflow")
-                    nas_context = nas_context[:3500] + "\n...(truncated)..."
+                # Reference material gets what the context has left after the prompt, the log and the answer
+                def nas_budget():
+                    used = count_tokens(model_path, full_system_content + (system_notice or ""))
+                    used += count_message_tokens(model_path, current_log_messages)
+                    return model_manager.context_size(str(model_path)) - CHAT_RESPONSE_RESERVE_TOKENS - used - 64
+                budget = await run_in_threadpool(nas_budget)
+                if await run_in_threadpool(count_tokens, model_path, nas_context) > budget:
+                    logger.warning(f"Truncating NAS context to {budget} tokens to prevent overflow")
+                    nas_context = await run_in_threadpool(truncate_tokens, model_path, nas_context, max(budget, 0))
+                    nas_context += "\n...(truncated)..."
 
                 full_system_content += "=== 参照資料 ===\n" + nas_context + "\n"
             if system_notice:
@@ -2663,13 +3046,6 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
             # 3. Generate Response
             # --- Canvas Agent Logic (Simplified) ---
             # Bypass complex Manager/Worker split for now to ensure reliability with smaller models
-            if request.canvas_mode:
-                 # Check for dedicated code model if available, otherwise use default
-                 # For now, just use the selected model but with the strict system prompt applied above
-                 llm = model_manager.get_llm(str(model_path))
-            else:
-                llm = model_manager.get_llm(str(model_path))
-            
             # Yield a small pulse to keep connection alive during prefill
             yield f"data: {json.dumps({'content': '', 'status': '考え中...'})}\n\n"
             await asyncio.sleep(0.1)
@@ -2681,13 +3057,50 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
             buffer = ""
             inside_canvas = False
             
+            # Wait for our turn on the model; interactive chats go ahead of agent and background work
+            try:
+                ticket = model_manager.enqueue_generation(str(model_path), INTERACTIVE, current_user['id'])
+            except QueueFull:
+                yield f"data: {json.dumps({'error': '現在混み合っています。しばらくしてから再度お試しください。'})}\n\n"
+                return
+            cancel = register_generation(session_id)
+            try:
+                async for position in ticket.wait():
+                    if cancel.is_set():
+                        break
+                    yield f"data: {json.dumps({'status': f'順番待ち中... (あと{position}件)', 'queue_position': position})}\n\n"
+            except BaseException:
+                ticket.release()
+                unregister_generation(session_id, cancel)
+                raise
+            if cancel.is_set():
+                # Stopped while still queued
+                ticket.release()
+                unregister_generation(session_id, cancel)
+                yield f"data: {json.dumps({'session_id': session_id, 'done': True, 'stopped': True})}\n\n"
+                return
+
+            # Canvas mode uses the selected model with the strict system prompt applied above.
+            # The lease keeps this model loaded until the stream ends, even if another
+            # request switches models in the meantime.
+            lease = None
+            token_stream = None
             try:
-                for chunk in llm.create_chat_completion(
+                # Loading a model can take seconds: do it off the event loop
+                lease = await run_in_threadpool(model_manager.llm_lease, str(model_path))
+                llm = lease.model
+                # Tokens are decoded on a generation thread and handed over with backpressure.
+                # Resumes from this session's KV state of the previous turn when the prefix still matches
+                # The stop endpoint sets `cancel`; decoding then ends after the current token, or
+                # after the current prompt batch while the prompt is still being evaluated.
+                token_stream = iterate_in_thread(lambda: session_chat_stream(
+                    llm, str(model_path), session_id,
                     messages=final_messages,
                     max_tokens=2048,
                     temperature=0.7,
-                    stream=True
-                ):
+                    cancel=cancel
+                ), cancel=cancel)
+                async for chunk in token_stream:
                     if 'choices' in chunk and len(chunk['choices']) > 0:
                         delta = chunk['choices'][0].get('delta', {})
                         if 'content' in delta:
@@ -2770,7 +3183,6 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
                                 # Normal Mode
                                 full_response += content
                                 yield f"data: {json.dumps({'content': content})}\n\n"
-                                await asyncio.sleep(0.01)
 
                 # Flush remaining buffer at end of stream
                 if request.canvas_mode and buffer:
@@ -2780,30 +3192,33 @@ async def chat_stream(request: ChatRequest, background_tasks: BackgroundTasks, c
             except Exception as e:
                 logger.error(f"Streaming Error: {e}")
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
-            
-            logger.info(f"Generation complete. Response length: {len(full_response)}")
-            
-            # 4. Save & Post-Processing
-            conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-            cursor = conn.cursor()
-            
-            # Update session timestamp
-            cursor.execute('UPDATE chat_sessions SET updated_at = ? WHERE id = ?', 
-                          (datetime.utcnow().isoformat(), session_id))
-                          
-            # Save messages
-            ts = datetime.utcnow().isoformat()
-            # User message already saved
-            cursor.execute('INSERT INTO chat_messages (session_id, role, content, timestamp) VALUES (?, ?, ?, ?)', 
-                          (session_id, 'assistant', full_response, ts))
-                          
-            conn.commit()
-            conn.close()
+            except BaseException:
+                # Client disconnected: the stream task is cancelled, which also stops the
+                # generation thread. Keep what was generated so far.
+                if full_response or buffer:
+                    logger.info(f"Client disconnected; saving partial response ({len(full_response + buffer)} chars)")
+                    save_assistant_message(session_id, full_response + buffer)
+                raise
+            finally:
+                # Closing the stream waits for the generation thread to exit; only then
+                # may the next ticket holder use this model
+                if token_stream is not None:
+                    await token_stream.aclose()
+                if lease:
+                    lease.release()
+                ticket.release()
+                unregister_generation(session_id, cancel)
+            
+            stopped = cancel.is_set()
+            logger.info(f"Generation {'stopped' if stopped else 'complete'}. Response length: {len(full_response)}")
+            
+            # 4. Save & Post-Processing (user message already saved)
+            save_assistant_message(session_id, full_response)
             
             # Trigger Background Summarization
             background_tasks.add_task(summarize_old_messages, session_id, model_path)
             
-            yield f"data: {json.dumps({'session_id': session_id, 'title': request.message[:20] if new_session else None, 'done': True})}\n\n"
+            yield f"data: {json.dumps({'session_id': session_id, 'title': request.message[:20] if new_session else None, 'done': True, 'stopped': stopped})}\n\n"
 
         except Exception as e:
             logger.error(f"Streaming Error: {e}")
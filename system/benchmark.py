@@ -0,0 +1,169 @@
+"""Per-model throughput benchmark.
+
+Measures, with fixed synthetic prompts and each model's normal runtime
+parameters: load time, prefill and decode tokens/s and time-to-first-token
+at several prompt lengths for chat models, and embedding throughput for
+embedding models. Each result is stored in users.db together with the
+hardware fingerprint, so numbers from different machines are never mixed.
+
+    python benchmark.py [--model NAME ...]
+
+The admin API starts the same command in the background
+(POST /api/admin/models/benchmark) and lists results
+(GET /api/admin/models/benchmarks).
+"""
+import sys
+import json
+import time
+import sqlite3
+import logging
+import argparse
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+from hardware import probe_hardware, hardware_fingerprint
+from gguf_metadata import model_info, runtime_params
+from model_store import MODELS_DIR, file_sha256, llama_memory_kwargs
+from calibrate import (bench_prefill, bench_decode, bench_embed, sample_tokens, free_model, is_embedding_model,
+                       PREFILL_TOKENS)
+
+logger = logging.getLogger("benchmark")
+
+BASE_DIR = Path(__file__).parent.absolute()
+DB_PATH = BASE_DIR / "users.db"
+
+TTFT_PROMPT_TOKENS = [128, 512, 2048]
+DECODE_TOKENS = 64
+
+
+def init_benchmark_table(conn: sqlite3.Connection):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS model_benchmarks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        model TEXT NOT NULL,
+        sha256 TEXT,
+        workload TEXT,
+        hardware TEXT,
+        hardware_info TEXT,
+        params TEXT,
+        load_seconds REAL,
+        prefill_tokens_per_sec REAL,
+        decode_tokens_per_sec REAL,
+        ttft_seconds TEXT,
+        embed_texts_per_sec REAL,
+        error TEXT,
+        created_at TEXT
+    )
+    ''')
+
+
+def _time_to_first_token(llm, tokens: List[int]) -> float:
+    llm.reset()  # No prefix reuse from the previous prompt
+    start = time.perf_counter()
+    llm.create_completion(tokens, max_tokens=1, temperature=0.0)
+    return time.perf_counter() - start
+
+
+def benchmark_model(path: Path) -> Dict[str, Any]:
+    info = model_info(path)
+    if info is None:
+        raise ValueError("not a readable GGUF file")
+    from llama_cpp import Llama
+    workload = "embed" if is_embedding_model(path, info) else "chat"
+    params = runtime_params(path, workload)
+    if workload == "embed":
+        params.setdefault("n_gpu_layers", 0)
+    result: Dict[str, Any] = {"model": path.name, "workload": workload, "params": params}
+
+    start = time.perf_counter()
+    llm = Llama(model_path=str(path), embedding=workload == "embed", verbose=False,
+                **params, **llama_memory_kwargs(path))
+    result["load_seconds"] = round(time.perf_counter() - start, 3)
+    try:
+        if workload == "embed":
+            result["embed_texts_per_sec"] = round(bench_embed(llm), 2)
+            return result
+        n_ctx = llm.n_ctx()
+        result["prefill_tokens_per_sec"] = round(bench_prefill(llm, sample_tokens(llm, min(PREFILL_TOKENS, n_ctx - 1))), 2)
+        result["decode_tokens_per_sec"] = round(bench_decode(llm, sample_tokens(llm, 128), DECODE_TOKENS), 2)
+        result["ttft_seconds"] = {
+            str(n): round(_time_to_first_token(llm, sample_tokens(llm, n)), 3)
+            for n in TTFT_PROMPT_TOKENS if n < n_ctx - 1
+        }
+        return result
+    finally:
+        free_model(llm)
+
+
+def save_result(result: Dict[str, Any], hardware: Dict[str, Any], db_path: Path = DB_PATH):
+    path = MODELS_DIR / result["model"]
+    try:
+        sha256 = file_sha256(path)
+    except OSError:
+        sha256 = None
+    conn = sqlite3.connect(db_path, timeout=60)
+    try:
+        init_benchmark_table(conn)
+        conn.execute('''
+        INSERT INTO model_benchmarks (model, sha256, workload, hardware, hardware_info, params, load_seconds,
+            prefill_tokens_per_sec, decode_tokens_per_sec, ttft_seconds, embed_texts_per_sec, error, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (result["model"], sha256, result.get("workload"), hardware_fingerprint(hardware), json.dumps(hardware),
+              json.dumps(result.get("params")), result.get("load_seconds"), result.get("prefill_tokens_per_sec"),
+              result.get("decode_tokens_per_sec"), json.dumps(result.get("ttft_seconds")),
+              result.get("embed_texts_per_sec"), result.get("error"), datetime.now().isoformat()))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def latest_results(db_path: Path = DB_PATH, hardware: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Most recent result per model, for this machine unless `hardware` is given."""
+    hardware = hardware or hardware_fingerprint()
+    conn = sqlite3.connect(db_path, timeout=60)
+    conn.row_factory = sqlite3.Row
+    try:
+        init_benchmark_table(conn)
+        rows = conn.execute('''
+        SELECT * FROM model_benchmarks WHERE id IN (
+            SELECT MAX(id) FROM model_benchmarks WHERE hardware = ? GROUP BY model
+        ) ORDER BY model
+        ''', (hardware,)).fetchall()
+    finally:
+        conn.close()
+    results = []
+    for row in rows:
+        r = dict(row)
+        for key in ("hardware_info", "params", "ttft_seconds"):
+            r[key] = json.loads(r[key]) if r[key] else None
+        results.append(r)
+    return results
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark installed models on this machine")
+    parser.add_argument("--model", action="append", help="Model filename in models/ (repeatable)")
+    parser.add_argument("--db", default=str(DB_PATH), help="Database to store results in")
+    args = parser.parse_args(argv)
+
+    hardware = probe_hardware()
+    logger.info(f"Hardware {hardware_fingerprint(hardware)}: {hardware}")
+    paths = [MODELS_DIR / m for m in args.model] if args.model else sorted(MODELS_DIR.glob("*.gguf"))
+    failed = 0
+    for path in paths:
+        logger.info(f"Benchmarking {path.name}...")
+        try:
+            result = benchmark_model(path)
+        except Exception as e:
+            logger.error(f"Benchmark of {path.name} failed: {e}")
+            result = {"model": path.name, "error": str(e)}
+            failed += 1
+        logger.info(json.dumps(result))
+        save_result(result, hardware, Path(args.db))
+    return 1 if paths and failed == len(paths) else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,195 @@
+"""Tune llama.cpp thread and batch settings for this machine.
+
+For every installed model this runs short sweeps and stores the fastest
+settings in the model store manifest:
+- chat models: decode speed over n_threads, then prefill speed over
+  n_threads_batch and (n_batch, n_ubatch);
+- embedding models: embedding throughput over n_threads.
+Every later load of that model on this machine (same hardware fingerprint)
+applies the stored profile through gguf_metadata.runtime_params.
+
+Run it on an otherwise idle box, e.g. after deploying or adding models:
+    python calibrate.py [--model NAME ...] [--quick] [--dry-run]
+"""
+import gc
+import sys
+import time
+import logging
+import argparse
+from pathlib import Path
+from typing import Dict, Any, List, Tuple
+
+from hardware import cpu_counts, numa_nodes, probe_hardware, hardware_fingerprint
+from gguf_metadata import model_info, runtime_params, save_profile
+from model_store import MODELS_DIR, llama_memory_kwargs
+
+logger = logging.getLogger("calibrate")
+
+PREFILL_TOKENS = 1024
+DECODE_TOKENS = 32
+EMBED_TEXTS = 16
+BENCH_CTX = 2048
+BATCH_CANDIDATES = [(128, 128), (256, 256), (512, 512), (1024, 512)]
+EMBEDDING_ARCHITECTURES = {"bert", "nomic-bert", "jina-bert-v2", "nomic-bert-moe"}
+
+SAMPLE_TEXT = ("Quarterly maintenance reports list each site's equipment, open work orders and the "
+               "parts that were replaced, along with notes from the technician on duty. ")
+
+
+def is_embedding_model(path: Path, info: Dict[str, Any]) -> bool:
+    return (info.get("architecture") in EMBEDDING_ARCHITECTURES or info.get("pooling_type") is not None
+            or "embed" in path.name.lower())
+
+
+def thread_candidates() -> List[int]:
+    physical, logical = cpu_counts()
+    per_node = max(1, physical // len(numa_nodes()))
+    candidates = {per_node, max(1, physical // 2), max(1, physical * 3 // 4), physical, logical}
+    return sorted(c for c in candidates if 1 <= c <= logical)
+
+
+def _load(path: Path, kind: str, **overrides):
+    from llama_cpp import Llama
+    params = runtime_params(path, kind)
+    params.update(n_ctx=BENCH_CTX if kind == "chat" else params["n_ctx"], **overrides)
+    params.setdefault("n_gpu_layers", 0 if kind == "embed" else -1)
+    return Llama(model_path=str(path), verbose=False, **params, **llama_memory_kwargs(path))
+
+
+def free_model(llm):
+    close = getattr(llm, "close", None)
+    if close:
+        close()
+    del llm
+    gc.collect()
+
+
+def sample_tokens(llm, n: int) -> List[int]:
+    text = SAMPLE_TEXT * (n // 16 + 1)
+    return llm.tokenize(text.encode("utf-8"))[:n]
+
+
+def _best_of(runs: int, fn) -> float:
+    return max(fn() for _ in range(runs))
+
+
+def bench_prefill(llm, tokens: List[int]) -> float:
+    def run():
+        llm.reset()
+        start = time.perf_counter()
+        llm.eval(tokens)
+        return len(tokens) / (time.perf_counter() - start)
+    return _best_of(2, run)
+
+
+def bench_decode(llm, tokens: List[int], n: int = DECODE_TOKENS) -> float:
+    def run():
+        llm.reset()
+        llm.eval(tokens[:64])
+        start = time.perf_counter()
+        for i in range(n):
+            llm.eval([tokens[64 + i % (len(tokens) - 64)]])
+        return n / (time.perf_counter() - start)
+    return _best_of(2, run)
+
+
+def bench_embed(llm, n: int = EMBED_TEXTS) -> float:
+    texts = [f"search_document: {SAMPLE_TEXT} ({i})" for i in range(n)]
+
+    def run():
+        start = time.perf_counter()
+        llm.create_embedding(texts)
+        return n / (time.perf_counter() - start)
+    return _best_of(2, run)
+
+
+def calibrate_chat(path: Path, quick: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    threads = thread_candidates()
+    sweep = []
+
+    decode = {}
+    for t in threads:
+        llm = _load(path, "chat", n_threads=t, n_threads_batch=t)
+        try:
+            decode[t] = bench_decode(llm, sample_tokens(llm, 128))
+        finally:
+            free_model(llm)
+        sweep.append({"phase": "decode", "n_threads": t, "tokens_per_sec": round(decode[t], 2)})
+        logger.info(f"  decode  n_threads={t:<3} {decode[t]:8.1f} tok/s")
+    n_threads = max(decode, key=decode.get)
+
+    prefill = {}
+    batches = [(512, 512)] if quick else BATCH_CANDIDATES
+    for tb in threads:
+        for n_batch, n_ubatch in batches:
+            llm = _load(path, "chat", n_threads=n_threads, n_threads_batch=tb, n_batch=n_batch, n_ubatch=n_ubatch)
+            try:
+                rate = bench_prefill(llm, sample_tokens(llm, PREFILL_TOKENS))
+            finally:
+                free_model(llm)
+            prefill[(tb, n_batch, n_ubatch)] = rate
+            sweep.append({"phase": "prefill", "n_threads_batch": tb, "n_batch": n_batch, "n_ubatch": n_ubatch,
+                          "tokens_per_sec": round(rate, 2)})
+            logger.info(f"  prefill n_threads_batch={tb:<3} n_batch={n_batch:<5} n_ubatch={n_ubatch:<4} "
+                        f"{rate:8.1f} tok/s")
+    tb, n_batch, n_ubatch = max(prefill, key=prefill.get)
+
+    params = {"n_threads": n_threads, "n_threads_batch": tb, "n_batch": n_batch, "n_ubatch": n_ubatch}
+    measurements = {"decode_tokens_per_sec": round(decode[n_threads], 2),
+                    "prefill_tokens_per_sec": round(prefill[(tb, n_batch, n_ubatch)], 2), "sweep": sweep}
+    return params, measurements
+
+
+def calibrate_embed(path: Path) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    rates, sweep = {}, []
+    for t in thread_candidates():
+        llm = _load(path, "embed", n_threads=t, n_threads_batch=t)
+        try:
+            rates[t] = bench_embed(llm)
+        finally:
+            free_model(llm)
+        sweep.append({"n_threads": t, "texts_per_sec": round(rates[t], 2)})
+        logger.info(f"  embed   n_threads={t:<3} {rates[t]:8.1f} texts/s")
+    best = max(rates, key=rates.get)
+    return {"n_threads": best, "n_threads_batch": best}, {"texts_per_sec": round(rates[best], 2), "sweep": sweep}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Tune llama.cpp thread/batch settings for this machine")
+    parser.add_argument("--model", action="append", help="Model filename in models/ or a path (repeatable)")
+    parser.add_argument("--quick", action="store_true", help="Only sweep thread counts")
+    parser.add_argument("--dry-run", action="store_true", help="Measure and print, but don't save profiles")
+    args = parser.parse_args(argv)
+
+    hardware = probe_hardware()
+    logger.info(f"Hardware {hardware_fingerprint(hardware)}: {hardware}")
+    logger.info(f"Thread candidates: {thread_candidates()}")
+
+    if args.model:
+        paths = [Path(m) if Path(m).exists() else MODELS_DIR / m for m in args.model]
+    else:
+        paths = sorted(MODELS_DIR.glob("*.gguf"))
+    failed = 0
+    for path in paths:
+        info = model_info(path)
+        if info is None:
+            logger.warning(f"Skipping {path.name}: not a readable GGUF file")
+            failed += 1
+            continue
+        workload = "embed" if is_embedding_model(path, info) else "chat"
+        logger.info(f"Calibrating {path.name} ({info['architecture']}, {info['quantization']}) for {workload}...")
+        try:
+            params, measurements = calibrate_embed(path) if workload == "embed" else calibrate_chat(path, args.quick)
+        except Exception as e:
+            logger.error(f"Calibration of {path.name} failed: {e}")
+            failed += 1
+            continue
+        logger.info(f"Best for {path.name}: {params}")
+        if not args.dry_run:
+            save_profile(path, workload, params, measurements)
+    return 1 if failed and failed == len(paths) else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
@@ -0,0 +1,203 @@
+import os
+import logging
+import threading
+import time
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+logger = logging.getLogger("chroma-writer")
+
+# Chroma 0.4 persists to SQLite (bounded by the max bound-variable count) and
+# folds new vectors into HNSW in hnsw:batch_size (100) steps, syncing the index
+# to disk every hnsw:sync_threshold (1000) items. A few hundred rows per call
+# keeps each write a single SQLite transaction and a whole number of HNSW
+# batches without crossing a sync on every flush.
+DEFAULT_UPSERT_BATCH = int(os.environ.get("CHROMA_UPSERT_BATCH", "500"))
+DEFAULT_UPSERT_BYTES = int(os.environ.get("CHROMA_UPSERT_BYTES", str(16 * 1024 * 1024)))
+DEFAULT_DELETE_BATCH = 100
+DEFAULT_FLUSH_INTERVAL = float(os.environ.get("CHROMA_FLUSH_INTERVAL", "5.0"))
+
+
+class ChromaWriter:
+    """Single writer stage for a Chroma collection.
+
+    Embedded chunks are accumulated and written with large `upsert` calls,
+    flushed when the batch reaches a row count or byte size, when the oldest
+    pending item is older than `flush_interval`, and on close. Deletes are
+    grouped by metadata field into `$in` filters.
+
+    Writes to the same key keep their order: a delete for a key that still has
+    pending upserts first flushes those upserts.
+
+    With `track_results`, the ids of upserts that reached the collection and of
+    those whose batch failed are kept until `take_results` collects them, so
+    callers can record state only for chunks that were actually stored.
+    """
+
+    def __init__(self, collection, max_batch: int = DEFAULT_UPSERT_BATCH, max_bytes: int = DEFAULT_UPSERT_BYTES,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, log: Optional[Callable[[str], None]] = None,
+                 track_results: bool = False):
+        self.collection = collection
+        client_limit = getattr(getattr(collection, "_client", None), "max_batch_size", None)
+        self.max_batch = min(max_batch, client_limit) if client_limit else max_batch
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.log = log or logger.info
+
+        self._cond = threading.Condition()
+        self._ids: List[str] = []
+        self._docs: List[str] = []
+        self._metas: List[Dict[str, Any]] = []
+        self._embeds: List[List[float]] = []
+        self._bytes = 0
+        self._deletes: Dict[str, List[Any]] = {}
+        self._oldest: Optional[float] = None
+        self._flush_requested = False
+        self._closing = False
+        self._generation = 0  # incremented after each completed write round
+        self._writing = False
+
+        self.upserted = 0
+        self.deleted_batches = 0
+        self.track_results = track_results
+        self._written_ids: List[str] = []
+        self._failed_ids: List[str] = []
+
+        self._thread = threading.Thread(target=self._run, name="chroma-writer", daemon=True)
+        self._thread.start()
+
+    # --- Producer API ---
+
+    def upsert(self, chunk_id: str, document: str, metadata: Dict[str, Any], embedding: List[float]):
+        size = len(document.encode("utf-8", errors="ignore")) + 4 * len(embedding) + 256
+        with self._cond:
+            self._ids.append(chunk_id)
+            self._docs.append(document)
+            self._metas.append(metadata)
+            self._embeds.append(embedding)
+            self._bytes += size
+            if self._oldest is None:
+                # Wake the writer so it starts the deadline clock
+                self._oldest = time.monotonic()
+                self._cond.notify_all()
+            elif len(self._ids) >= self.max_batch or self._bytes >= self.max_bytes:
+                self._cond.notify_all()
+
+    def delete(self, field: str, value: Any):
+        with self._cond:
+            has_pending = any(m.get(field) == value for m in self._metas)
+        if has_pending:
+            self.flush()
+        with self._cond:
+            self._deletes.setdefault(field, []).append(value)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify_all()
+            elif len(self._deletes[field]) >= DEFAULT_DELETE_BATCH:
+                self._cond.notify_all()
+
+    def update_metadata(self, ids: List[str], metadatas: List[Dict[str, Any]]):
+        """Apply a metadata update after everything queued so far is written."""
+        self.flush()
+        try:
+            self.collection.update(ids=ids, metadatas=metadatas)
+        except Exception as e:
+            self.log(f"Error updating metadata in Chroma: {e}")
+
+    def flush(self):
+        """Block until everything queued before this call has been written."""
+        with self._cond:
+            if not self._ids and not self._deletes:
+                return
+            # A round already in flight does not contain the items queued since
+            target = self._generation + (2 if self._writing else 1)
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._generation < target and self._thread.is_alive():
+                self._cond.wait(timeout=1.0)
+
+    def take_results(self) -> Tuple[List[str], List[str]]:
+        """Ids written and ids whose upsert failed since the last call (needs track_results)."""
+        with self._cond:
+            written, failed = self._written_ids, self._failed_ids
+            self._written_ids, self._failed_ids = [], []
+        return written, failed
+
+    def close(self):
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # --- Writer thread ---
+
+    def _due(self) -> bool:
+        if self._flush_requested or self._closing:
+            return True
+        if len(self._ids) >= self.max_batch or self._bytes >= self.max_bytes:
+            return True
+        if any(len(v) >= DEFAULT_DELETE_BATCH for v in self._deletes.values()):
+            return True
+        return self._oldest is not None and time.monotonic() - self._oldest >= self.flush_interval
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    timeout = None
+                    if self._oldest is not None:
+                        timeout = max(0.05, self.flush_interval - (time.monotonic() - self._oldest))
+                    self._cond.wait(timeout=timeout)
+
+                ids, docs, metas, embeds = self._ids, self._docs, self._metas, self._embeds
+                deletes = self._deletes
+                self._ids, self._docs, self._metas, self._embeds = [], [], [], []
+                self._deletes = {}
+                self._bytes = 0
+                self._oldest = None
+                self._flush_requested = False
+                closing = self._closing
+                self._writing = True
+
+            self._write(ids, docs, metas, embeds, deletes)
+
+            with self._cond:
+                self._generation += 1
+                self._writing = False
+                self._cond.notify_all()
+                if closing and not self._ids and not self._deletes:
+                    return
+
+    def _write(self, ids, docs, metas, embeds, deletes):
+        # Deletes first: any upsert queued before a delete on the same key was already flushed
+        for field, values in deletes.items():
+            for i in range(0, len(values), DEFAULT_DELETE_BATCH):
+                batch = values[i:i + DEFAULT_DELETE_BATCH]
+                try:
+                    self.collection.delete(where={field: {"$in": batch}})
+                    self.deleted_batches += 1
+                except Exception as e:
+                    self.log(f"Error deleting {len(batch)} entries from Chroma: {e}")
+
+        for i in range(0, len(ids), self.max_batch):
+            batch = ids[i:i + self.max_batch]
+            try:
+                self.collection.upsert(
+                    ids=batch,
+                    documents=docs[i:i + self.max_batch],
+                    metadatas=metas[i:i + self.max_batch],
+                    embeddings=embeds[i:i + self.max_batch]
+                )
+                self.upserted += len(batch)
+                ok = True
+            except Exception as e:
+                self.log(f"Error upserting batch to Chroma: {e}")
+                ok = False
+            if self.track_results:
+                with self._cond:
+                    (self._written_ids if ok else self._failed_ids).extend(batch)
@@ -0,0 +1,319 @@
+"""Shared embedding service.
+
+One long-lived process keeps the embedding model loaded and serves both the
+backend and the indexer over a Unix socket (HTTP + JSON). Requests from all
+callers go into one queue: query embeddings are always served before bulk
+indexing work, and bulk requests are processed in small slices so a query
+waits for at most one slice.
+
+Run standalone with `python embedding_service.py [model_path]`; the backend
+starts it on startup unless EMBED_SERVICE=0.
+"""
+import os
+import sys
+import json
+import heapq
+import time
+import socket
+import logging
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+from model_store import canonical_model_path, llama_memory_kwargs
+from gguf_metadata import runtime_params, embedding_dim
+
+logger = logging.getLogger("embedding-service")
+
+BASE_DIR = Path(__file__).parent.absolute()
+SOCKET_PATH = os.environ.get("EMBED_SERVICE_SOCKET", str(BASE_DIR / "run" / "embed.sock"))
+DEFAULT_MODEL_PATH = BASE_DIR / "models" / "nomic-embed-text-v1.5.f16.gguf"
+SLICE_SIZE = int(os.environ.get("EMBED_SLICE_SIZE", "8"))
+# How long a connect check of the socket is trusted
+AVAILABILITY_TTL_SECONDS = 1.0
+
+PRIORITIES = {"query": 0, "bulk": 1}
+
+
+class EmbeddingServiceError(Exception):
+    pass
+
+
+# --- Server ---
+
+class _Job:
+    def __init__(self, model_path: str, texts: List[str], priority: int):
+        self.model_path = model_path
+        self.texts = texts
+        self.priority = priority
+        self.results: List[Optional[List[float]]] = [None] * len(texts)
+        self.next = 0        # first text not yet handed to the worker
+        self.remaining = len(texts)
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+
+class EmbeddingWorker:
+    """Single inference thread fed by a priority queue of embedding jobs.
+
+    Each round takes up to `slice_size` texts from the highest-priority jobs
+    for one model, across callers, and embeds them in one call. Unfinished
+    jobs go back into the queue in their original order.
+    """
+
+    def __init__(self, slice_size: int = SLICE_SIZE):
+        self.slice_size = slice_size
+        self.models: Dict[str, Any] = {}
+        self._cond = threading.Condition()
+        self._heap: List[tuple] = []
+        self._seq = 0
+        self._thread = threading.Thread(target=self._run, name="embed-worker", daemon=True)
+        self._thread.start()
+
+    def queued(self) -> int:
+        with self._cond:
+            return sum(job.remaining for _, _, job in self._heap)
+
+    def embed(self, model_path: str, texts: List[str], priority: str = "query") -> List[List[float]]:
+        if not texts:
+            return []
+        job = _Job(canonical_model_path(model_path), texts, PRIORITIES.get(priority, PRIORITIES["bulk"]))
+        with self._cond:
+            self._push(job)
+            self._cond.notify()
+        job.done.wait()
+        if job.error:
+            raise EmbeddingServiceError(job.error)
+        return job.results
+
+    def get_model(self, model_path: str):
+        model = self.models.get(model_path)
+        if model is None:
+            from llama_cpp import Llama
+            logger.info(f"Loading Embedding Model: {model_path}")
+            model = Llama(
+                model_path=model_path,
+                embedding=True,
+                n_gpu_layers=0,  # Keep VRAM for chat models
+                verbose=False,
+                **runtime_params(model_path, "embed"),
+                **llama_memory_kwargs(model_path)
+            )
+            self.models[model_path] = model
+        return model
+
+    def _push(self, job: _Job):
+        self._seq += 1
+        heapq.heappush(self._heap, (job.priority, self._seq, job))
+
+    def _take(self) -> List[tuple]:
+        """Pop one slice: [(job, start, end)] for a single priority and model."""
+        with self._cond:
+            while not self._heap:
+                self._cond.wait()
+            parts = []
+            requeue = []
+            budget = self.slice_size
+            head = self._heap[0][2]
+            while self._heap and budget > 0:
+                priority, seq, job = self._heap[0]
+                if priority != head.priority or job.model_path != head.model_path:
+                    break
+                heapq.heappop(self._heap)
+                end = min(len(job.texts), job.next + budget)
+                parts.append((job, job.next, end))
+                budget -= end - job.next
+                job.next = end
+                if job.next < len(job.texts):
+                    requeue.append((priority, seq, job))
+            for entry in requeue:
+                heapq.heappush(self._heap, entry)
+            return parts
+
+    def _run(self):
+        while True:
+            parts = self._take()
+            texts = [t for job, start, end in parts for t in job.texts[start:end]]
+            try:
+                vectors = self._embed(self.get_model(parts[0][0].model_path), texts, parts[0][0].model_path)
+                error = None
+            except Exception as e:
+                logger.error(f"Embedding batch failed: {e}")
+                vectors, error = None, str(e)
+
+            offset = 0
+            for job, start, end in parts:
+                if error:
+                    job.error = error
+                else:
+                    job.results[start:end] = vectors[offset:offset + end - start]
+                offset += end - start
+                job.remaining -= end - start
+                if job.remaining <= 0 or job.error:
+                    job.done.set()
+
+    def _embed(self, llm, texts: List[str], model_path: str) -> List[List[float]]:
+        try:
+            data = llm.create_embedding(texts)['data']
+            return [d['embedding'] for d in sorted(data, key=lambda d: d['index'])]
+        except Exception as e:
+            logger.warning(f"Batched embedding failed ({e}), embedding texts one by one")
+        vectors = []
+        for i, text in enumerate(texts):
+            try:
+                vectors.append(llm.create_embedding(text)['data'][0]['embedding'])
+            except Exception as e:
+                logger.error(f"Failed to create embedding for text {i}: {e}")
+                vectors.append([0.0] * embedding_dim(model_path))
+        return vectors
+
+
+class _Handler(BaseHTTPRequestHandler):
+    worker: EmbeddingWorker = None
+
+    def address_string(self):
+        return "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, code: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send(200, {"status": "ok", "models": list(self.worker.models), "queued": self.worker.queued()})
+        else:
+            self._send(404, {"detail": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/embed":
+            self._send(404, {"detail": "Not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            req = json.loads(self.rfile.read(length))
+            embeddings = self.worker.embed(req["model_path"], req["texts"], req.get("priority", "query"))
+            self._send(200, {"embeddings": embeddings})
+        except (KeyError, ValueError) as e:
+            self._send(400, {"detail": f"Invalid request: {e}"})
+        except EmbeddingServiceError as e:
+            self._send(500, {"detail": str(e)})
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _socket_live(socket_path: str) -> bool:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1.0)
+    try:
+        sock.connect(socket_path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def serve(socket_path: str = SOCKET_PATH, model_path: Optional[str] = None):
+    Path(socket_path).parent.mkdir(parents=True, exist_ok=True)
+    if os.path.exists(socket_path):
+        if _socket_live(socket_path):
+            raise SystemExit(f"An embedding service is already listening on {socket_path}")
+        # Left by a service that crashed; remove it now so clients don't wait on it during warm-up
+        logger.info(f"Removing stale socket {socket_path}")
+        os.unlink(socket_path)
+
+    worker = EmbeddingWorker()
+    model_path = model_path or str(DEFAULT_MODEL_PATH)
+    if os.path.exists(model_path):
+        # Load and run one embedding so the first real request doesn't pay for it
+        worker.embed(model_path, ["search_query: warm-up"])
+        logger.info(f"Embedding model warm: {model_path}")
+    else:
+        logger.warning(f"Default embedding model not found: {model_path}")
+
+    _Handler.worker = worker
+    server = _Server(socket_path, _Handler)
+    os.chmod(socket_path, 0o600)
+    logger.info(f"Embedding service listening on {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+# --- Client ---
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+_availability: Dict[str, tuple] = {}  # socket path -> (checked at, accepted a connection)
+_availability_lock = threading.Lock()
+
+
+class EmbeddingClient:
+    """Client for the shared embedding service.
+
+    `priority` is "query" for interactive lookups and "bulk" for indexing.
+    """
+
+    def __init__(self, priority: str = "query", socket_path: str = SOCKET_PATH, timeout: float = 600.0):
+        self.priority = priority
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def available(self) -> bool:
+        """Whether the service accepts connections (a crashed service can leave its socket file behind)."""
+        now = time.monotonic()
+        with _availability_lock:
+            checked = _availability.get(self.socket_path)
+            if checked and now - checked[0] < AVAILABILITY_TTL_SECONDS:
+                return checked[1]
+        live = os.path.exists(self.socket_path) and _socket_live(self.socket_path)
+        with _availability_lock:
+            _availability[self.socket_path] = (now, live)
+        return live
+
+    def embed(self, model_path: str, texts: List[str]) -> List[List[float]]:
+        body = json.dumps({"model_path": str(model_path), "texts": texts, "priority": self.priority})
+        conn = _UnixHTTPConnection(self.socket_path, self.timeout)
+        try:
+            conn.request("POST", "/embed", body=body, headers={"Content-Type": "application/json"})
+            resp = conn.getresponse()
+            payload = json.loads(resp.read() or b"{}")
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            with _availability_lock:
+                _availability.pop(self.socket_path, None)
+            raise EmbeddingServiceError(f"Embedding service unreachable: {e}")
+        finally:
+            conn.close()
+        if resp.status != 200:
+            raise EmbeddingServiceError(payload.get("detail", f"HTTP {resp.status}"))
+        return payload["embeddings"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    serve(model_path=sys.argv[1] if len(sys.argv) > 1 else None)
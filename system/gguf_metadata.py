@@ -0,0 +1,351 @@
+"""GGUF header metadata and the runtime parameters derived from it.
+
+`read_gguf_header` parses the key/value section and tensor table of a GGUF
+file without loading any weights. `model_info` keeps the useful parts
+(architecture, parameter count, quantisation, trained context length,
+embedding length, KV-cache cost per token) per file in memory, and by sha256
+in the model store manifest when the store already knows the file's hash.
+Parsing a header takes milliseconds; hashing a model takes minutes, so it
+never hashes.
+`runtime_params` turns that into context size, batch size, thread counts and
+GPU offload for a load, within a memory budget. Thread and batch settings
+measured by `python calibrate.py` on this machine take precedence.
+"""
+import os
+import json
+import hashlib
+import time
+import struct
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional, Union
+
+from model_store import MANIFEST_DB, file_sha256, known_sha256
+from hardware import cpu_counts, hardware_fingerprint
+from lazy_import import lazy, available
+
+psutil = lazy("psutil") if available("psutil") else None
+
+logger = logging.getLogger("gguf-metadata")
+
+# Upper bounds for automatic sizing; the trained context is used when smaller
+MODEL_MAX_CTX = int(os.environ.get("MODEL_MAX_CTX", "8192"))
+EMBED_MAX_CTX = int(os.environ.get("EMBED_MAX_CTX", "2048"))
+MODEL_MIN_CTX = 512
+# Models at least this large run on CPU to avoid VRAM OOM on limited GPUs
+GPU_MAX_PARAMS = float(os.environ.get("GPU_MAX_PARAMS_B", "6.5")) * 1e9
+DEFAULT_EMBED_DIM = 768  # nomic-embed-text-v1.5, when a header can't be read
+COMPUTE_OVERHEAD_BYTES = 64 * 1024 * 1024
+
+GGUF_MAGIC = b"GGUF"
+
+# GGUF value types -> struct format (8 = string, 9 = array)
+_SCALARS = {0: "<B", 1: "<b", 2: "<H", 3: "<h", 4: "<I", 5: "<i", 6: "<f", 7: "<?", 10: "<Q", 11: "<q", 12: "<d"}
+_STRING, _ARRAY = 8, 9
+# Arrays longer than this (vocabularies, merges) are skipped, only their length is kept
+_MAX_ARRAY_ITEMS = 64
+# ...except that these get a digest too, to tell tokenizers with the same vocabulary size apart
+_DIGEST_ARRAYS = {"tokenizer.ggml.tokens"}
+
+# llama_ftype (general.file_type)
+FILE_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 7: "Q8_0", 8: "Q5_0", 9: "Q5_1", 10: "Q2_K",
+    11: "Q3_K_S", 12: "Q3_K_M", 13: "Q3_K_L", 14: "Q4_K_S", 15: "Q4_K_M", 16: "Q5_K_S", 17: "Q5_K_M",
+    18: "Q6_K", 19: "IQ2_XXS", 20: "IQ2_XS", 21: "Q2_K_S", 22: "IQ3_XS", 23: "IQ3_XXS", 24: "IQ1_S",
+    25: "IQ4_NL", 26: "IQ3_S", 27: "IQ3_M", 28: "IQ2_S", 29: "IQ2_M", 30: "IQ4_XS", 31: "IQ1_M", 32: "BF16"
+}
+# ggml_type of individual tensors, used when general.file_type is missing
+TENSOR_TYPES = {
+    0: "F32", 1: "F16", 2: "Q4_0", 3: "Q4_1", 6: "Q5_0", 7: "Q5_1", 8: "Q8_0", 9: "Q8_1", 10: "Q2_K",
+    11: "Q3_K", 12: "Q4_K", 13: "Q5_K", 14: "Q6_K", 15: "Q8_K", 30: "BF16"
+}
+
+
+class GGUFError(Exception):
+    pass
+
+
+def _read(f, fmt: str):
+    size = struct.calcsize(fmt)
+    data = f.read(size)
+    if len(data) != size:
+        raise GGUFError("Truncated GGUF header")
+    return struct.unpack(fmt, data)[0]
+
+
+def _read_string(f) -> str:
+    length = _read(f, "<Q")
+    return f.read(length).decode("utf-8", errors="replace")
+
+
+def _read_value(f, vtype: int, digest: bool = False):
+    if vtype in _SCALARS:
+        return _read(f, _SCALARS[vtype])
+    if vtype == _STRING:
+        return _read_string(f)
+    if vtype == _ARRAY:
+        item_type = _read(f, "<I")
+        count = _read(f, "<Q")
+        if count > _MAX_ARRAY_ITEMS:
+            h = hashlib.sha1() if digest else None
+            if item_type in _SCALARS and not h:
+                f.seek(count * struct.calcsize(_SCALARS[item_type]), os.SEEK_CUR)
+            else:
+                for _ in range(count):
+                    item = _read_value(f, item_type)
+                    if h:
+                        h.update(repr(item).encode("utf-8", "surrogatepass"))
+            return {"length": count, "sha1": h.hexdigest()} if h else {"length": count}
+        return [_read_value(f, item_type) for _ in range(count)]
+    raise GGUFError(f"Unknown GGUF value type {vtype}")
+
+
+def read_gguf_header(path: Union[str, Path]) -> Dict[str, Any]:
+    """Returns {"version", "metadata": {key: value}, "tensors": [(name, shape, ggml_type)]}."""
+    with open(path, "rb") as f:
+        if f.read(4) != GGUF_MAGIC:
+            raise GGUFError(f"Not a GGUF file: {path}")
+        version = _read(f, "<I")
+        if version < 2:
+            raise GGUFError(f"Unsupported GGUF version {version}")
+        tensor_count = _read(f, "<Q")
+        kv_count = _read(f, "<Q")
+        metadata = {}
+        for _ in range(kv_count):
+            key = _read_string(f)
+            metadata[key] = _read_value(f, _read(f, "<I"), digest=key in _DIGEST_ARRAYS)
+        tensors = []
+        for _ in range(tensor_count):
+            name = _read_string(f)
+            n_dims = _read(f, "<I")
+            shape = [_read(f, "<Q") for _ in range(n_dims)]
+            ggml_type = _read(f, "<I")
+            _read(f, "<Q")  # data offset
+            tensors.append((name, shape, ggml_type))
+    return {"version": version, "metadata": metadata, "tensors": tensors}
+
+
+def summarize_header(header: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields the runtime needs from a parsed header."""
+    meta = header["metadata"]
+    arch = meta.get("general.architecture", "unknown")
+
+    def arch_key(name, default=None):
+        return meta.get(f"{arch}.{name}", default)
+
+    parameters = 0
+    type_bytes: Dict[str, int] = {}
+    for _, shape, ggml_type in header["tensors"]:
+        n = 1
+        for d in shape:
+            n *= d
+        parameters += n
+        type_name = TENSOR_TYPES.get(ggml_type, str(ggml_type))
+        type_bytes[type_name] = type_bytes.get(type_name, 0) + n
+    quantization = FILE_TYPES.get(meta.get("general.file_type"))
+    if quantization is None and type_bytes:
+        quantization = max(type_bytes, key=type_bytes.get)
+
+    n_layer = arch_key("block_count", 0)
+    n_embd = arch_key("embedding_length", 0)
+    n_head = arch_key("attention.head_count", 0)
+    n_head_kv = arch_key("attention.head_count_kv", n_head)
+    if isinstance(n_head_kv, list):  # Per-layer head counts
+        n_head_kv = max(n_head_kv)
+    if isinstance(n_head, list):
+        n_head = max(n_head)
+    head_dim = n_embd // n_head if n_head else 0
+    k_len = arch_key("attention.key_length", head_dim)
+    v_len = arch_key("attention.value_length", head_dim)
+    # f16 K and V for every layer
+    kv_bytes_per_token = n_layer * n_head_kv * (k_len + v_len) * 2
+
+    tokens = meta.get("tokenizer.ggml.tokens")
+    vocab_size = tokens["length"] if isinstance(tokens, dict) else len(tokens or [])
+    if isinstance(tokens, dict):
+        vocab_hash = tokens.get("sha1")
+    else:
+        vocab_hash = hashlib.sha1("".join(repr(t) for t in tokens).encode("utf-8", "surrogatepass")).hexdigest() if tokens else None
+
+    return {
+        "name": meta.get("general.name"),
+        "architecture": arch,
+        "parameters": parameters,
+        "quantization": quantization,
+        "context_length": arch_key("context_length", 0),
+        "embedding_length": n_embd,
+        "block_count": n_layer,
+        "kv_bytes_per_token": kv_bytes_per_token,
+        "pooling_type": arch_key("pooling_type"),
+        "vocab_size": vocab_size,
+        # Same tokenizer model, pre-tokenizer and token list: same tokenization
+        "tokenizer": [meta.get("tokenizer.ggml.model"), meta.get("tokenizer.ggml.pre"), vocab_hash] if vocab_hash else None,
+    }
+
+
+# --- Cache ---
+
+_memo: Dict[tuple, Optional[Dict[str, Any]]] = {}
+_memo_lock = threading.Lock()
+
+
+def _db() -> sqlite3.Connection:
+    MANIFEST_DB.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(MANIFEST_DB, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS gguf_metadata (sha256 TEXT PRIMARY KEY, info TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS runtime_profiles (sha256 TEXT, workload TEXT, hardware TEXT, "
+                 "params TEXT, measurements TEXT, updated_at REAL, PRIMARY KEY (sha256, workload, hardware))")
+    return conn
+
+
+def model_info(model_path: Union[str, Path]) -> Optional[Dict[str, Any]]:
+    """Header summary for a model file, or None if it can't be read as GGUF."""
+    path = os.path.realpath(str(model_path))
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_size, st.st_mtime_ns)
+    with _memo_lock:
+        if key in _memo:
+            return _memo[key]
+    info = None
+    try:
+        sha256 = known_sha256(path)
+        if sha256:
+            conn = _db()
+            try:
+                row = conn.execute("SELECT info FROM gguf_metadata WHERE sha256 = ?", (sha256,)).fetchone()
+                if row:
+                    info = json.loads(row[0])
+                # Summaries stored before the tokenizer digest existed are parsed again
+                if not info or "tokenizer" not in info:
+                    info = summarize_header(read_gguf_header(path))
+                    conn.execute("INSERT OR REPLACE INTO gguf_metadata (sha256, info) VALUES (?, ?)",
+                                 (sha256, json.dumps(info)))
+                    conn.commit()
+            finally:
+                conn.close()
+        else:
+            info = summarize_header(read_gguf_header(path))
+    except (OSError, GGUFError, sqlite3.Error, UnicodeDecodeError) as e:
+        logger.warning(f"Could not read GGUF metadata of {path}: {e}")
+    with _memo_lock:
+        _memo[key] = info
+    return info
+
+
+def embedding_dim(model_path: Union[str, Path]) -> int:
+    """Vector size of an embedding model, for zero-vector fallbacks."""
+    info = model_info(model_path)
+    return (info or {}).get("embedding_length") or DEFAULT_EMBED_DIM
+
+
+# --- Sizing ---
+
+def default_memory_budget() -> int:
+    if psutil:
+        return int(psutil.virtual_memory().total * 0.6)
+    return 8 * 1024 * 1024 * 1024
+
+
+def kv_bytes_per_token(model_path: Union[str, Path], default: int) -> int:
+    info = model_info(model_path)
+    return (info or {}).get("kv_bytes_per_token") or default
+
+
+def runtime_params(model_path: Union[str, Path], kind: str = "chat",
+                   budget_bytes: Optional[int] = None) -> Dict[str, Any]:
+    """Llama(...) sizing arguments for `kind` "chat" or "embed".
+
+    The context is the trained context capped by MODEL_MAX_CTX/EMBED_MAX_CTX,
+    halved until weights plus KV cache fit `budget_bytes`. Unreadable files
+    get the previous fixed defaults.
+    """
+    physical, logical = cpu_counts()
+    params = {"n_threads": physical, "n_threads_batch": logical}
+    info = model_info(model_path)
+    cap = EMBED_MAX_CTX if kind == "embed" else MODEL_MAX_CTX
+    if not info:
+        params.update(n_ctx=2048, n_batch=64 if kind == "chat" else 512)
+        params.update(load_profile(model_path, kind))
+        return params
+
+    n_ctx = min(info["context_length"] or cap, cap)
+    budget = budget_bytes or default_memory_budget()
+    weights = os.path.getsize(model_path)
+    kv = info["kv_bytes_per_token"]
+    while n_ctx > MODEL_MIN_CTX and weights + n_ctx * kv + COMPUTE_OVERHEAD_BYTES > budget:
+        n_ctx //= 2
+    n_ctx = max(n_ctx, MODEL_MIN_CTX)
+    params["n_ctx"] = n_ctx
+    if kind == "embed":
+        # Non-causal embedding models need the whole input in one micro-batch
+        params.update(n_batch=n_ctx, n_ubatch=n_ctx)
+    else:
+        params["n_batch"] = min(512, n_ctx)
+    if kind == "chat" and info["parameters"] >= GPU_MAX_PARAMS:
+        params["n_gpu_layers"] = 0
+    profile = load_profile(model_path, kind)
+    if kind == "chat" and "n_batch" in profile:
+        profile["n_batch"] = min(profile["n_batch"], n_ctx)
+        profile["n_ubatch"] = min(profile.get("n_ubatch", profile["n_batch"]), profile["n_batch"])
+    params.update(profile)
+    return params
+
+
+# --- Tuned profiles ---
+
+_fingerprint = None
+_profiles: Dict[tuple, Dict[str, Any]] = {}
+
+
+def _hardware() -> str:
+    global _fingerprint
+    if _fingerprint is None:
+        _fingerprint = hardware_fingerprint()
+    return _fingerprint
+
+
+def save_profile(model_path: Union[str, Path], workload: str, params: Dict[str, Any],
+                 measurements: Optional[Dict[str, Any]] = None):
+    """Persist tuned runtime parameters for a model and workload on this machine."""
+    sha256 = file_sha256(model_path)
+    conn = _db()
+    try:
+        conn.execute("INSERT OR REPLACE INTO runtime_profiles (sha256, workload, hardware, params, measurements, "
+                     "updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                     (sha256, workload, _hardware(), json.dumps(params), json.dumps(measurements or {}), time.time()))
+        conn.commit()
+    finally:
+        conn.close()
+    with _memo_lock:
+        _profiles.pop((sha256, workload), None)
+
+
+def load_profile(model_path: Union[str, Path], workload: str) -> Dict[str, Any]:
+    """Tuned parameters for this model, workload and machine ({} if never calibrated)."""
+    # Calibrating hashes the file, so a profile can only exist for a file the store knows
+    sha256 = known_sha256(model_path)
+    if not sha256:
+        return {}
+    with _memo_lock:
+        if (sha256, workload) in _profiles:
+            return dict(_profiles[(sha256, workload)])
+    profile = {}
+    try:
+        conn = _db()
+        try:
+            row = conn.execute("SELECT params FROM runtime_profiles WHERE sha256 = ? AND workload = ? AND hardware = ?",
+                               (sha256, workload, _hardware())).fetchone()
+        finally:
+            conn.close()
+        if row:
+            profile = json.loads(row[0])
+    except sqlite3.Error as e:
+        logger.warning(f"Could not read runtime profile: {e}")
+    with _memo_lock:
+        _profiles[(sha256, workload)] = profile
+    return dict(profile)
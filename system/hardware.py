@@ -0,0 +1,94 @@
+"""What the machine we run on looks like: cores, NUMA layout, memory.
+
+`hardware_fingerprint` identifies the box so that tuned runtime profiles and
+benchmark results measured on one machine are never applied to another.
+"""
+import os
+import json
+import glob
+import hashlib
+import platform
+from typing import Dict, Any, List, Tuple
+
+from lazy_import import lazy, available
+
+psutil = lazy("psutil") if available("psutil") else None
+
+
+def cpu_counts() -> Tuple[int, int]:
+    """(physical cores, logical CPUs) available to this process."""
+    try:
+        logical = len(os.sched_getaffinity(0))
+    except AttributeError:
+        logical = os.cpu_count() or 1
+    physical = psutil.cpu_count(logical=False) if psutil else None
+    physical = min(physical or max(1, logical // 2), logical)
+    return physical, logical
+
+
+def _parse_cpulist(text: str) -> List[int]:
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            lo, hi = part.split("-")
+            cpus.extend(range(int(lo), int(hi) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_nodes() -> List[List[int]]:
+    """CPUs of each NUMA node (one node on non-NUMA or non-Linux systems)."""
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        try:
+            with open(path) as f:
+                cpus = _parse_cpulist(f.read())
+        except OSError:
+            continue
+        if cpus:
+            nodes.append(cpus)
+    return nodes or [list(range(os.cpu_count() or 1))]
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def cpu_flags() -> List[str]:
+    """SIMD extensions llama.cpp's CPU kernels care about."""
+    wanted = {"avx", "avx2", "avx512f", "avx512_vnni", "avx_vnni", "fma", "f16c", "amx_int8", "neon", "asimd"}
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return sorted(wanted & set(line.split(":", 1)[1].split()))
+    except OSError:
+        pass
+    return []
+
+
+def probe_hardware() -> Dict[str, Any]:
+    physical, logical = cpu_counts()
+    memory = psutil.virtual_memory().total if psutil else 0
+    return {
+        "cpu_model": cpu_model(),
+        "physical_cores": physical,
+        "logical_cpus": logical,
+        "numa_nodes": len(numa_nodes()),
+        "cpu_flags": cpu_flags(),
+        "memory_gb": round(memory / 1024 ** 3),
+        "machine": platform.machine()
+    }
+
+
+def hardware_fingerprint(hardware: Dict[str, Any] = None) -> str:
+    hardware = hardware or probe_hardware()
+    return hashlib.sha256(json.dumps(hardware, sort_keys=True).encode()).hexdigest()[:16]
@@ -0,0 +1,178 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, time as dtime
+from typing import Optional, Callable, Dict, Any, Set
+
+import index_state
+
+logger = logging.getLogger("index-scheduler")
+
+TICK_SECONDS = 30
+
+
+def parse_days(spec: str) -> Set[int]:
+    """Parse a cron day-of-week field ("*", "1-5", "0,6", "*/2"); 0 and 7 are Sunday."""
+    spec = (spec or "*").strip()
+    days: Set[int] = set()
+    for part in spec.split(","):
+        part = part.strip()
+        step = 1
+        if "/" in part:
+            part, step_str = part.split("/", 1)
+            step = int(step_str)
+        if part in ("*", ""):
+            lo, hi = 0, 6
+        elif "-" in part:
+            lo_str, hi_str = part.split("-", 1)
+            lo, hi = int(lo_str), int(hi_str)
+        else:
+            lo = hi = int(part)
+        if not (0 <= lo <= 7 and 0 <= hi <= 7 and lo <= hi and step > 0):
+            raise ValueError(f"Invalid day-of-week field: {spec}")
+        days.update(d % 7 for d in range(lo, hi + 1, step))
+    return days
+
+
+def parse_hhmm(value: str) -> dtime:
+    hour, minute = value.strip().split(":")
+    return dtime(int(hour), int(minute))
+
+
+def validate_schedule(schedule: Dict[str, Any]):
+    """Raise ValueError if the schedule can't be evaluated."""
+    parse_days(schedule.get("days", "*"))
+    start, end = parse_hhmm(schedule["start_time"]), parse_hhmm(schedule["end_time"])
+    if start == end:
+        raise ValueError("start_time and end_time must differ")
+    if schedule.get("storage_mode", "nas") not in ("nas", "internal"):
+        raise ValueError("Invalid storage_mode")
+    runtime = schedule.get("max_runtime_minutes")
+    if runtime is not None and runtime <= 0:
+        raise ValueError("max_runtime_minutes must be positive")
+
+
+def _cron_dow(d: datetime) -> int:
+    # Python: Monday=0; cron: Sunday=0
+    return (d.weekday() + 1) % 7
+
+
+def current_window(schedule: Dict[str, Any], now: datetime):
+    """Return (window_start, window_end) if `now` falls inside the schedule, else None.
+
+    Windows may cross midnight (e.g. 22:00-04:00); the day-of-week applies to
+    the day the window opens.
+    """
+    days = parse_days(schedule.get("days", "*"))
+    start, end = parse_hhmm(schedule["start_time"]), parse_hhmm(schedule["end_time"])
+    duration = (datetime.combine(now.date(), end) - datetime.combine(now.date(), start))
+    if duration <= timedelta(0):
+        duration += timedelta(days=1)
+
+    for opened_on in (now.date(), now.date() - timedelta(days=1)):
+        window_start = datetime.combine(opened_on, start)
+        window_end = window_start + duration
+        if window_start <= now < window_end and _cron_dow(window_start) in days:
+            return window_start, window_end
+    return None
+
+
+class IndexScheduler:
+    """Runs incremental index jobs inside configured off-peak windows.
+
+    A job is stopped at the end of its window (or after max_runtime_minutes)
+    through the indexer's stop flag. Because per-file state is committed as it
+    goes, the next window's run picks up where the previous one stopped.
+    Each window gets one job (restarted only if a backend restart interrupted
+    it); outcomes are recorded in index_jobs.
+    """
+
+    def __init__(self, start_indexer: Callable[[str], Any], is_indexing: Callable[[], bool]):
+        self.start_indexer = start_indexer
+        self.is_indexing = is_indexing
+        self.task: Optional[asyncio.Task] = None
+        self.active: Optional[Dict[str, Any]] = None  # {job_id, schedule, deadline, process, stop_sent}
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _loop(self):
+        try:
+            await asyncio.to_thread(index_state.close_orphaned_jobs)
+        except Exception as e:
+            logger.error(f"Index scheduler error: {e}")
+        while True:
+            try:
+                # sqlite reads/writes and process checks: keep them off the event loop chat runs on
+                await asyncio.to_thread(self.tick, datetime.now())
+            except Exception as e:
+                logger.error(f"Index scheduler error: {e}")
+            await asyncio.sleep(TICK_SECONDS)
+
+    def tick(self, now: datetime):
+        if self.active:
+            self._supervise(now)
+            return
+
+        for schedule in index_state.get_schedules(enabled_only=True):
+            try:
+                window = current_window(schedule, now)
+            except ValueError as e:
+                logger.warning(f"Skipping invalid schedule {schedule['id']}: {e}")
+                continue
+            if not window:
+                continue
+
+            window_start, window_end = window
+            window_key = window_start.isoformat()
+            jobs = index_state.get_window_jobs(schedule["id"], window_key)
+            if any(j["status"] != "interrupted" for j in jobs):
+                continue  # Already ran in this window; a paused job resumes in the next one
+
+            if self.is_indexing():
+                continue  # A manual run is in progress; try again on the next tick
+
+            deadline = window_end
+            if schedule.get("max_runtime_minutes"):
+                deadline = min(deadline, now + timedelta(minutes=schedule["max_runtime_minutes"]))
+            if deadline <= now:
+                continue
+
+            job_id = index_state.start_job(schedule["id"], window_key)
+            logger.info(f"Scheduled indexing '{schedule.get('name') or schedule['id']}' started (until {deadline:%H:%M})")
+            process = self.start_indexer(schedule.get("storage_mode", "nas"))
+            self.active = {"job_id": job_id, "schedule": schedule, "deadline": deadline,
+                           "process": process, "stop_sent": False}
+            return
+
+    def _supervise(self, now: datetime):
+        active = self.active
+        process = active["process"]
+
+        if process.poll() is None:
+            if now >= active["deadline"] and not active["stop_sent"]:
+                logger.info("Indexing window closed; pausing scheduled run until the next window.")
+                index_state.request_stop()
+                active["stop_sent"] = True
+            return
+
+        status = index_state.get_status(log_lines=0)
+        run_status = status.get("status") or ""
+        if run_status == "Completed":
+            job_status = "completed"
+        elif active["stop_sent"]:
+            job_status = "paused"
+        elif run_status == "Stopped":
+            job_status = "stopped"  # Stopped by an admin: don't restart it in this window
+        else:
+            job_status = "failed"
+        index_state.finish_job(active["job_id"], job_status, run_id=status.get("run_id"), note=run_status)
+        logger.info(f"Scheduled indexing job {active['job_id']} finished: {job_status}")
+        self.active = None
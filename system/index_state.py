@@ -0,0 +1,452 @@
+import json
+import sqlite3
+import logging
+from pathlib import Path
+from typing import List, Optional, Dict, Any
+from datetime import datetime
+
+logger = logging.getLogger("index-state")
+
+# Indexing state lives in its own database so bulk indexer writes never share
+# a WAL with logins, chat messages and canvases in users.db.
+BASE_DIR = Path(__file__).parent.absolute()
+INDEX_DB_PATH = BASE_DIR / "index_state.db"
+LEGACY_DB_PATH = BASE_DIR / "users.db"
+
+LOG_KEEP_LINES = 2000
+
+
+def connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(INDEX_DB_PATH, timeout=60, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL;")
+    # State is rebuildable from the file tree, so trade durability for write speed
+    conn.execute("PRAGMA synchronous=NORMAL;")
+    conn.execute("PRAGMA busy_timeout=10000;")
+    conn.execute("PRAGMA temp_store=MEMORY;")
+    return conn
+
+
+def init_index_db():
+    conn = connect()
+    cursor = conn.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS file_index_state (
+        path TEXT PRIMARY KEY,
+        modified_time REAL,
+        last_seen REAL,
+        summary TEXT,
+        content_hash TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_index_state_content ON file_index_state (content_hash)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_file_index_state_last_seen ON file_index_state (last_seen)")
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS content_index_state (
+        content_hash TEXT PRIMARY KEY,
+        size INTEGER,
+        chunk_count INTEGER,
+        primary_path TEXT,
+        summary TEXT
+    )
+    ''')
+
+    # Single-row live status of the current/last run
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS indexing_status (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        run_id INTEGER,
+        status TEXT,
+        progress REAL,
+        is_indexing INTEGER,
+        processed_files INTEGER,
+        total_files INTEGER,
+        last_updated TEXT
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS indexing_log (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        run_id INTEGER,
+        message TEXT NOT NULL
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS index_runs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        storage_mode TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        status TEXT,
+        processed_files INTEGER DEFAULT 0,
+        scanned_files INTEGER DEFAULT 0,
+        deduped_files INTEGER DEFAULT 0
+    )
+    ''')
+
+    # Migration for partial-reindex scope if not exists
+    try:
+        cursor.execute('ALTER TABLE index_runs ADD COLUMN scope TEXT')
+    except sqlite3.OperationalError:
+        pass # Already exists
+
+    # Recurring indexing windows run by the backend scheduler
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS index_schedules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT,
+        days TEXT NOT NULL DEFAULT '*',
+        start_time TEXT NOT NULL,
+        end_time TEXT NOT NULL,
+        max_runtime_minutes INTEGER,
+        storage_mode TEXT NOT NULL DEFAULT 'nas',
+        enabled INTEGER NOT NULL DEFAULT 1
+    )
+    ''')
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS index_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        schedule_id INTEGER,
+        window_start TEXT,
+        started_at TEXT,
+        finished_at TEXT,
+        status TEXT,
+        run_id INTEGER,
+        note TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_index_jobs_window ON index_jobs (schedule_id, window_start)")
+
+    # Stop flag, last_indexed_at and other small control values
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS index_control (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+
+    conn.commit()
+    _migrate_from_users_db(conn)
+    conn.close()
+
+
+def _migrate_from_users_db(conn: sqlite3.Connection):
+    """One-time copy of index state that used to live in users.db."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT value FROM index_control WHERE key = 'migrated_from_users_db'")
+    if cursor.fetchone() or not LEGACY_DB_PATH.exists() or LEGACY_DB_PATH.is_dir():
+        return
+
+    try:
+        cursor.execute("ATTACH DATABASE ? AS legacy", (str(LEGACY_DB_PATH),))
+        cursor.execute("SELECT name FROM legacy.sqlite_master WHERE type = 'table'")
+        legacy_tables = {r[0] for r in cursor.fetchall()}
+
+        if 'file_index_state' in legacy_tables:
+            cursor.execute("PRAGMA legacy.table_info(file_index_state)")
+            cols = [c[1] for c in cursor.fetchall()]
+            summary_col = "summary" if "summary" in cols else "NULL"
+            hash_col = "content_hash" if "content_hash" in cols else "NULL"
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO file_index_state (path, modified_time, last_seen, summary, content_hash)
+                SELECT path, modified_time, last_seen, {summary_col}, {hash_col} FROM legacy.file_index_state
+            ''')
+        if 'content_index_state' in legacy_tables:
+            cursor.execute('''
+                INSERT OR IGNORE INTO content_index_state (content_hash, size, chunk_count, primary_path, summary)
+                SELECT content_hash, size, chunk_count, primary_path, summary FROM legacy.content_index_state
+            ''')
+        if 'settings' in legacy_tables:
+            cursor.execute('''
+                INSERT OR IGNORE INTO index_control (key, value)
+                SELECT key, value FROM legacy.settings WHERE key = 'last_indexed_at'
+            ''')
+
+        cursor.execute("INSERT OR REPLACE INTO index_control (key, value) VALUES (?, ?)",
+                       ("migrated_from_users_db", datetime.now().isoformat()))
+        conn.commit()
+        cursor.execute("DETACH DATABASE legacy")
+        logger.info("Migrated index state from users.db to index_state.db")
+    except Exception as e:
+        conn.rollback()
+        logger.error(f"Failed to migrate index state from users.db: {e}")
+
+
+# --- Control values ---
+
+def get_control(key: str, default: Optional[str] = None) -> Optional[str]:
+    try:
+        conn = connect()
+        row = conn.execute("SELECT value FROM index_control WHERE key = ?", (key,)).fetchone()
+        conn.close()
+        return row[0] if row else default
+    except Exception:
+        return default
+
+
+def set_control(key: str, value: Optional[str]):
+    conn = connect()
+    if value is None:
+        conn.execute("DELETE FROM index_control WHERE key = ?", (key,))
+    else:
+        conn.execute("INSERT OR REPLACE INTO index_control (key, value) VALUES (?, ?)", (key, value))
+    conn.commit()
+    conn.close()
+
+
+def request_stop():
+    set_control("stop_indexing_flag", "true")
+
+
+def clear_stop():
+    set_control("stop_indexing_flag", "false")
+
+
+def stop_requested() -> bool:
+    return get_control("stop_indexing_flag") == "true"
+
+
+def get_last_indexed_at() -> Optional[str]:
+    return get_control("last_indexed_at")
+
+
+def set_last_indexed_at(value: str):
+    set_control("last_indexed_at", value)
+
+
+# --- Runs, status and log ---
+
+def start_run(storage_mode: str, scope: Optional[Dict[str, Any]] = None) -> int:
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO index_runs (storage_mode, started_at, status, scope) VALUES (?, ?, ?, ?)",
+                   (storage_mode, datetime.now().isoformat(), "Running", json.dumps(scope) if scope else None))
+    run_id = cursor.lastrowid
+    cursor.execute("DELETE FROM indexing_log")
+    conn.commit()
+    conn.close()
+    return run_id
+
+
+def finish_run(run_id: int, status: str, processed: int = 0, scanned: int = 0, deduped: int = 0):
+    conn = connect()
+    conn.execute('''
+        UPDATE index_runs SET finished_at = ?, status = ?, processed_files = ?, scanned_files = ?, deduped_files = ?
+        WHERE id = ?
+    ''', (datetime.now().isoformat(), status, processed, scanned, deduped, run_id))
+    conn.commit()
+    conn.close()
+
+
+def get_runs(limit: int = 20) -> List[Dict[str, Any]]:
+    conn = connect()
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute("SELECT * FROM index_runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    conn.close()
+    runs = [dict(r) for r in rows]
+    for run in runs:
+        run["scope"] = json.loads(run["scope"]) if run.get("scope") else None
+    return runs
+
+
+def update_status(status: str, progress: float, is_indexing: bool, processed: int, total: int,
+                  run_id: Optional[int] = None, new_log_lines: Optional[List[str]] = None):
+    """Write the live status row and append any new log lines in one transaction."""
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute('''
+        INSERT OR REPLACE INTO indexing_status (id, run_id, status, progress, is_indexing, processed_files, total_files, last_updated)
+        VALUES (1, ?, ?, ?, ?, ?, ?, ?)
+    ''', (run_id, status, progress, int(is_indexing), processed, total, datetime.now().isoformat()))
+    if new_log_lines:
+        cursor.executemany("INSERT INTO indexing_log (run_id, message) VALUES (?, ?)",
+                           [(run_id, line) for line in new_log_lines])
+        cursor.execute("DELETE FROM indexing_log WHERE id <= (SELECT MAX(id) FROM indexing_log) - ?", (LOG_KEEP_LINES,))
+    conn.commit()
+    conn.close()
+
+
+def get_status(log_lines: int = 50) -> Dict[str, Any]:
+    """Status in the shape the admin API has always returned."""
+    try:
+        conn = connect()
+        conn.row_factory = sqlite3.Row
+        row = conn.execute("SELECT * FROM indexing_status WHERE id = 1").fetchone()
+        logs = conn.execute("SELECT message FROM indexing_log ORDER BY id DESC LIMIT ?", (log_lines,)).fetchall()
+        conn.close()
+    except Exception:
+        return {}
+    if not row:
+        return {}
+    return {
+        "run_id": row["run_id"],
+        "status": row["status"],
+        "progress": row["progress"],
+        "is_indexing": bool(row["is_indexing"]),
+        "processed_files": row["processed_files"],
+        "total_files": row["total_files"],
+        "last_updated": row["last_updated"],
+        "indexing_log": [r[0] for r in reversed(logs)]
+    }
+
+
+def reset_stuck_status() -> bool:
+    """Mark a run left 'indexing' by a crashed process as interrupted. Returns True if one was found."""
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("SELECT run_id FROM indexing_status WHERE id = 1 AND is_indexing = 1")
+    row = cursor.fetchone()
+    if row:
+        cursor.execute("UPDATE indexing_status SET is_indexing = 0, status = 'Interrupted', last_updated = ? WHERE id = 1",
+                       (datetime.now().isoformat(),))
+        if row[0]:
+            cursor.execute("UPDATE index_runs SET status = 'Interrupted', finished_at = ? WHERE id = ? AND finished_at IS NULL",
+                           (datetime.now().isoformat(), row[0]))
+        conn.commit()
+    conn.close()
+    return bool(row)
+
+
+def count_indexed_files() -> int:
+    try:
+        conn = connect()
+        count = conn.execute("SELECT COUNT(*) FROM file_index_state").fetchone()[0]
+        conn.close()
+        return count
+    except Exception:
+        return 0
+
+
+def indexed_files() -> List[Dict[str, Any]]:
+    """Every indexed path with its content's chunk count; copies of one content each get a row."""
+    conn = connect()
+    rows = conn.execute("""
+        SELECT f.path, f.modified_time, f.content_hash, c.chunk_count
+        FROM file_index_state f LEFT JOIN content_index_state c ON c.content_hash = f.content_hash
+        ORDER BY f.path
+    """).fetchall()
+    conn.close()
+    return [{
+        "path": path,
+        "modified_at": datetime.fromtimestamp(modified_time).isoformat() if modified_time else "",
+        "content_hash": content_hash,
+        "chunk_count": chunk_count or 0
+    } for path, modified_time, content_hash, chunk_count in rows]
+
+
+def content_hash_for_path(path: str) -> Optional[str]:
+    conn = connect()
+    row = conn.execute("SELECT content_hash FROM file_index_state WHERE path = ?", (path,)).fetchone()
+    conn.close()
+    return row[0] if row else None
+
+
+def clear_index_state():
+    """Forget every indexed file so the next run re-scans from scratch."""
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM file_index_state")
+    cursor.execute("DELETE FROM content_index_state")
+    cursor.execute("DELETE FROM indexing_log")
+    cursor.execute("DELETE FROM index_control WHERE key = 'last_indexed_at'")
+    cursor.execute('''
+        INSERT OR REPLACE INTO indexing_status (id, run_id, status, progress, is_indexing, processed_files, total_files, last_updated)
+        VALUES (1, NULL, 'Idle', 0, 0, 0, 0, ?)
+    ''', (datetime.now().isoformat(),))
+    conn.commit()
+    conn.close()
+
+
+# --- Schedules and scheduled job history ---
+
+def get_schedules(enabled_only: bool = False) -> List[Dict[str, Any]]:
+    conn = connect()
+    conn.row_factory = sqlite3.Row
+    query = "SELECT * FROM index_schedules"
+    if enabled_only:
+        query += " WHERE enabled = 1"
+    rows = conn.execute(query + " ORDER BY id").fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def save_schedule(schedule: Dict[str, Any]) -> int:
+    conn = connect()
+    cursor = conn.cursor()
+    values = (schedule.get("name"), schedule.get("days", "*"), schedule["start_time"], schedule["end_time"],
+              schedule.get("max_runtime_minutes"), schedule.get("storage_mode", "nas"), int(schedule.get("enabled", True)))
+    if schedule.get("id"):
+        cursor.execute('''
+            UPDATE index_schedules SET name = ?, days = ?, start_time = ?, end_time = ?, max_runtime_minutes = ?,
+                storage_mode = ?, enabled = ?
+            WHERE id = ?
+        ''', values + (schedule["id"],))
+        schedule_id = schedule["id"]
+    else:
+        cursor.execute('''
+            INSERT INTO index_schedules (name, days, start_time, end_time, max_runtime_minutes, storage_mode, enabled)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', values)
+        schedule_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return schedule_id
+
+
+def delete_schedule(schedule_id: int) -> bool:
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM index_schedules WHERE id = ?", (schedule_id,))
+    deleted = cursor.rowcount > 0
+    conn.commit()
+    conn.close()
+    return deleted
+
+
+def start_job(schedule_id: int, window_start: str) -> int:
+    conn = connect()
+    cursor = conn.cursor()
+    cursor.execute("INSERT INTO index_jobs (schedule_id, window_start, started_at, status) VALUES (?, ?, ?, ?)",
+                   (schedule_id, window_start, datetime.now().isoformat(), "running"))
+    job_id = cursor.lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def finish_job(job_id: int, status: str, run_id: Optional[int] = None, note: Optional[str] = None):
+    conn = connect()
+    conn.execute("UPDATE index_jobs SET finished_at = ?, status = ?, run_id = ?, note = ? WHERE id = ?",
+                 (datetime.now().isoformat(), status, run_id, note, job_id))
+    conn.commit()
+    conn.close()
+
+
+def get_window_jobs(schedule_id: int, window_start: str) -> List[Dict[str, Any]]:
+    conn = connect()
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute("SELECT * FROM index_jobs WHERE schedule_id = ? AND window_start = ? ORDER BY id",
+                        (schedule_id, window_start)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def get_jobs(limit: int = 50) -> List[Dict[str, Any]]:
+    conn = connect()
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute("SELECT * FROM index_jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+def close_orphaned_jobs():
+    """Jobs left 'running' by a backend restart can't be tracked any more."""
+    conn = connect()
+    conn.execute("UPDATE index_jobs SET status = 'interrupted', finished_at = ? WHERE status = 'running'",
+                 (datetime.now().isoformat(),))
+    conn.commit()
+    conn.close()
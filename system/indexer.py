@@ -5,7 +5,6 @@ os.environ['LANG'] = 'POSIX'
 
 import sys
 import json
-import sqlite3
 import logging
 import time
 from pathlib import Path
@@ -13,29 +12,28 @@ from typing import List, Optional, Dict, Any
 from datetime import datetime
 import gc
 import hashlib
+import argparse
+
+from chroma_writer import ChromaWriter
+from embedding_service import EmbeddingClient, EmbeddingServiceError
+import index_state
+from model_store import llama_memory_kwargs
+from gguf_metadata import runtime_params, embedding_dim
+from tokenizer_service import truncate_tokens
+from inference_scheduler import foreground_busy
+
+# Heavy libraries are imported on first use; optional ones are None when not installed
+from lazy_import import lazy, available
 
 # Llama.cpp
-try:
-    from llama_cpp import Llama
-except ImportError:
-    Llama = None
+llama_cpp = lazy("llama_cpp")
 
 # ChromaDB
-try:
-    import chromadb
-    from chromadb.config import Settings
-except ImportError:
-    chromadb = None
+chromadb = lazy("chromadb") if available("chromadb") else None
 
 # Document Loaders
-try:
-    import docx
-except ImportError:
-    docx = None
-try:
-    import openpyxl
-except ImportError:
-    openpyxl = None
+docx = lazy("docx") if available("docx") else None
+openpyxl = lazy("openpyxl") if available("openpyxl") else None
 
 # Setup Logging
 logging.basicConfig(
@@ -54,7 +52,8 @@ MODELS_DIR = BASE_DIR / "models"
 MNT_DIR = BASE_DIR / "mnt"
 INTERNAL_NAS_DIR = BASE_DIR / "internal_storage"
 CHROMA_DB_DIR = BASE_DIR / "chroma_db"
-DB_PATH = BASE_DIR / "users.db"
+SUMMARY_INPUT_TOKENS = 512  # Document tokens the summarizer sees
+FOREGROUND_POLL_SECONDS = 0.1
 
 # Ensure directories exist
 MODELS_DIR.mkdir(exist_ok=True)
@@ -79,12 +78,13 @@ class ModelManager:
         logger.info(f"Loading Embedding Model: {model_path}")
 
         try:
-            self.current_embed_model = Llama(
+            self.current_embed_model = llama_cpp.Llama(
                 model_path=str(model_path),
                 embedding=True,      # Set to embedding mode
                 n_gpu_layers=0,      # Force CPU for stability
-                n_ctx=2048,
-                verbose=False
+                verbose=False,
+                **runtime_params(model_path, "embed"),
+                **llama_memory_kwargs(model_path)
             )
         except Exception as e:
             logger.error(f"Failed to load embedding model: {e}")
@@ -117,12 +117,12 @@ class ModelManager:
 
         logger.info(f"Loading Summarization Model: {chat_model_path}")
         try:
-            self.current_embed_model = Llama(
+            # Memory-mapped, so the backend's copy of the same model shares these pages
+            self.current_embed_model = llama_cpp.Llama(
                 model_path=str(chat_model_path),
-                n_gpu_layers=0,
-                n_ctx=2048, # Increased context for safety
                 verbose=False,
-                use_mmap=False
+                **{**runtime_params(chat_model_path, "chat"), "n_gpu_layers": 0},  # CPU only
+                **llama_memory_kwargs(chat_model_path)
             )
             self.current_embed_path = chat_model_path
             return self.current_embed_model
@@ -138,24 +138,39 @@ def generate_summary(text: str) -> str:
     if not llm: return "Summary generation unavailable."
 
     try:
-        # Use first 800 chars for summary to keep it safe within context
-        preview = text[:800]
+        # Only the start of the document: enough for a summary, and well inside the context
+        preview = truncate_tokens(llm.model_path, text, SUMMARY_INPUT_TOKENS)
         messages = [
             {"role": "system", "content": "You are a helpful assistant. Summarize the provided document text in 3 concise Japanese sentences."},
             {"role": "user", "content": f"Document Snippet:\n{preview}\n\nSummary:"}
         ]
         
-        response = llm.create_chat_completion(messages=messages, max_tokens=200, temperature=0.3)
-        return response['choices'][0]['message']['content'].strip()
+        # This process owns its model, so a summary simply pauses between tokens (keeping its
+        # KV state) while the backend serves interactive or agent generations
+        summary = ""
+        for chunk in llm.create_chat_completion(messages=messages, max_tokens=200, temperature=0.3, stream=True):
+            summary += chunk['choices'][0].get('delta', {}).get('content') or ""
+            while foreground_busy():
+                time.sleep(FOREGROUND_POLL_SECONDS)
+        return summary.strip()
     except Exception as e:
         logger.error(f"Summarization error: {e}")
         return "Summary generation failed."
 
 class GGUFEmbeddingFunction:
-    def __init__(self, model_path: Path):
+    def __init__(self, model_path: Path, priority: str = "bulk"):
         self.model_path = model_path
+        self.service = EmbeddingClient(priority)
         
     def __call__(self, input: List[str]) -> List[List[float]]:
+        # Use the backend's embedding service when it's running so the model isn't
+        # loaded twice; interactive queries there are served ahead of our batches
+        if self.service.available():
+            try:
+                return self.service.embed(str(self.model_path), input)
+            except EmbeddingServiceError as e:
+                logger.warning(f"{e}; loading embedding model in-process instead")
+
         try:
             llm = model_manager.get_embed_model(self.model_path)
             if not llm:
@@ -171,11 +186,151 @@ class GGUFEmbeddingFunction:
                 except Exception as e:
                     logger.error(f"Failed to create embedding for text {i}: {e}")
                     # Return zero vector as fallback
-                    embeddings.append([0.0] * 768)  # nomic-embed has 768 dimensions
+                    embeddings.append([0.0] * embedding_dim(self.model_path))
             return embeddings
         except Exception as e:
             logger.error(f"Critical error in embedding function: {e}")
-            return [[0.0] * 768 for _ in input]
+            return [[0.0] * embedding_dim(self.model_path) for _ in input]
+
+def content_fingerprint(path: Path, size: int) -> str:
+    """Identify file content by size plus a streamed blake2b digest.
+
+    Copies of the same document in different folders share a fingerprint,
+    so their chunks are embedded and stored only once.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return f"{size:x}-{h.hexdigest()}"
+
+def release_content_ref(writer: ChromaWriter, db_cursor, path: str, content_hash: Optional[str]):
+    """Drop one path's reference to stored content.
+
+    Chunks are only deleted once no other path references the content. If the
+    path was the one recorded in the chunk metadata, the metadata is re-pointed
+    to a remaining copy so search results still resolve to an existing file.
+    """
+    if not content_hash:
+        # Legacy entry indexed per path before content dedup
+        writer.delete("path", path)
+        return
+
+    db_cursor.execute("SELECT path FROM file_index_state WHERE content_hash = ? AND path != ? LIMIT 1",
+                      (content_hash, path))
+    other = db_cursor.fetchone()
+    db_cursor.execute("SELECT chunk_count, primary_path FROM content_index_state WHERE content_hash = ?", (content_hash,))
+    content_row = db_cursor.fetchone()
+
+    if not other:
+        writer.delete("content_hash", content_hash)
+        db_cursor.execute("DELETE FROM content_index_state WHERE content_hash = ?", (content_hash,))
+        return
+
+    if content_row and content_row[1] == path:
+        new_path = other[0]
+        chunk_count = content_row[0] or 0
+        if chunk_count:
+            writer.update_metadata(
+                ids=[f"{content_hash}_{j}" for j in range(chunk_count)],
+                metadatas=[{"filename": Path(new_path).name, "path": new_path} for _ in range(chunk_count)]
+            )
+        db_cursor.execute("UPDATE content_index_state SET primary_path = ? WHERE content_hash = ?",
+                          (new_path, content_hash))
+
+def settle_pending(writer: ChromaWriter, db_conn, pending: Dict[str, Dict[str, Any]]) -> int:
+    """Mark content indexed once all of its chunks are in Chroma; returns how many were.
+
+    Until then its content_index_state row has chunk_count NULL (ignored by
+    the dedup check) and its paths have modified_time NULL, so content that
+    never reached Chroma (embedding error, failed batch, stop) is re-indexed
+    on the next run instead of being linked to chunks that don't exist.
+    """
+    written, failed = writer.take_results()
+    for ids, ok in ((written, True), (failed, False)):
+        for chunk_id in ids:
+            entry = pending.get(chunk_id.rsplit("_", 1)[0])
+            if entry:
+                entry["remaining"].discard(chunk_id)
+                entry["failed"] = entry["failed"] or not ok
+
+    settled = 0
+    cursor = db_conn.cursor()
+    for content_hash, entry in list(pending.items()):
+        if entry["remaining"]:
+            continue
+        del pending[content_hash]
+        if entry["failed"]:
+            add_log(f"Not all chunks of {Path(entry['files'][0][0]).name} were stored; it will be retried next run")
+            continue
+        cursor.execute("UPDATE content_index_state SET chunk_count = ? WHERE content_hash = ?",
+                       (entry["chunk_count"], content_hash))
+        cursor.executemany("UPDATE file_index_state SET modified_time = ? WHERE path = ? AND content_hash = ?",
+                           [(mod_time, path, content_hash) for path, mod_time in entry["files"]])
+        settled += 1
+    db_conn.commit()
+    return settled
+
+def parse_args(argv: List[str]) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Index NAS / internal storage into ChromaDB")
+    parser.add_argument("storage_mode", nargs="?", default="nas", choices=["nas", "internal"])
+    parser.add_argument("--prefix", action="append", default=[],
+                        help="Only scan this directory (relative to the storage root). Repeatable.")
+    parser.add_argument("--file", action="append", default=[],
+                        help="Only index this file (relative to the storage root). Repeatable.")
+    parser.add_argument("--since", type=float, default=None,
+                        help="Only (re)process files modified at or after this UNIX timestamp.")
+    return parser.parse_args(argv)
+
+def resolve_scope_path(source_dir: Path, rel: str) -> Optional[Path]:
+    """Map a user-supplied path onto the storage root, refusing anything outside it."""
+    root = os.path.normpath(str(source_dir))
+    candidate = os.path.normpath(os.path.join(root, rel.lstrip("/")) if not rel.startswith(root) else rel)
+    if candidate != root and not candidate.startswith(root + os.sep):
+        return None
+    return Path(candidate)
+
+def _within(path: Path, prefixes: List[Path]) -> bool:
+    key = str(path)
+    return any(key == str(p) or key.startswith(str(p) + os.sep) for p in prefixes)
+
+def scan_targets(source_dir: Path, prefixes: List[Path], files: List[Path]):
+    """Yield (directory, filenames) pairs limited to the requested scope, like os.walk.
+
+    The scope is the union of `prefixes` and `files`; with neither it is the whole root.
+    """
+    for prefix in prefixes or ([] if files else [source_dir]):
+        if prefix.is_file():
+            yield str(prefix.parent), [prefix.name]
+            continue
+        for root, _, names in os.walk(prefix):
+            yield root, names
+
+    by_dir: Dict[str, List[str]] = {}
+    for f in files:
+        # Files under a scanned prefix were yielded already
+        if f.is_file() and not _within(f, prefixes):
+            by_dir.setdefault(str(f.parent), []).append(f.name)
+    for root, names in by_dir.items():
+        yield root, names
+
+def stale_entries(db_cursor, scan_start_time: float, source_dir: Path, prefixes: List[Path], files: List[Path]) -> List[tuple]:
+    """State rows inside the scanned scope that were not seen during this run."""
+    rows = []
+    for prefix in prefixes or ([] if files else [source_dir]):
+        key = str(prefix)
+        # Range on the primary key instead of LIKE so the scan stays inside the subtree
+        db_cursor.execute('''
+            SELECT path, content_hash FROM file_index_state
+            WHERE last_seen < ? AND (path = ? OR (path >= ? AND path < ?))
+        ''', (scan_start_time, key, key + os.sep, key + chr(ord(os.sep) + 1)))
+        rows.extend(db_cursor.fetchall())
+
+    for f in files:
+        if not f.exists() and not _within(f, prefixes):
+            db_cursor.execute("SELECT path, content_hash FROM file_index_state WHERE path = ?", (str(f),))
+            rows.extend(db_cursor.fetchall())
+    return rows
 
 def read_docx_file(path: Path) -> str:
     if not docx: return ""
@@ -248,6 +403,8 @@ def recursive_character_text_splitter(text: str, chunk_size: int = 1000, chunk_o
 
 # Global log buffer
 log_buffer = []
+pending_log_lines = []
+current_run_id = None
 
 def add_log(message: str):
     global log_buffer
@@ -255,56 +412,48 @@ def add_log(message: str):
     log_entry = f"[{timestamp}] {message}"
     print(log_entry) # Stdout for docker logs
     log_buffer.append(log_entry)
+    pending_log_lines.append(log_entry)
     if len(log_buffer) > 50:
         log_buffer.pop(0)
 
 def update_status(status: str, progress: float, is_indexing: bool, processed: int, total: int):
+    global pending_log_lines
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        
-        # Ensure table exists (indexer needs to be robust)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT
-            )
-        ''')
-        
-        status_data = {
-            "status": status,
-            "progress": progress,
-            "is_indexing": is_indexing,
-            "processed_files": processed,
-            "total_files": total,
-            "last_updated": datetime.now().isoformat(),
-            "indexing_log": log_buffer
-        }
-        
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", 
-                      ("indexing_status", json.dumps(status_data)))
-        conn.commit()
-        conn.close()
+        # Only log lines added since the last update are written
+        index_state.update_status(status, progress, is_indexing, processed, total,
+                                  run_id=current_run_id, new_log_lines=pending_log_lines)
+        pending_log_lines = []
     except Exception as e:
         print(f"Failed to update status: {e}")
 
+_stop_flag_checked_at = 0.0
+_stop_flag_value = False
+
 def check_stop_flag() -> bool:
+    # Polled per file; re-read the flag at most once per second
+    global _stop_flag_checked_at, _stop_flag_value
+    now = time.monotonic()
+    if _stop_flag_value or now - _stop_flag_checked_at < 1.0:
+        return _stop_flag_value
+    _stop_flag_checked_at = now
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT value FROM settings WHERE key = 'stop_indexing_flag'")
-        row = cursor.fetchone()
-        conn.close()
-        if row and row[0] == 'true':
-            return True
-        return False
-    except:
-        return False
+        _stop_flag_value = index_state.stop_requested()
+    except Exception:
+        _stop_flag_value = False
+    return _stop_flag_value
 
 def main():
     logger.info("Starting indexing process...")
-    global log_buffer
+    global log_buffer, current_run_id
     log_buffer = []
+
+    # Handle storage mode and optional partial-reindex scope from command line
+    args = parse_args(sys.argv[1:])
+    storage_mode = args.storage_mode
+    scope = {k: v for k, v in (("prefixes", args.prefix), ("files", args.file), ("since", args.since)) if v}
+
+    index_state.init_index_db()
+    current_run_id = index_state.start_run(storage_mode, scope=scope or None)
     
     # Initialize status
     add_log("Starting indexing process...")
@@ -312,20 +461,14 @@ def main():
     
     # Reset stop flag
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", ("stop_indexing_flag", "false"))
-        conn.commit()
-        conn.close()
+        index_state.clear_stop()
     except Exception as e:
         logger.error(f"Failed to reset stop flag: {e}")
 
+    writer = None
+    scanned_count, processed_count, deduped_count = 0, 0, 0
     try:
-        # Handle storage mode from command line
-        storage_mode = "nas"
-        if len(sys.argv) > 1:
-            storage_mode = sys.argv[1]
-            
+
         if storage_mode == "internal":
             source_dir = INTERNAL_NAS_DIR
         else:
@@ -339,8 +482,20 @@ def main():
         if not source_dir.exists():
             logger.error(f"Source directory not found: {source_dir}")
             update_status(f"Error: Directory not found", 0, False, 0, 0)
+            index_state.finish_run(current_run_id, "Error: Directory not found")
             return
 
+        scope_prefixes = [p for p in (resolve_scope_path(source_dir, r) for r in args.prefix) if p]
+        scope_files = [p for p in (resolve_scope_path(source_dir, r) for r in args.file) if p]
+        if len(scope_prefixes) != len(args.prefix) or len(scope_files) != len(args.file):
+            add_log("WARNING: Ignored scope paths outside the storage root.")
+        if (args.prefix or args.file) and not (scope_prefixes or scope_files):
+            update_status("Error: Invalid scope", 0, False, 0, 0)
+            index_state.finish_run(current_run_id, "Error: Invalid scope")
+            return
+        if scope:
+            add_log(f"Partial reindex scope: {json.dumps(scope, ensure_ascii=False)}")
+
         # Initialize ChromaDB
         logger.info("Initializing ChromaDB...")
         client = chromadb.PersistentClient(path=str(CHROMA_DB_DIR))
@@ -350,6 +505,7 @@ def main():
         if not embed_model_path.exists():
             logger.error(f"Embedding model not found: {embed_model_path}")
             update_status("Error: Embedding model missing", 0, False, 0, 0)
+            index_state.finish_run(current_run_id, "Error: Embedding model missing")
             return
             
         embedding_function = GGUFEmbeddingFunction(model_path=embed_model_path)
@@ -364,44 +520,23 @@ def main():
         )
         logger.info("ChromaDB collection loaded.")
 
-        # DB for file state (Updated Schema)
-        db_conn = sqlite3.connect(DB_PATH)
+        # DB for file state (separate index_state.db; one row per unique content in
+        # content_index_state, every path referencing it via file_index_state.content_hash)
+        db_conn = index_state.connect()
         db_cursor = db_conn.cursor()
-        
-        # Check if table exists and has 'summary' column
-        db_cursor.execute("PRAGMA table_info(file_index_state)")
-        columns = [info[1] for info in db_cursor.fetchall()]
-        
-        if 'file_index_state' not in columns and not columns: # Table doesn't exist
-            db_cursor.execute('''
-                CREATE TABLE IF NOT EXISTS file_index_state (
-                    path TEXT PRIMARY KEY,
-                    modified_time REAL,
-                    last_seen REAL,
-                    summary TEXT
-                )
-            ''')
-        elif 'summary' not in columns: # Table exists but needs upgrade
-            try:
-                db_cursor.execute("ALTER TABLE file_index_state ADD COLUMN summary TEXT")
-            except Exception as e:
-                logger.warning(f"Could not add summary column (might exist): {e}")
-        
-        db_conn.commit()
 
         # Scan
         logger.info("Starting scan...")
         update_status("Scanning files...", 0, True, 0, 0)
         
         scan_start_time = time.time()
-        batch_size = 10
-        current_batch_ids, current_batch_docs, current_batch_metadatas, current_batch_embeddings = [], [], [], []
-        scanned_count, processed_count = 0, 0
+        writer = ChromaWriter(collection, log=add_log, track_results=True)
+        pending: Dict[str, Dict[str, Any]] = {}  # content_hash -> chunks not yet confirmed written
         
         # Count total files first for progress (optional, but good for UX)
         # For now, we'll just increment scanned_count
         
-        for root, _, files in os.walk(source_dir):
+        for root, files in scan_targets(source_dir, scope_prefixes, scope_files):
             if check_stop_flag():
                 logger.info("Stop flag detected. Halting scan.")
                 break
@@ -428,12 +563,45 @@ def main():
                     if stat.st_size > 1024 * 1024 * 1024: # 1GB limit
                         continue
 
-                    db_cursor.execute("SELECT modified_time FROM file_index_state WHERE path = ?", (file_key,))
+                    if args.since and mod_time < args.since:
+                        # Outside the time window: keep it, but don't diff or re-read it
+                        db_cursor.execute("UPDATE file_index_state SET last_seen = ? WHERE path = ?", (scan_start_time, file_key))
+                        continue
+
+                    db_cursor.execute("SELECT modified_time, content_hash FROM file_index_state WHERE path = ?", (file_key,))
                     result = db_cursor.fetchone()
                     
                     if result and result[0] == mod_time:
                         db_cursor.execute("UPDATE file_index_state SET last_seen = ? WHERE path = ?", (scan_start_time, file_key))
                         continue
+
+                    old_content_hash = result[1] if result else None
+                    content_hash = content_fingerprint(file_path, stat.st_size)
+
+                    if content_hash in pending:
+                        # Another copy of content still being written in this run: settled along with it
+                        if old_content_hash != content_hash:
+                            release_content_ref(writer, db_cursor, file_key, old_content_hash)
+                        db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen, summary, content_hash) VALUES (?, NULL, ?, ?, ?)",
+                                          (file_key, scan_start_time, pending[content_hash]["summary"], content_hash))
+                        db_conn.commit()
+                        pending[content_hash]["files"].append((file_key, mod_time))
+                        deduped_count += 1
+                        add_log(f"Duplicate content, linked: {file}")
+                        continue
+
+                    # Same content already indexed (another copy, or a touch without edits): record a reference only
+                    db_cursor.execute("SELECT summary FROM content_index_state WHERE content_hash = ? AND chunk_count IS NOT NULL", (content_hash,))
+                    known_content = db_cursor.fetchone()
+                    if known_content:
+                        if old_content_hash != content_hash:
+                            release_content_ref(writer, db_cursor, file_key, old_content_hash)
+                        db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen, summary, content_hash) VALUES (?, ?, ?, ?, ?)",
+                                          (file_key, mod_time, scan_start_time, known_content[0], content_hash))
+                        db_conn.commit()
+                        deduped_count += 1
+                        add_log(f"Duplicate content, linked: {file}")
+                        continue
                         
                     add_log(f"Processing: {file}")
                     update_status(f"Processing: {file}", 0, True, processed_count, scanned_count)
@@ -453,9 +621,14 @@ def main():
                             logger.warning(f"    - Read error: {read_err}")
                             continue
 
+                    if old_content_hash != content_hash:
+                        release_content_ref(writer, db_cursor, file_key, old_content_hash)
+
                     if not content or not content.strip():
-                        db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen, summary) VALUES (?, ?, ?, ?)",
-                                          (file_key, mod_time, scan_start_time, ""))
+                        db_cursor.execute("INSERT OR REPLACE INTO content_index_state (content_hash, size, chunk_count, primary_path, summary) VALUES (?, ?, ?, ?, ?)",
+                                          (content_hash, stat.st_size, 0, file_key, ""))
+                        db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen, summary, content_hash) VALUES (?, ?, ?, ?, ?)",
+                                          (file_key, mod_time, scan_start_time, "", content_hash))
                         continue
 
                     # --- 4-Layer Architecture: Generate Summary Layer ---
@@ -467,48 +640,28 @@ def main():
                     except Exception as sum_err:
                         add_log(f"Warning: Summary failed for {file}: {sum_err}")
                     
-                    # Store State & Summary immediately
-                    db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen, summary) VALUES (?, ?, ?, ?)",
-                                      (file_key, mod_time, scan_start_time, summary))
-                    db_conn.commit()
-
                     chunks = recursive_character_text_splitter(content, chunk_size=1000, chunk_overlap=200)
-                    file_hash = hashlib.md5(file_key.encode()).hexdigest()
                     mod_time_iso = datetime.fromtimestamp(mod_time).isoformat()
 
-                    collection.delete(where={"path": file_key})
-
-                    for j, chunk in enumerate(chunks):
-                        raw_chunk = chunk
-                        # nomic-embed likes search_document: prefix for documents
-                        prefixed_chunk = f"search_document: {raw_chunk}"
-                        chunk_id = f"{file_hash}_{j}"
-                        
-                        current_batch_ids.append(chunk_id)
-                        current_batch_docs.append(raw_chunk)
-                        current_batch_metadatas.append({"filename": file_path.name, "path": file_key, "modified_at": mod_time_iso, "chunk_index": j, "total_chunks": len(chunks)})
-                        
-                        # Calculate embedding with prefix
-                        embeds = embedding_function([prefixed_chunk])
-                        current_batch_embeddings.append(embeds[0])
-                        
-                        if len(current_batch_ids) >= batch_size:
-                            try:
-                                collection.add(
-                                    ids=current_batch_ids, 
-                                    documents=current_batch_docs, 
-                                    metadatas=current_batch_metadatas,
-                                    embeddings=current_batch_embeddings
-                                )
-                            except Exception as add_err:
-                                add_log(f"Error adding batch to Chroma: {add_err}")
-                            current_batch_ids, current_batch_docs, current_batch_metadatas, current_batch_embeddings = [], [], [], []
-
-                    # Update state (redundant but safe)
-                    db_cursor.execute("UPDATE file_index_state SET last_seen = ? WHERE path = ?",
-                                      (scan_start_time, file_key))
+                    # Pending until the writer confirms every chunk (see settle_pending)
+                    db_cursor.execute("INSERT OR REPLACE INTO content_index_state (content_hash, size, chunk_count, primary_path, summary) VALUES (?, ?, NULL, ?, ?)",
+                                      (content_hash, stat.st_size, file_key, summary))
+                    db_cursor.execute("INSERT OR REPLACE INTO file_index_state (path, modified_time, last_seen, summary, content_hash) VALUES (?, NULL, ?, ?, ?)",
+                                      (file_key, scan_start_time, summary, content_hash))
                     db_conn.commit()
-                    
+
+                    # nomic-embed likes search_document: prefix for documents.
+                    # Embed the whole file in one request so the service can batch it.
+                    embeds = embedding_function([f"search_document: {chunk}" for chunk in chunks])
+                    pending[content_hash] = {"remaining": {f"{content_hash}_{j}" for j in range(len(chunks))},
+                                             "failed": False, "chunk_count": len(chunks), "summary": summary,
+                                             "files": [(file_key, mod_time)]}
+                    for j, raw_chunk in enumerate(chunks):
+                        chunk_id = f"{content_hash}_{j}"
+                        metadata = {"filename": file_path.name, "path": file_key, "content_hash": content_hash, "modified_at": mod_time_iso, "chunk_index": j, "total_chunks": len(chunks)}
+                        writer.upsert(chunk_id, raw_chunk, metadata, embeds[j])
+                    settle_pending(writer, db_conn, pending)
+
                     processed_count += 1
                     add_log(f"Indexed: {file} ({len(chunks)} chunks)")
                     update_status(f"Indexed: {file}", 0, True, processed_count, scanned_count)
@@ -516,44 +669,46 @@ def main():
                 except Exception as e:
                     add_log(f"Error processing {file}: {e}")
 
-        # Final Batch
-        if current_batch_ids and not check_stop_flag():
-            logger.info(f"Adding final batch of {len(current_batch_ids)} chunks...")
-            try:
-                collection.add(
-                    ids=current_batch_ids, 
-                    documents=current_batch_docs, 
-                    metadatas=current_batch_metadatas,
-                    embeddings=current_batch_embeddings
-                )
-                db_conn.commit()
-            except Exception as e:
-                logger.error(f"ERROR adding final batch: {e}")
-
         # Cleanup old files
         if not check_stop_flag():
             logger.info("Cleaning up deleted files from index...")
-            db_cursor.execute("SELECT path FROM file_index_state WHERE last_seen < ?", (scan_start_time,))
-            deleted_files = db_cursor.fetchall()
-            for (path,) in deleted_files:
+            deleted_files = stale_entries(db_cursor, scan_start_time, source_dir, scope_prefixes, scope_files)
+            for (path, content_hash) in deleted_files:
                 logger.info(f"Removing deleted file from index: {path}")
-                collection.delete(where={"path": path})
+                release_content_ref(writer, db_cursor, path, content_hash)
                 db_cursor.execute("DELETE FROM file_index_state WHERE path = ?", (path,))
             db_conn.commit()
 
+        # Final flush, also on stop; content whose chunks were all written is marked indexed
+        writer.close()
+        settle_pending(writer, db_conn, pending)
+        logger.info(f"Chroma writer finished: {writer.upserted} chunks upserted, {writer.deleted_batches} delete batches.")
+        writer = None
+
         db_conn.close()
-        db_conn = sqlite3.connect(DB_PATH)
-        db_cursor = db_conn.cursor()
-        db_cursor.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', ('last_indexed_at', datetime.now().isoformat()))
-        db_conn.commit()
-        db_conn.close()
-        
+
+        if deduped_count:
+            add_log(f"Linked {deduped_count} duplicate files without re-embedding.")
+
+        if check_stop_flag():
+            add_log("Indexing stopped by user.")
+            update_status("Stopped", 0, False, processed_count, scanned_count)
+            index_state.finish_run(current_run_id, "Stopped", processed_count, scanned_count, deduped_count)
+            return
+
+        if not scope:
+            index_state.set_last_indexed_at(datetime.now().isoformat())
         logger.info("Indexing completed.")
         update_status("Completed", 100, False, processed_count, scanned_count)
+        index_state.finish_run(current_run_id, "Completed", processed_count, scanned_count, deduped_count)
 
     except Exception as e:
         logger.error(f"Global Indexing Error: {e}")
         update_status(f"Failed: {str(e)}", 0, False, 0, 0)
+        index_state.finish_run(current_run_id, f"Failed: {str(e)}", processed_count, scanned_count, deduped_count)
+    finally:
+        if writer:
+            writer.close()
 
 if __name__ == "__main__":
     main()
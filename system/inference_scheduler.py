@@ -0,0 +1,258 @@
+"""Central admission control for local model generations.
+
+Every generation on a model first takes a ticket from the scheduler. A model
+runs a bounded number of generations at once (one per llama.cpp context);
+waiting tickets are granted by priority class, and within a class round-robin
+across users so one user's burst can't starve the others. Callers can poll
+their queue position while they wait, e.g. to show it to the user.
+
+Background generations can be taken preemptible: when interactive or agent
+work is waiting on a model whose slots are all busy, the scheduler sets the
+`preempt` event of running preemptible tickets. Their generation stops at
+the next token boundary, hands the slot over with `yield_turn` and is
+granted again (keeping its place) once the urgent work is done. While any
+interactive or agent generation is queued or running, the scheduler also
+keeps a marker file so background generations in other processes (the
+indexer) can pause too; see `foreground_busy`.
+"""
+import os
+import time
+import asyncio
+import logging
+import itertools
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Any
+
+logger = logging.getLogger("inference-scheduler")
+
+# Priority classes, most urgent first
+INTERACTIVE = 0
+AGENT = 1
+SUMMARY = 2
+INDEXING = 3
+PRIORITY_NAMES = {INTERACTIVE: "interactive", AGENT: "agent", SUMMARY: "summary", INDEXING: "indexing"}
+
+MAX_QUEUE_DEPTH = int(os.environ.get("INFERENCE_MAX_QUEUE", "32"))
+SLOTS_PER_MODEL = int(os.environ.get("INFERENCE_SLOTS_PER_MODEL", "1"))
+# Most urgent class that preemptible tickets give way to
+FOREGROUND = AGENT
+BUSY_MARKER = os.environ.get("INFERENCE_BUSY_MARKER",
+                             str(Path(__file__).parent.absolute() / "run" / "foreground.busy"))
+
+
+def foreground_busy(marker: str = BUSY_MARKER) -> bool:
+    """True while the backend is running or queueing interactive/agent generations."""
+    try:
+        with open(marker) as f:
+            pid = int(f.read().strip() or 0)
+    except (OSError, ValueError):
+        return False
+    try:
+        os.kill(pid, 0)  # A marker left behind by a dead backend doesn't count
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Ticket:
+    def __init__(self, scheduler: "InferenceScheduler", resource: str, priority: int, user: str, seq: int,
+                 preemptible: bool = False):
+        self.scheduler = scheduler
+        self.resource = resource
+        self.priority = priority
+        self.user = str(user)
+        self.seq = seq
+        self.enqueued_at = time.monotonic()
+        self.granted = threading.Event()
+        self.released = False
+        self.preemptible = preemptible
+        self.preempt = threading.Event()  # Set when urgent work wants this ticket's slot
+        self.preemptions = 0
+
+    def position(self) -> int:
+        """Number of waiting tickets that will be granted before this one (0 once granted)."""
+        return self.scheduler.position(self)
+
+    async def wait(self, poll_interval: float = 0.25):
+        """Async generator yielding the queue position each time it changes, until granted."""
+        last = None
+        while not self.granted.is_set():
+            pos = self.position()
+            if pos != last:
+                last = pos
+                yield pos
+            await asyncio.sleep(poll_interval)
+
+    async def wait_granted(self):
+        async for _ in self.wait():
+            pass
+
+    def wait_blocking(self, timeout: Optional[float] = None) -> bool:
+        return self.granted.wait(timeout)
+
+    def yield_turn(self):
+        """Hand the slot to the urgent work that preempted us and queue again, keeping our place."""
+        self.scheduler.requeue(self)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.scheduler.release(self)
+
+    def __enter__(self):
+        self.wait_blocking()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class _Resource:
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.active: List[Ticket] = []
+        self.waiting: List[Ticket] = []
+        self.last_served: Dict[str, int] = {}  # user -> grant counter when last served
+
+
+class InferenceScheduler:
+    def __init__(self, max_queue_depth: int = MAX_QUEUE_DEPTH, slots_per_model: int = SLOTS_PER_MODEL,
+                 busy_marker: Optional[str] = None):
+        self.max_queue_depth = max_queue_depth
+        self.slots_per_model = slots_per_model
+        self.busy_marker = busy_marker
+        self._foreground_busy = False
+        self._lock = threading.Lock()
+        self._resources: Dict[str, _Resource] = {}
+        self._seq = itertools.count(1)
+        self._grants = itertools.count(1)
+
+    def enqueue(self, resource: str, priority: int, user: Any = "system", preemptible: bool = False) -> Ticket:
+        """Queue a generation on `resource` (a model path). Raises QueueFull when saturated.
+
+        A `preemptible` generation must watch `ticket.preempt` and call
+        `ticket.yield_turn()` when it is set.
+        """
+        with self._lock:
+            res = self._resources.setdefault(resource, _Resource(self.slots_per_model))
+            waiting = sum(len(r.waiting) for r in self._resources.values())
+            if waiting >= self.max_queue_depth:
+                raise QueueFull(f"Inference queue is full ({waiting} waiting)")
+            ticket = Ticket(self, resource, priority, user, next(self._seq), preemptible)
+            res.waiting.append(ticket)
+            self._dispatch(res)
+        if not ticket.granted.is_set():
+            logger.info(f"Queued {PRIORITY_NAMES.get(priority, priority)} generation for {ticket.user} "
+                        f"(position {ticket.position()})")
+        return ticket
+
+    def set_slots(self, resource: str, slots: int):
+        """Set how many generations may run on `resource` at once."""
+        with self._lock:
+            res = self._resources.setdefault(resource, _Resource(slots))
+            res.slots = slots
+            self._dispatch(res)
+
+    def release(self, ticket: Ticket):
+        with self._lock:
+            res = self._resources.get(ticket.resource)
+            if not res:
+                return
+            if ticket in res.active:
+                res.active.remove(ticket)
+            elif ticket in res.waiting:
+                res.waiting.remove(ticket)  # Gave up while waiting
+            self._dispatch(res)
+
+    def requeue(self, ticket: Ticket):
+        with self._lock:
+            res = self._resources.get(ticket.resource)
+            if not res or ticket not in res.active:
+                return
+            res.active.remove(ticket)
+            ticket.granted.clear()
+            ticket.preempt.clear()
+            ticket.preemptions += 1
+            res.waiting.append(ticket)
+            self._dispatch(res)
+        logger.info(f"Preempted {PRIORITY_NAMES.get(ticket.priority, ticket.priority)} generation for {ticket.user}")
+
+    def position(self, ticket: Ticket) -> int:
+        with self._lock:
+            if ticket.granted.is_set():
+                return 0
+            res = self._resources.get(ticket.resource)
+            if not res or ticket not in res.waiting:
+                return 0
+            order = self._order(res.waiting, dict(res.last_served))
+            return order.index(ticket) + 1
+
+    def status(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.monotonic()
+            return {resource: {
+                "slots": res.slots,
+                "active": [{"user": t.user, "priority": PRIORITY_NAMES.get(t.priority, t.priority),
+                            "preemptions": t.preemptions} for t in res.active],
+                "waiting": [{"user": t.user, "priority": PRIORITY_NAMES.get(t.priority, t.priority),
+                             "waited_seconds": round(now - t.enqueued_at, 1)}
+                            for t in self._order(res.waiting, dict(res.last_served))]
+            } for resource, res in self._resources.items() if res.active or res.waiting}
+
+    # --- Internals (called with self._lock held) ---
+
+    def _next(self, waiting: List[Ticket], last_served: Dict[str, int]) -> Ticket:
+        # Best priority class first; within it the user served longest ago, then FIFO
+        return min(waiting, key=lambda t: (t.priority, last_served.get(t.user, 0), t.seq))
+
+    def _order(self, waiting: List[Ticket], last_served: Dict[str, int]) -> List[Ticket]:
+        # Replays _dispatch on a copy of the fairness state
+        pending, order = list(waiting), []
+        grant = max(last_served.values(), default=0)
+        while pending:
+            t = self._next(pending, last_served)
+            pending.remove(t)
+            order.append(t)
+            grant += 1
+            last_served[t.user] = grant
+        return order
+
+    def _dispatch(self, res: _Resource):
+        while res.waiting and len(res.active) < res.slots:
+            t = self._next(res.waiting, res.last_served)
+            res.waiting.remove(t)
+            res.active.append(t)
+            res.last_served[t.user] = next(self._grants)
+            t.granted.set()
+        # Urgent work still waiting: ask that many running background generations to yield
+        urgent = sum(1 for t in res.waiting if t.priority <= FOREGROUND)
+        if urgent:
+            victims = [t for t in res.active if t.preemptible and t.priority > FOREGROUND]
+            victims.sort(key=lambda t: (-t.priority, -t.seq))
+            for t in victims[:urgent]:
+                t.preempt.set()
+        self._update_busy_marker()
+
+    def _update_busy_marker(self):
+        if not self.busy_marker:
+            return
+        busy = any(t.priority <= FOREGROUND for r in self._resources.values() for t in r.active + r.waiting)
+        if busy == self._foreground_busy:
+            return
+        self._foreground_busy = busy
+        try:
+            if busy:
+                os.makedirs(os.path.dirname(self.busy_marker), exist_ok=True)
+                with open(self.busy_marker, "w") as f:
+                    f.write(str(os.getpid()))
+            elif os.path.exists(self.busy_marker):
+                os.remove(self.busy_marker)
+        except OSError as e:
+            logger.warning(f"Could not update {self.busy_marker}: {e}")
@@ -0,0 +1,75 @@
+"""Import heavy optional libraries on first use.
+
+`lazy("chromadb")` returns a stand-in module that performs the real import
+on first attribute access, so importing backend.py or starting an indexer
+subprocess doesn't pay for llama_cpp, chromadb, the document parsers and
+the auth libraries until something actually uses them. `available(name)`
+tells whether a library is installed by looking it up on sys.path, without
+importing it.
+
+A library that is missing raises ImportError at first use, where an eager
+import would have raised at startup.
+"""
+import sys
+import importlib
+import importlib.util
+import threading
+import types
+from typing import Dict
+
+_lock = threading.Lock()
+_available: Dict[str, bool] = {}
+
+
+def available(name: str) -> bool:
+    """True if module `name` can be imported.
+
+    A top-level name is only looked up; for a dotted name the parent package
+    has to be imported to search it.
+    """
+    with _lock:
+        if name in _available:
+            return _available[name]
+    if name in sys.modules:
+        found = True
+    else:
+        try:
+            found = importlib.util.find_spec(name) is not None
+        except (ImportError, ValueError):
+            found = False
+    with _lock:
+        _available[name] = found
+    return found
+
+
+class LazyModule(types.ModuleType):
+    """Module proxy that imports the real module when an attribute is first read."""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.__dict__["_lazy_target"] = None
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__["_lazy_target"]
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__["_lazy_target"] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = "loaded" if self.__dict__["_lazy_target"] is not None else "not loaded"
+        return f"<lazy module {self.__name__!r} ({state})>"
+
+
+def lazy(name: str) -> types.ModuleType:
+    """The module itself if it is already imported, else a LazyModule for it."""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
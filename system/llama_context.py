@@ -0,0 +1,61 @@
+"""The llama-cpp-python context internals this code relies on, in one place.
+
+Prefill that can be interrupted, speculative drafting and session snapshots
+all need to know which tokens are already in a `Llama`'s KV cache and to
+evaluate new ones in slices. llama-cpp-python has no public API for that:
+it keeps the evaluated tokens in `_input_ids[:n_tokens]` and rewinds by
+lowering `n_tokens`. Only this module touches those attributes.
+"""
+import time
+from typing import Callable, List, Optional, Sequence
+
+
+def prompt_tokens(llm, prompt: str) -> List[int]:
+    """The tokens `Llama.create_completion(prompt=...)` evaluates for `prompt`."""
+    if prompt == "":
+        return [llm.token_bos()]
+    return llm.tokenize(prompt.encode("utf-8"), add_bos=True, special=True)
+
+
+def context_tokens(llm) -> List[int]:
+    """Tokens currently evaluated in the context."""
+    return [int(t) for t in llm._input_ids[:llm.n_tokens]]
+
+
+def keep_prefix(llm, tokens: Sequence[int], min_new: int = 0) -> int:
+    """Rewind the context to its longest common prefix with `tokens`; returns its length.
+
+    At least `min_new` tokens are left to evaluate, so the caller gets fresh
+    logits for the last one.
+    """
+    prefix = 0
+    for a, b in zip(context_tokens(llm), tokens):
+        if a != int(b):
+            break
+        prefix += 1
+    prefix = max(0, min(prefix, len(tokens) - min_new))
+    llm.n_tokens = prefix
+    return prefix
+
+
+def eval_in_slices(llm, tokens: Sequence[int], stop: Callable[[], bool],
+                   max_delay: Optional[float] = None, evaluate: Optional[Callable] = None) -> bool:
+    """Evaluate `tokens`, checking `stop` before each slice; False if it stopped early.
+
+    Slices are n_batch tokens, or, with `max_delay`, sized to take about that
+    many seconds each. `evaluate` replaces `llm.eval` for callers that wrap it.
+    """
+    evaluate = evaluate or llm.eval
+    tokens = list(tokens)
+    step = llm.n_batch if max_delay is None else min(32, llm.n_batch)
+    i = 0
+    while i < len(tokens):
+        if stop():
+            return False
+        start = time.perf_counter()
+        evaluate(tokens[i:i + step])
+        i += step
+        if max_delay is not None:
+            elapsed = max(time.perf_counter() - start, 1e-3)
+            step = max(16, min(llm.n_batch, int(step * max_delay / elapsed)))
+    return True
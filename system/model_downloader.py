@@ -0,0 +1,482 @@
+"""Resumable, parallel model downloads.
+
+A download is split into fixed-size byte ranges fetched over several HTTP
+connections and written in place into `<filename>.download`. Progress per
+range is checkpointed in the database, so a dropped connection only retries
+that range from where it stopped and a restarted backend picks unfinished
+downloads up again. The sha256 is computed while the data arrives, trailing
+the contiguous downloaded prefix of the file, and checked against the
+expected digest before the file is moved into place. Servers without Range
+support get a single streaming connection.
+
+Bandwidth is limited across all downloads by MODEL_DOWNLOAD_MAX_MBPS, and
+optionally per download.
+"""
+import os
+import time
+import threading
+import uuid
+import asyncio
+import hashlib
+import logging
+import sqlite3
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Callable, Awaitable
+
+import httpx
+
+logger = logging.getLogger("model-downloader")
+
+CONNECTIONS = int(os.environ.get("MODEL_DOWNLOAD_CONNECTIONS", "4"))
+SEGMENT_BYTES = int(os.environ.get("MODEL_DOWNLOAD_SEGMENT_MB", "64")) * 1024 * 1024
+MAX_MBPS = float(os.environ.get("MODEL_DOWNLOAD_MAX_MBPS", "0"))  # 0 = unlimited
+RETRIES = int(os.environ.get("MODEL_DOWNLOAD_RETRIES", "5"))
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+READ_CHUNK = 1024 * 1024
+
+# "publishing": the file is in place and on_complete hasn't finished; resumed by running it again
+ACTIVE_STATUSES = ("queued", "downloading", "verifying", "publishing")
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RateLimiter:
+    """Token bucket shared by every connection that draws from it."""
+
+    def __init__(self, bytes_per_sec: float):
+        self.rate = bytes_per_sec
+        self.tokens = bytes_per_sec
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, n: int):
+        if self.rate <= 0:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            if self.tokens < 0:
+                await asyncio.sleep(-self.tokens / self.rate)
+
+
+class _Segment:
+    def __init__(self, idx: int, start: int, end: Optional[int], done: int = 0):
+        self.idx = idx
+        self.start = start
+        self.end = end  # inclusive; None when the size is unknown
+        self.done = done
+        self.saved = done
+
+    @property
+    def length(self) -> Optional[int]:
+        return None if self.end is None else self.end - self.start + 1
+
+    @property
+    def complete(self) -> bool:
+        return self.length is not None and self.done >= self.length
+
+
+class _Download:
+    def __init__(self, row: Dict[str, Any], part_path: Path):
+        self.id = row["id"]
+        self.url = row["url"]
+        self.filename = row["filename"]
+        self.expected_sha256 = (row["expected_sha256"] or "").lower() or None
+        self.total = row["total"] or 0
+        self.max_bps = (row["max_mbps"] or 0) * 1024 * 1024
+        self.part_path = part_path
+        self.segments: List[_Segment] = []
+        self.hasher = hashlib.sha256()
+        self.hashed = 0
+        self.hash_wakeup = asyncio.Event()
+        self.finished = False  # No more data will be written
+        self.started_at = time.monotonic()
+        self.started_bytes = 0
+
+    def downloaded(self) -> int:
+        return sum(s.done for s in self.segments)
+
+    def contiguous(self) -> int:
+        """End of the prefix of the file that is fully written."""
+        end = 0
+        for s in self.segments:
+            end = s.start + s.done
+            if not s.complete:
+                break
+        return end
+
+
+class DownloadManager:
+    def __init__(self, db_path: Path, models_dir: Path,
+                 on_complete: Optional[Callable[[Path, str], Awaitable[Any]]] = None,
+                 connections: int = CONNECTIONS, segment_bytes: int = SEGMENT_BYTES,
+                 max_mbps: float = MAX_MBPS):
+        self.db_path = db_path
+        self.models_dir = Path(models_dir)
+        self.on_complete = on_complete
+        self.connections = connections
+        self.segment_bytes = segment_bytes
+        self.limiter = RateLimiter(max_mbps * 1024 * 1024)
+        self.active: Dict[str, _Download] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self._init_db()
+
+    # --- Persistence ---
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _init_db(self):
+        conn = self._connect()
+        cursor = conn.cursor()
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS model_downloads (
+            id TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            expected_sha256 TEXT,
+            sha256 TEXT,
+            max_mbps REAL,
+            total INTEGER,
+            status TEXT,
+            error TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+        ''')
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS model_download_segments (
+            task_id TEXT,
+            idx INTEGER,
+            start INTEGER,
+            end_byte INTEGER,
+            done INTEGER,
+            PRIMARY KEY (task_id, idx)
+        )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _update(self, task_id: str, **fields):
+        fields["updated_at"] = datetime.now().isoformat()
+        conn = self._connect()
+        conn.execute(f"UPDATE model_downloads SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                     (*fields.values(), task_id))
+        conn.commit()
+        conn.close()
+
+    def _save_segments(self, dl: _Download, segments: Optional[List[_Segment]] = None):
+        conn = self._connect()
+        conn.executemany("INSERT OR REPLACE INTO model_download_segments (task_id, idx, start, end_byte, done) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(dl.id, s.idx, s.start, s.end, s.done) for s in (segments or dl.segments)])
+        conn.commit()
+        conn.close()
+        for s in segments or dl.segments:
+            s.saved = s.done
+
+    def _load_segments(self, task_id: str) -> List[_Segment]:
+        conn = self._connect()
+        rows = conn.execute("SELECT idx, start, end_byte, done FROM model_download_segments "
+                            "WHERE task_id = ? ORDER BY idx", (task_id,)).fetchall()
+        conn.close()
+        return [_Segment(r["idx"], r["start"], r["end_byte"], r["done"]) for r in rows]
+
+    def _reset_segments(self, task_id: str):
+        conn = self._connect()
+        conn.execute("DELETE FROM model_download_segments WHERE task_id = ?", (task_id,))
+        conn.commit()
+        conn.close()
+
+    def _row(self, task_id: str) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        row = conn.execute("SELECT * FROM model_downloads WHERE id = ?", (task_id,)).fetchone()
+        conn.close()
+        return dict(row) if row else None
+
+    def _active_for(self, conn: sqlite3.Connection, filename: str, exclude: Optional[str] = None):
+        return conn.execute(f"SELECT id, url FROM model_downloads WHERE filename = ? AND id != ? "
+                            f"AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                            (filename, exclude or "", *ACTIVE_STATUSES)).fetchone()
+
+    # --- Public API ---
+
+    def start(self, url: str, filename: str, expected_sha256: Optional[str] = None,
+              max_mbps: Optional[float] = None) -> str:
+        """Start (or join an unfinished download of) `filename`; returns the task id."""
+        if not filename or os.path.basename(filename) != filename:
+            raise ValueError("Invalid filename")
+        conn = self._connect()
+        # One active download per file: two writers would interleave into the same .part
+        row = self._active_for(conn, filename)
+        if row and row["url"] != url:
+            conn.close()
+            raise ValueError(f"{filename} is already being downloaded from {row['url']}")
+        if row:
+            task_id = row["id"]
+        else:
+            task_id = str(uuid.uuid4())
+            now = datetime.now().isoformat()
+            conn.execute("INSERT INTO model_downloads (id, url, filename, expected_sha256, max_mbps, total, status, "
+                         "created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, 'queued', ?, ?)",
+                         (task_id, url, filename, expected_sha256, max_mbps, now, now))
+            conn.commit()
+        conn.close()
+        self._spawn(task_id)
+        return task_id
+
+    def resume_pending(self) -> List[str]:
+        """Restart downloads that were unfinished when the process stopped."""
+        conn = self._connect()
+        rows = conn.execute(f"SELECT id FROM model_downloads WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                            ACTIVE_STATUSES).fetchall()
+        conn.close()
+        for r in rows:
+            logger.info(f"Resuming model download {r['id']}")
+            self._spawn(r["id"])
+        return [r["id"] for r in rows]
+
+    def retry(self, task_id: str):
+        row = self._row(task_id)
+        if not row or row["status"] != "error":
+            raise ValueError("Only failed downloads can be retried")
+        conn = self._connect()
+        other = self._active_for(conn, row["filename"], exclude=task_id)
+        conn.close()
+        if other:
+            raise ValueError(f"{row['filename']} is already being downloaded by task {other['id']}")
+        self._update(task_id, status="queued", error=None)
+        self._spawn(task_id)
+
+    def status(self, task_id: str) -> Dict[str, Any]:
+        row = self._row(task_id)
+        if not row:
+            return {"status": "not_found"}
+        dl = self.active.get(task_id)
+        total = dl.total if dl else row["total"] or 0
+        if dl:
+            downloaded = dl.downloaded()
+        elif row["status"] == "completed":
+            downloaded = total
+        else:
+            downloaded = sum(s.done for s in self._load_segments(task_id))
+        status = {
+            "status": row["status"],
+            "filename": row["filename"],
+            "total": total,
+            "downloaded": downloaded,
+            "progress": int(downloaded / total * 100) if total else 0,
+            "sha256": row["sha256"],
+            "error": row["error"]
+        }
+        if dl:
+            elapsed = time.monotonic() - dl.started_at
+            status["mbps"] = round((downloaded - dl.started_bytes) / elapsed / 1024 / 1024, 1) if elapsed > 0 else 0
+        return status
+
+    async def shutdown(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+
+    # --- Download ---
+
+    def _spawn(self, task_id: str):
+        if task_id in self.tasks and not self.tasks[task_id].done():
+            return
+        self.tasks[task_id] = asyncio.get_running_loop().create_task(self._run(task_id))
+
+    async def _run(self, task_id: str):
+        row = self._row(task_id)
+        dl = _Download(row, self.models_dir / f"{row['filename']}.download")
+        self.active[task_id] = dl
+        try:
+            if row["status"] == "publishing":
+                # Interrupted after the file was moved into place: only publishing is left
+                target = self.models_dir / dl.filename
+                if not target.exists():
+                    raise DownloadError(f"{dl.filename} is missing; download it again")
+                await self._publish(task_id, target, row["sha256"], row["total"])
+                return
+            self._update(task_id, status="downloading", error=None)
+            async with httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=30.0), follow_redirects=True) as client:
+                await self._prepare(client, dl)
+                dl.started_bytes = dl.downloaded()
+                hashing = asyncio.create_task(self._hash(dl))
+                try:
+                    try:
+                        limiters = [self.limiter] + ([RateLimiter(dl.max_bps)] if dl.max_bps > 0 else [])
+                        pending: asyncio.Queue = asyncio.Queue()
+                        for s in dl.segments:
+                            if not s.complete:
+                                pending.put_nowait(s)
+                        workers = [asyncio.create_task(self._worker(client, dl, pending, limiters))
+                                   for _ in range(min(self.connections, pending.qsize()) or 1)]
+                        try:
+                            await asyncio.gather(*workers)
+                        except BaseException:
+                            for w in workers:
+                                w.cancel()
+                            await asyncio.gather(*workers, return_exceptions=True)
+                            raise
+                    finally:
+                        dl.finished = True
+                        dl.hash_wakeup.set()
+                        dl.total = dl.total or dl.downloaded()
+                    self._update(task_id, status="verifying")
+                    digest = await hashing
+                finally:
+                    # On failure or cancellation, stop reading the .part before a retry can reuse it
+                    if not hashing.done():
+                        hashing.cancel()
+                    await asyncio.gather(hashing, return_exceptions=True)
+            if dl.expected_sha256 and digest != dl.expected_sha256:
+                # The data on disk is wrong; start from scratch next time
+                dl.part_path.unlink(missing_ok=True)
+                self._reset_segments(task_id)
+                raise DownloadError(f"Checksum mismatch: expected {dl.expected_sha256}, got {digest}")
+
+            target = self.models_dir / dl.filename
+            os.replace(dl.part_path, target)
+            self._reset_segments(task_id)
+            await self._publish(task_id, target, digest, dl.total)
+        except asyncio.CancelledError:
+            if dl.segments:
+                self._save_segments(dl)  # Resume from here on the next start
+            raise
+        except Exception as e:
+            logger.error(f"Download of {dl.filename} failed: {e}")
+            if dl.segments:
+                self._save_segments(dl)
+            self._update(task_id, status="error", error=str(e))
+        finally:
+            self.active.pop(task_id, None)
+            self.tasks.pop(task_id, None)
+
+    async def _publish(self, task_id: str, target: Path, digest: str, total: int):
+        self._update(task_id, status="publishing", sha256=digest, total=total)
+        if self.on_complete:
+            await self.on_complete(target, digest)
+        self._update(task_id, status="completed")
+        logger.info(f"Downloaded {target.name} ({total} bytes, sha256 {digest[:12]})")
+
+    async def _probe(self, client: httpx.AsyncClient, url: str):
+        """Returns (total size or 0, whether byte ranges are supported)."""
+        async with client.stream("GET", url, headers={"Range": "bytes=0-0"}) as resp:
+            if resp.status_code == 206:
+                content_range = resp.headers.get("content-range", "")
+                total = content_range.rsplit("/", 1)[-1]
+                if total.isdigit():
+                    return int(total), True
+                return 0, False
+            if resp.status_code == 200:
+                return int(resp.headers.get("content-length", 0) or 0), False
+            raise DownloadError(f"HTTP {resp.status_code}")
+
+    async def _prepare(self, client: httpx.AsyncClient, dl: _Download):
+        total, ranges = await self._probe(client, dl.url)
+        segments = self._load_segments(dl.id)
+        if segments and (total != dl.total or not dl.part_path.exists()):
+            logger.info(f"Remote file or partial data changed, restarting download of {dl.filename}")
+            segments = []
+        if segments and not ranges and not all(s.complete for s in segments):
+            segments = []  # Can't continue a range without Range support
+        if not segments:
+            self._reset_segments(dl.id)
+            if ranges and total > 0:
+                segments = [_Segment(i, start, min(start + self.segment_bytes, total) - 1)
+                            for i, start in enumerate(range(0, total, self.segment_bytes))]
+            else:
+                segments = [_Segment(0, 0, total - 1 if total > 0 else None)]
+            with open(dl.part_path, "wb") as f:
+                if total > 0:
+                    f.truncate(total)
+        dl.total = total
+        dl.segments = segments
+        self._update(dl.id, total=total)
+        self._save_segments(dl)
+
+    async def _worker(self, client: httpx.AsyncClient, dl: _Download, pending: asyncio.Queue,
+                      limiters: List[RateLimiter]):
+        fd = os.open(dl.part_path, os.O_WRONLY)
+        try:
+            while not pending.empty():
+                seg = pending.get_nowait()
+                failures = 0
+                while not seg.complete:
+                    before = seg.done
+                    try:
+                        await self._fetch(client, dl, seg, fd, limiters)
+                        if seg.end is None:
+                            break  # Unknown size: the stream ending is the end of the file
+                    except (httpx.HTTPError, DownloadError) as e:
+                        failures = 0 if seg.done > before else failures + 1
+                        if failures > RETRIES:
+                            raise DownloadError(f"Range {seg.start}-{seg.end} failed: {e}")
+                        delay = min(2 ** failures, 30)
+                        logger.warning(f"{dl.filename}: range {seg.start}-{seg.end} interrupted ({e}), "
+                                       f"retrying in {delay}s")
+                        await asyncio.sleep(delay)
+                self._save_segments(dl, [seg])
+                dl.hash_wakeup.set()
+        finally:
+            os.close(fd)
+
+    async def _fetch(self, client: httpx.AsyncClient, dl: _Download, seg: _Segment, fd: int,
+                     limiters: List[RateLimiter]):
+        offset = seg.start + seg.done
+        headers = {}
+        if offset > 0 or seg.end is not None:
+            headers["Range"] = f"bytes={offset}-{'' if seg.end is None else seg.end}"
+        async with client.stream("GET", dl.url, headers=headers) as resp:
+            if resp.status_code == 200 and offset > 0:
+                raise DownloadError("Server ignored the Range request")
+            if resp.status_code not in (200, 206):
+                raise DownloadError(f"HTTP {resp.status_code}")
+            async for chunk in resp.aiter_bytes():  # Unbuffered, so bytes received before a drop are kept
+                if seg.length is not None:
+                    chunk = chunk[:seg.length - seg.done]
+                for limiter in limiters:
+                    await limiter.consume(len(chunk))
+                os.pwrite(fd, chunk, seg.start + seg.done)
+                seg.done += len(chunk)
+                if seg.done - seg.saved >= CHECKPOINT_BYTES:
+                    self._save_segments(dl, [seg])
+                    dl.hash_wakeup.set()
+                if seg.complete:
+                    break
+
+    async def _hash(self, dl: _Download) -> str:
+        """Hash the file in order as its contiguous prefix grows; returns the hex digest."""
+        loop = asyncio.get_running_loop()
+        stop = threading.Event()
+        with open(dl.part_path, "rb") as f:
+            def catch_up(end: int):
+                while dl.hashed < end and not stop.is_set():
+                    block = os.pread(f.fileno(), min(READ_CHUNK * 8, end - dl.hashed), dl.hashed)
+                    if not block:
+                        break
+                    dl.hasher.update(block)
+                    dl.hashed += len(block)
+
+            while True:
+                await dl.hash_wakeup.wait()
+                dl.hash_wakeup.clear()
+                finished = dl.finished
+                reading = loop.run_in_executor(None, catch_up, dl.contiguous())
+                try:
+                    await asyncio.shield(reading)
+                except asyncio.CancelledError:
+                    # The executor thread can't be cancelled: stop it and wait before closing the file
+                    stop.set()
+                    await asyncio.gather(reading, return_exceptions=True)
+                    raise
+                if finished:
+                    return dl.hasher.hexdigest()
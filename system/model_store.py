@@ -0,0 +1,420 @@
+"""Model file resolution and page-cache handling shared by all processes.
+
+GGUF weights are memory-mapped by default, so every process that loads the
+same file shares its physical pages through the page cache. That only works
+if they open the same file, so paths are first resolved to one canonical file.
+
+Model files are stored once, content-addressed by sha256, under
+models/.store/blobs/<sha256>/<name>. Each user's model directory
+(models/users/<username>) is a view of hardlinks into the blob store,
+falling back to reflinks and then relative symlinks where hardlinks are not
+possible. Which blob each view entry points at, and the sha256 of every file
+already hashed, are recorded in models/.store/manifest.db.
+"""
+import os
+import time
+import shutil
+import sqlite3
+import fnmatch
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Union
+
+logger = logging.getLogger("model-store")
+
+BASE_DIR = Path(__file__).parent.absolute()
+MODELS_DIR = BASE_DIR / "models"
+
+# MODEL_USE_MMAP=0 restores private-heap loading (e.g. for filesystems without mmap support)
+USE_MMAP = os.environ.get("MODEL_USE_MMAP", "1") != "0"
+# Comma-separated filename patterns of hot models to lock in RAM, e.g. "nomic-embed-*,qwen2-1.5b-*"
+PIN_PATTERNS = [p.strip() for p in os.environ.get("MODEL_PIN", "").split(",") if p.strip()]
+
+
+def canonical_model_path(model_path: Union[str, Path]) -> str:
+    """Resolve a model path to the one file every process should open.
+
+    Symlinks are resolved and files known to the blob store map to their blob.
+    Otherwise a copy that matches the file of the same name in MODELS_DIR
+    (same size and mtime, as left by copytree/copy2) maps to the MODELS_DIR
+    file.
+    """
+    real = os.path.realpath(str(model_path))
+    blob = _known_blob(real)
+    if blob:
+        return blob
+    shared = MODELS_DIR / os.path.basename(real)
+    if str(shared) == real:
+        return real
+    try:
+        st, shared_st = os.stat(real), os.stat(shared)
+    except OSError:
+        return real
+    if (st.st_dev, st.st_ino) == (shared_st.st_dev, shared_st.st_ino):
+        return str(shared)
+    if st.st_size == shared_st.st_size and int(st.st_mtime) == int(shared_st.st_mtime):
+        return str(shared)
+    return real
+
+
+def should_pin(model_path: Union[str, Path]) -> bool:
+    name = os.path.basename(str(model_path))
+    return any(fnmatch.fnmatch(name, pattern) for pattern in PIN_PATTERNS)
+
+
+def llama_memory_kwargs(model_path: Union[str, Path]) -> Dict[str, Any]:
+    """mmap/mlock arguments for `Llama(...)`."""
+    return {"use_mmap": USE_MMAP, "use_mlock": USE_MMAP and should_pin(model_path)}
+
+
+def warm_page_cache(model_path: Union[str, Path]):
+    """Pull a model file into the page cache ahead of its first load."""
+    path = str(model_path)
+    try:
+        with open(path, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                while f.read(8 * 1024 * 1024):
+                    pass
+        logger.info(f"Page cache warmed: {path}")
+    except OSError as e:
+        logger.warning(f"Could not warm page cache for {path}: {e}")
+
+
+def pinned_models() -> List[Path]:
+    if not PIN_PATTERNS or not MODELS_DIR.exists():
+        return []
+    return [p for p in sorted(MODELS_DIR.glob("*.gguf")) if should_pin(p)]
+
+
+# --- Content-addressed blob store ---
+
+STORE_DIR = MODELS_DIR / ".store"
+BLOBS_DIR = STORE_DIR / "blobs"
+MANIFEST_DB = STORE_DIR / "manifest.db"
+USER_VIEWS_DIR = MODELS_DIR / "users"
+
+FICLONE = 0x40049409  # Linux ioctl: share extents with another file (btrfs, XFS, ...)
+
+_store_lock = threading.RLock()
+
+
+def _db() -> sqlite3.Connection:
+    STORE_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(MANIFEST_DB, timeout=30)
+    conn.execute("CREATE TABLE IF NOT EXISTS blobs (sha256 TEXT PRIMARY KEY, name TEXT, size INTEGER, created_at REAL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, mtime_ns INTEGER)")
+    conn.execute("CREATE TABLE IF NOT EXISTS views (username TEXT, name TEXT, sha256 TEXT, PRIMARY KEY (username, name))")
+    return conn
+
+
+def _blob_path(conn: sqlite3.Connection, sha256: str) -> Optional[Path]:
+    row = conn.execute("SELECT name FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()
+    return BLOBS_DIR / sha256 / row[0] if row else None
+
+
+def _known_blob(real: str) -> Optional[str]:
+    """Blob for a file that is (a link to) a stored blob or was hashed before; no hashing here."""
+    if not MANIFEST_DB.exists():
+        return None
+    try:
+        st = os.stat(real)
+        conn = sqlite3.connect(MANIFEST_DB, timeout=30)
+        try:
+            row = conn.execute("SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                               (real, st.st_size, st.st_mtime_ns)).fetchone()
+            candidates = [row[0]] if row else [
+                sha for (sha,) in conn.execute("SELECT sha256 FROM blobs WHERE size = ?", (st.st_size,))]
+            for sha in candidates:
+                blob = _blob_path(conn, sha)
+                if blob and blob.exists() and (row or os.path.samefile(real, blob)):
+                    return str(blob)
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error):
+        pass
+    return None
+
+
+def known_sha256(path: Union[str, Path]) -> Optional[str]:
+    """sha256 of a file if it was hashed before or is a link to a blob, else None; never reads it."""
+    if not MANIFEST_DB.exists():
+        return None
+    path = os.path.realpath(str(path))
+    try:
+        st = os.stat(path)
+        conn = sqlite3.connect(MANIFEST_DB, timeout=30)
+        try:
+            row = conn.execute("SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                               (path, st.st_size, st.st_mtime_ns)).fetchone()
+            if row:
+                return row[0]
+            for (sha,) in conn.execute("SELECT sha256 FROM blobs WHERE size = ?", (st.st_size,)).fetchall():
+                blob = _blob_path(conn, sha)
+                if blob and blob.exists() and os.path.samefile(path, blob):
+                    return sha
+        finally:
+            conn.close()
+    except (OSError, sqlite3.Error):
+        pass
+    return None
+
+
+def file_sha256(path: Union[str, Path]) -> str:
+    """sha256 of a file, remembered per (path, size, mtime) so unchanged files are hashed once."""
+    path = os.path.realpath(str(path))
+    st = os.stat(path)
+    conn = _db()
+    try:
+        row = conn.execute("SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                           (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        # A link to a stored blob (e.g. after a `touch`, which changes the shared inode's mtime)
+        # has the blob's content: no need to read it
+        for (sha,) in conn.execute("SELECT sha256 FROM blobs WHERE size = ?", (st.st_size,)).fetchall():
+            blob = _blob_path(conn, sha)
+            if blob and blob.exists() and os.path.samefile(path, blob):
+                _remember(conn, path, sha)
+                conn.commit()
+                return sha
+        logger.info(f"Hashing {path}...")
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+                h.update(block)
+        sha256 = h.hexdigest()
+        _remember(conn, path, sha256)
+        conn.commit()
+        return sha256
+    finally:
+        conn.close()
+
+
+def _remember(conn: sqlite3.Connection, path: Union[str, Path], sha256: str):
+    path = os.path.realpath(str(path))
+    st = os.stat(path)
+    conn.execute("INSERT OR REPLACE INTO files (path, sha256, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                 (path, sha256, st.st_size, st.st_mtime_ns))
+
+
+def _reflink(src: Path, dst: Path):
+    import fcntl
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _link(src: Path, dst: Path, allow_symlink: bool = True) -> str:
+    """Make `dst` the same content as `src` without copying where possible.
+
+    Tries a hardlink, then a reflink, then (for views) a relative symlink,
+    which also works across bind mounts. Blobs themselves must be real files
+    and fall back to a copy instead.
+    """
+    part = dst.with_name(dst.name + ".part")
+    part.unlink(missing_ok=True)
+    try:
+        os.link(src, part)
+        how = "hardlink"
+    except OSError:
+        try:
+            _reflink(src, part)
+            how = "reflink"
+        except (OSError, ImportError):
+            part.unlink(missing_ok=True)
+            if allow_symlink:
+                os.symlink(os.path.relpath(src, dst.parent), part)
+                how = "symlink"
+            else:
+                shutil.copy2(src, part)
+                how = "copy"
+    os.replace(part, dst)
+    return how
+
+
+def ingest(path: Union[str, Path], sha256: Optional[str] = None) -> str:
+    """Store a model file as a blob and return its sha256.
+
+    If the blob already exists, `path` is replaced by a link to it, so
+    duplicate content only occupies disk once.
+    """
+    path = Path(path)
+    sha256 = sha256 or file_sha256(path)
+    with _store_lock:
+        conn = _db()
+        try:
+            blob = _blob_path(conn, sha256)
+            if blob and blob.exists() and os.path.samefile(path, blob):
+                return sha256  # Already stored and linked; nothing to write
+            if blob and blob.exists():
+                if not os.path.samefile(path, blob):
+                    _link(blob, path, allow_symlink=False)
+            else:
+                blob = BLOBS_DIR / sha256 / path.name
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                how = _link(path, blob, allow_symlink=False)
+                if how == "copy":
+                    _link(blob, path, allow_symlink=False)  # Make the source share the blob where possible
+                conn.execute("INSERT OR REPLACE INTO blobs (sha256, name, size, created_at) VALUES (?, ?, ?, ?)",
+                             (sha256, blob.name, blob.stat().st_size, time.time()))
+                logger.info(f"Stored blob {sha256[:12]} ({blob.name})")
+            _remember(conn, path, sha256)
+            conn.commit()
+        finally:
+            conn.close()
+    return sha256
+
+
+def _add_to_view(conn: sqlite3.Connection, username: str, name: str, sha256: str):
+    view = USER_VIEWS_DIR / username
+    dst = view / name
+    blob = _blob_path(conn, sha256)
+    if not (dst.exists() and os.path.samefile(dst, blob)):
+        view.mkdir(parents=True, exist_ok=True)
+        _link(blob, dst)
+        if not dst.is_symlink():
+            _remember(conn, dst, sha256)
+    conn.execute("INSERT OR REPLACE INTO views (username, name, sha256) VALUES (?, ?, ?)", (username, name, sha256))
+
+
+def known_shared_models() -> Dict[str, str]:
+    """{filename: sha256} of the models in MODELS_DIR the store already knows; no hashing or writes."""
+    shared = {}
+    for p in sorted(MODELS_DIR.glob("*.gguf")):
+        blob = _known_blob(os.path.realpath(p))
+        if blob:
+            shared[p.name] = Path(blob).parent.name
+    return shared
+
+
+def sync_shared_models() -> Dict[str, str]:
+    """Ingest every model in MODELS_DIR; returns {filename: sha256}.
+
+    Reads (and may hash) every model file: run it at startup, after
+    downloads and for new users, not per request.
+    """
+    shared = {}
+    for p in sorted(MODELS_DIR.glob("*.gguf")):
+        try:
+            shared[p.name] = ingest(p)
+        except OSError as e:
+            logger.error(f"Could not store {p.name}: {e}")
+    return shared
+
+
+def ensure_user_view(username: str, shared: Optional[Dict[str, str]] = None) -> Path:
+    """Create or update a user's model directory as a view of the blob store.
+
+    A legacy per-user copy (models_<username>, from before the blob store) is
+    ingested, so models only that user had are kept, and then removed.
+    Without `shared`, the view gets the shared models the store already knows.
+    """
+    view = USER_VIEWS_DIR / username
+    view.mkdir(parents=True, exist_ok=True)
+    shared = known_shared_models() if shared is None else shared
+    legacy = BASE_DIR / f"models_{username}"
+    with _store_lock:
+        if legacy.is_symlink() or (legacy.exists() and not legacy.is_dir()):
+            legacy.unlink()
+        elif legacy.is_dir():
+            logger.info(f"Migrating {legacy.name} into the blob store...")
+            migrated = True
+            for p in sorted(legacy.glob("*.gguf")):
+                try:
+                    sha256 = ingest(p)
+                    conn = _db()
+                    try:
+                        _add_to_view(conn, username, p.name, sha256)
+                        conn.commit()
+                    finally:
+                        conn.close()
+                except OSError as e:
+                    migrated = False
+                    logger.error(f"Could not migrate {p}: {e}")
+            if migrated:
+                shutil.rmtree(legacy)
+        conn = _db()
+        try:
+            for name, sha256 in shared.items():
+                _add_to_view(conn, username, name, sha256)
+            conn.commit()
+        finally:
+            conn.close()
+    return view
+
+
+def publish_model(path: Union[str, Path], sha256: Optional[str] = None) -> str:
+    """Ingest a new model in MODELS_DIR and link it into every user view."""
+    path = Path(path)
+    sha256 = ingest(path, sha256)
+    with _store_lock:
+        conn = _db()
+        try:
+            for view in sorted(USER_VIEWS_DIR.glob("*")) if USER_VIEWS_DIR.exists() else []:
+                if view.is_dir():
+                    try:
+                        _add_to_view(conn, view.name, path.name, sha256)
+                    except OSError as e:
+                        logger.error(f"Failed to link {path.name} into {view.name}'s models: {e}")
+            conn.commit()
+        finally:
+            conn.close()
+    return sha256
+
+
+def remove_user_view(username: str):
+    """Delete a user's model directory and any blobs nothing else refers to."""
+    with _store_lock:
+        for d in (USER_VIEWS_DIR / username, BASE_DIR / f"models_{username}"):
+            if d.is_symlink():
+                d.unlink()
+            elif d.exists():
+                shutil.rmtree(d)
+        conn = _db()
+        try:
+            conn.execute("DELETE FROM views WHERE username = ?", (username,))
+            conn.commit()
+        finally:
+            conn.close()
+    collect_garbage()
+
+
+def collect_garbage() -> int:
+    """Remove blobs that no view and no file in MODELS_DIR refers to; returns bytes freed."""
+    freed = 0
+    with _store_lock:
+        conn = _db()
+        try:
+            in_views = {sha for (sha,) in conn.execute("SELECT DISTINCT sha256 FROM views")}
+            for sha256, name in conn.execute("SELECT sha256, name FROM blobs").fetchall():
+                blob = BLOBS_DIR / sha256 / name
+                try:
+                    st = blob.stat()
+                except OSError:
+                    conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                    continue
+                # Hardlinks from MODELS_DIR or views show up in the link count
+                if sha256 in in_views or st.st_nlink > 1:
+                    continue
+                shutil.rmtree(blob.parent)
+                conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+                freed += st.st_size
+                logger.info(f"Removed unreferenced blob {sha256[:12]} ({name})")
+            conn.execute("DELETE FROM files WHERE sha256 NOT IN (SELECT sha256 FROM blobs)")
+            conn.commit()
+        finally:
+            conn.close()
+    return freed
+
+
+def store_status() -> Dict[str, Any]:
+    conn = _db()
+    try:
+        blobs = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM blobs").fetchone()
+        views = conn.execute("SELECT COUNT(DISTINCT username), COUNT(*) FROM views").fetchone()
+    finally:
+        conn.close()
+    return {"blobs": blobs[0], "blob_mb": round(blobs[1] / 1024 / 1024), "users": views[0], "view_entries": views[1]}
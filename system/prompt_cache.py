@@ -0,0 +1,322 @@
+"""Prompt-prefix KV cache for local chat models.
+
+llama-cpp-python consults `Llama.cache` before every completion: it looks up
+the saved state whose tokens share the longest prefix with the new prompt,
+restores it, and only evaluates the tokens after the shared prefix. After a
+completion it stores the new state. Chat requests all start with the same
+system prompt (and the agent with its tool schema), so with a warm cache
+time-to-first-token depends on the new suffix only.
+
+Each model gets its own `PrefixCache`: a RAM tier bounded by bytes, spilling
+least-recently-used states to a disk tier under cache/prompt/<model>/ that
+is bounded too and survives restarts.
+"""
+import os
+import json
+import pickle
+import hashlib
+import time
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Sequence, Tuple, Dict, Any
+
+from llama_context import context_tokens, eval_in_slices
+
+logger = logging.getLogger("prompt-cache")
+
+BASE_DIR = Path(__file__).parent.absolute()
+PROMPT_CACHE_ENABLED = os.environ.get("PROMPT_CACHE", "1") != "0"
+PROMPT_CACHE_DIR = Path(os.environ.get("PROMPT_CACHE_DIR", str(BASE_DIR / "cache" / "prompt")))
+PROMPT_CACHE_RAM_BYTES = int(os.environ.get("PROMPT_CACHE_RAM_MB", "512")) * 1024 * 1024
+PROMPT_CACHE_DISK_BYTES = int(os.environ.get("PROMPT_CACHE_DISK_MB", "4096")) * 1024 * 1024
+
+
+def _common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+def _tokens_hash(tokens: Tuple[int, ...]) -> str:
+    return hashlib.sha256(json.dumps(tokens).encode("ascii")).hexdigest()[:32]
+
+
+class PrefixCache:
+    """Two-tier (RAM, then disk) LRU cache of llama.cpp states keyed by token prefix.
+
+    Implements the interface of llama-cpp-python's BaseLlamaCache, which
+    `Llama.set_cache` doesn't check for; not subclassing it keeps llama_cpp
+    out of this module's imports.
+    """
+
+    def __init__(self, cache_dir: Path, ram_bytes: int = PROMPT_CACHE_RAM_BYTES,
+                 disk_bytes: int = PROMPT_CACHE_DISK_BYTES, n_ctx: Optional[int] = None):
+        self.n_ctx = n_ctx  # States holding more tokens than the model's context can't be loaded
+        self.capacity_bytes = ram_bytes
+        self.disk_bytes = disk_bytes
+        self.cache_dir = Path(cache_dir)
+        self.ram: "OrderedDict[Tuple[int, ...], Any]" = OrderedDict()
+        self.disk: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # hash -> {"tokens", "size"}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load_disk_index()
+
+    # --- llama-cpp-python cache interface ---
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self.ram.values())
+
+    def _find_longest_prefix_key(self, key: Tuple[int, ...]) -> Optional[Tuple[int, ...]]:
+        best, best_len = None, 0
+        for tokens in list(self.ram.keys()) + [tuple(e["tokens"]) for e in self.disk.values()]:
+            n = _common_prefix_len(tokens, key)
+            if n > best_len:
+                best, best_len = tokens, n
+        return best
+
+    def __getitem__(self, key: Sequence[int]):
+        key = tuple(key)
+        with self.lock:
+            best = self._find_longest_prefix_key(key)
+            if best is None:
+                self.misses += 1
+                raise KeyError("No cached prefix")
+            if best in self.ram:
+                self.ram.move_to_end(best)
+                state = self.ram[best]
+            else:
+                state = self._read_disk(_tokens_hash(best))
+                if state is None:
+                    self.misses += 1
+                    raise KeyError("Cached prefix unreadable")
+                self._put_ram(best, state)
+            # llama-cpp-python only treats KeyError as a miss; anything load_state would reject fails the completion
+            if self.n_ctx and getattr(state, "n_tokens", 0) > self.n_ctx:
+                self.misses += 1
+                raise KeyError("Cached prefix longer than the model's context")
+            self.hits += 1
+            return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self.lock:
+            return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key: Sequence[int], value):
+        with self.lock:
+            self._put_ram(tuple(key), value)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "ram_entries": len(self.ram),
+                "ram_mb": round(self.cache_size / 1024 / 1024),
+                "disk_entries": len(self.disk),
+                "disk_mb": round(sum(e["size"] for e in self.disk.values()) / 1024 / 1024),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    # --- Tiers ---
+
+    def _put_ram(self, key: Tuple[int, ...], state):
+        self.ram[key] = state
+        self.ram.move_to_end(key)
+        while self.ram and self.cache_size > self.capacity_bytes:
+            old_key, old_state = self.ram.popitem(last=False)
+            self._spill(old_key, old_state)
+
+    def _spill(self, key: Tuple[int, ...], state):
+        if self.disk_bytes <= 0:
+            return
+        h = _tokens_hash(key)
+        if h in self.disk:
+            self.disk.move_to_end(h)
+            return
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            path = self.cache_dir / f"{h}.state"
+            with open(path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            self.disk[h] = {"tokens": list(key), "size": path.stat().st_size}
+        except Exception as e:
+            logger.warning(f"Could not spill prompt cache entry to disk: {e}")
+            return
+        while self.disk and sum(e["size"] for e in self.disk.values()) > self.disk_bytes:
+            old, _ = self.disk.popitem(last=False)
+            (self.cache_dir / f"{old}.state").unlink(missing_ok=True)
+        self._save_disk_index()
+
+    def _read_disk(self, h: str):
+        try:
+            with open(self.cache_dir / f"{h}.state", "rb") as f:
+                state = pickle.load(f)
+            self.disk.move_to_end(h)
+            return state
+        except Exception as e:
+            logger.warning(f"Dropping unreadable prompt cache entry {h}: {e}")
+            self.disk.pop(h, None)
+            self._save_disk_index()
+            return None
+
+    def _load_disk_index(self):
+        index_path = self.cache_dir / "index.json"
+        try:
+            entries = json.loads(index_path.read_text())
+        except (OSError, ValueError):
+            return
+        for h, entry in entries:
+            if (self.cache_dir / f"{h}.state").exists():
+                self.disk[h] = entry
+
+    def _save_disk_index(self):
+        try:
+            tmp = self.cache_dir / "index.json.tmp"
+            tmp.write_text(json.dumps(list(self.disk.items())))
+            os.replace(tmp, self.cache_dir / "index.json")
+        except OSError as e:
+            logger.warning(f"Could not write prompt cache index: {e}")
+
+
+def attach_prompt_cache(llm, model_path: str):
+    """Give a freshly loaded chat model its own prefix cache."""
+    if not PROMPT_CACHE_ENABLED or not hasattr(llm, "set_cache"):
+        return llm
+    # Saved states are only valid for the exact weights and context layout they were computed
+    # with; the same file is loaded with a smaller n_ctx when the RAM budget is tight
+    st = os.stat(model_path)
+    n_ctx = llm.n_ctx() if callable(getattr(llm, "n_ctx", None)) else None
+    context = getattr(llm, "context_params", None)
+    layout = (n_ctx, getattr(llm, "n_batch", None),
+              getattr(context, "type_k", None), getattr(context, "type_v", None))
+    model_key = hashlib.sha256(f"{model_path}:{st.st_size}:{int(st.st_mtime)}:{layout}".encode()).hexdigest()[:8]
+    cache_dir = PROMPT_CACHE_DIR / f"{os.path.basename(model_path)}-{model_key}"
+    llm.set_cache(PrefixCache(cache_dir, n_ctx=n_ctx))
+    return llm
+
+
+# --- Per-session snapshots ---
+
+SESSION_KV_MAX_BYTES = int(os.environ.get("SESSION_KV_MAX_MB", "1024")) * 1024 * 1024
+SESSION_KV_TTL_SECONDS = int(os.environ.get("SESSION_KV_TTL_SECONDS", "1800"))
+
+
+class SessionStateStore:
+    """The KV state each chat session ended its last turn with, per model.
+
+    Restoring it before the next turn lets llama.cpp keep every token up to the
+    first difference from the new prompt (normally: the whole previous
+    conversation) and prefill only the new message. If the prompt changed
+    earlier than that (new summary, different RAG context) llama.cpp simply
+    re-evaluates from the first differing token. Snapshots are dropped after
+    SESSION_KV_TTL_SECONDS and least recently used first beyond
+    SESSION_KV_MAX_MB.
+    """
+
+    def __init__(self, max_bytes: int = SESSION_KV_MAX_BYTES, ttl: int = SESSION_KV_TTL_SECONDS):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.states: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def size_bytes(self) -> int:
+        return sum(state.llama_state_size for _, state in self.states.values())
+
+    def _evict(self):
+        now = time.monotonic()
+        for key, (saved_at, _) in list(self.states.items()):
+            if now - saved_at > self.ttl:
+                del self.states[key]
+        while self.states and self.size_bytes() > self.max_bytes:
+            self.states.popitem(last=False)
+
+    def restore(self, llm, model_path: str, session_id: str) -> bool:
+        with self.lock:
+            self._evict()
+            entry = self.states.get((model_path, session_id))
+            if entry:
+                self.states.move_to_end((model_path, session_id))
+        if not entry:
+            return False
+        state = entry[1]
+        # Nothing to do if the context already continues this session's last turn
+        current, saved = context_tokens(llm), [int(t) for t in state.input_ids]
+        if current[:len(saved)] == saved:
+            return True
+        try:
+            llm.load_state(state)
+            return True
+        except Exception as e:
+            logger.warning(f"Could not restore session state for {session_id}: {e}")
+            self.drop(session_id)
+            return False
+
+    def snapshot(self, llm, model_path: str, session_id: str):
+        try:
+            state = llm.save_state()
+        except Exception as e:
+            logger.warning(f"Could not snapshot session state for {session_id}: {e}")
+            return
+        with self.lock:
+            self.states[(model_path, session_id)] = (time.monotonic(), state)
+            self.states.move_to_end((model_path, session_id))
+            self._evict()
+
+    def drop(self, session_id: str):
+        with self.lock:
+            for key in [k for k in self.states if k[1] == session_id]:
+                del self.states[key]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"sessions": len(self.states), "mb": round(self.size_bytes() / 1024 / 1024)}
+
+
+session_states = SessionStateStore()
+
+
+class _PrefillCancelled(Exception):
+    pass
+
+
+def _cancellable_eval(llm, cancel: threading.Event):
+    """`llm.eval` that checks `cancel` between n_batch slices of a long prompt."""
+    evaluate = llm.eval
+
+    def eval(tokens):
+        if not eval_in_slices(llm, tokens, cancel.is_set, evaluate=evaluate):
+            raise _PrefillCancelled()
+    return eval
+
+
+def session_chat_stream(llm, model_path: str, session_id: Optional[str],
+                        cancel: Optional[threading.Event] = None, **kwargs):
+    """`create_chat_completion(stream=True)` that resumes from, and then saves, the session's KV state.
+
+    Restore, generation and snapshot run back to back on the consuming
+    thread, so the snapshot is the state this generation left behind.
+    Setting `cancel` during prefill ends the stream after the current batch.
+    """
+    local = session_id and hasattr(llm, "save_state")
+    if local:
+        session_states.restore(llm, model_path, session_id)
+    interruptible = cancel is not None and hasattr(llm, "eval") and hasattr(llm, "n_batch")
+    if interruptible:
+        llm.eval = _cancellable_eval(llm, cancel)  # Instance attribute; the leased model is ours alone
+    try:
+        for chunk in llm.create_chat_completion(stream=True, **kwargs):
+            yield chunk
+    except _PrefillCancelled:
+        return
+    finally:
+        if interruptible:
+            del llm.eval
+    # Only reached when the stream ran to completion
+    if local:
+        session_states.snapshot(llm, model_path, session_id)
@@ -0,0 +1,216 @@
+"""Opt-in speculative decoding for local chat models.
+
+A cheap drafter proposes the next few tokens and the target model checks
+them all in one batched forward pass; llama-cpp-python keeps the proposals
+that match what the target samples and discards the rest. The target
+decides every token, so the output is what it would have generated anyway
+(token for token with greedy sampling). Speed-up depends on the acceptance
+rate, which is tracked per target model.
+
+Configured per target model in SPECULATIVE_DECODING, comma-separated
+`target=drafter[:n]` entries. Targets are filename patterns. The drafter is
+a GGUF filename in models/ that uses the same vocabulary as the target, or
+`lookup` for prompt-lookup decoding. Prompt lookup copies continuations of
+n-grams found earlier in the prompt, which suits RAG answers that quote
+their context. `n` is the number of tokens drafted per step. Example:
+
+    SPECULATIVE_DECODING="qwen2.5-3b-instruct-*=qwen2-1.5b-instruct-q8_0.gguf:6,*-7b-*=lookup:10"
+"""
+import os
+import fnmatch
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional, Tuple, Union
+
+from model_store import MODELS_DIR, canonical_model_path, llama_memory_kwargs
+from gguf_metadata import model_info, runtime_params, kv_bytes_per_token
+from lazy_import import lazy, available
+from llama_context import keep_prefix
+
+# Drafters implement llama_speculative.LlamaDraftModel's interface (a callable), which
+# Llama doesn't type-check, so neither module is imported until a drafter is built
+np = lazy("numpy")
+llama_speculative = lazy("llama_cpp.llama_speculative")
+
+logger = logging.getLogger("speculative")
+
+LOOKUP = "lookup"
+DEFAULT_DRAFT_TOKENS = {LOOKUP: 10}
+DEFAULT_MODEL_DRAFT_TOKENS = 6
+
+
+def _parse_config(value: str) -> Dict[str, Tuple[str, Optional[int]]]:
+    config = {}
+    for entry in value.split(","):
+        target, sep, drafter = entry.strip().partition("=")
+        if not sep or not target or not drafter:
+            continue
+        name, _, n = drafter.strip().partition(":")
+        config[target.strip()] = (name, int(n) if n.isdigit() else None)
+    return config
+
+
+SPECULATIVE_CONFIG = _parse_config(os.environ.get("SPECULATIVE_DECODING", ""))
+
+
+def draft_config(model_path: Union[str, Path]) -> Optional[Tuple[str, int]]:
+    """(drafter, draft length) configured for a target model, or None."""
+    name = os.path.basename(str(model_path))
+    for pattern, (drafter, n) in SPECULATIVE_CONFIG.items():
+        if fnmatch.fnmatch(name, pattern):
+            default = DEFAULT_DRAFT_TOKENS.get(drafter, DEFAULT_MODEL_DRAFT_TOKENS)
+            return drafter, n or default
+    return None
+
+
+class AcceptanceStats:
+    """Counts how many drafted tokens the target accepted.
+
+    llama-cpp-python calls the drafter with the tokens so far after every
+    verification step, so the proposals of the previous call that reappear
+    right after the previous input are the accepted ones.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.proposed = 0
+        self.accepted = 0
+        self.steps = 0
+        self._last_len = 0
+        self._last_draft: list = []
+
+    def record(self, input_ids, draft):
+        with self.lock:
+            if self._last_draft and len(input_ids) > self._last_len:
+                added = list(input_ids[self._last_len:self._last_len + len(self._last_draft)])
+                n = 0
+                for a, b in zip(added, self._last_draft):
+                    if int(a) != int(b):
+                        break
+                    n += 1
+                self.accepted += n
+            self._last_len = len(input_ids)
+            self._last_draft = [int(t) for t in draft]
+            self.proposed += len(self._last_draft)
+            self.steps += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "steps": self.steps,
+                "proposed": self.proposed,
+                "accepted": self.accepted,
+                "acceptance_rate": round(self.accepted / self.proposed, 3) if self.proposed else None
+            }
+
+
+class PromptLookupDrafter:
+    def __init__(self, num_pred_tokens: int):
+        self.lookup = llama_speculative.LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens)
+        self.acceptance = AcceptanceStats()
+        self.kind = LOOKUP
+
+    def __call__(self, input_ids, **kwargs):
+        draft = self.lookup(input_ids, **kwargs)
+        self.acceptance.record(input_ids, draft)
+        return draft
+
+    def close(self):
+        pass
+
+
+class ModelDrafter:
+    """Greedy drafts from a small model sharing the target's vocabulary.
+
+    The draft context follows the target's token sequence: on each call it
+    keeps the KV cache for the common prefix and evaluates only new tokens.
+    """
+
+    def __init__(self, draft_path: str, num_pred_tokens: int, n_ctx: int):
+        from llama_cpp import Llama
+        params = runtime_params(draft_path, "chat")
+        params.update(n_ctx=n_ctx, n_gpu_layers=0)  # Drafting is memory-bound; keep VRAM for the target
+        self.llm = Llama(model_path=draft_path, verbose=False, **params, **llama_memory_kwargs(draft_path))
+        self.num_pred_tokens = num_pred_tokens
+        self.acceptance = AcceptanceStats()
+        self.kind = os.path.basename(draft_path)
+
+    def __call__(self, input_ids, **kwargs):
+        llm = self.llm
+        input_ids = [int(t) for t in input_ids]
+        # Re-evaluate at least one token for fresh logits
+        prefix = keep_prefix(llm, input_ids, min_new=1)
+        budget = llm.n_ctx() - len(input_ids)
+        llm.eval(input_ids[prefix:])
+        draft = []
+        for _ in range(min(self.num_pred_tokens, budget)):
+            token = int(np.argmax(llm.scores[llm.n_tokens - 1]))
+            if token == llm.token_eos():
+                break
+            draft.append(token)
+            llm.eval([token])
+        draft = np.array(draft, dtype=np.intc)
+        self.acceptance.record(input_ids, draft)
+        return draft
+
+    def close(self):
+        close = getattr(self.llm, "close", None)
+        if close:
+            close()
+
+
+def draft_model_path(name: str) -> str:
+    path = Path(name) if os.path.isabs(name) else MODELS_DIR / name
+    return canonical_model_path(path)
+
+
+def draft_bytes(model_path: Union[str, Path], n_ctx: int, default_kv_bytes: int) -> int:
+    """Extra resident memory a target's draft model needs at `n_ctx` (0 for prompt lookup).
+
+    The draft model runs with the target's context, so its KV cache is
+    counted along with its weights.
+    """
+    config = draft_config(model_path)
+    if not config or config[0] == LOOKUP:
+        return 0
+    path = draft_model_path(config[0])
+    try:
+        weights = os.path.getsize(path)
+    except OSError:
+        return 0
+    return weights + n_ctx * kv_bytes_per_token(path, default_kv_bytes)
+
+
+def create_drafter(model_path: Union[str, Path], n_ctx: int) -> Optional[Union[PromptLookupDrafter, ModelDrafter]]:
+    """The drafter to pass as `Llama(draft_model=...)` for a target, if one is configured."""
+    config = draft_config(model_path)
+    if not config:
+        return None
+    if not available("llama_cpp.llama_speculative"):
+        logger.warning("Speculative decoding needs a llama-cpp-python with llama_speculative; disabled")
+        return None
+    drafter, n = config
+    if drafter == LOOKUP:
+        logger.info(f"Prompt-lookup decoding for {os.path.basename(str(model_path))} ({n} tokens)")
+        return PromptLookupDrafter(n)
+
+    draft_path = draft_model_path(drafter)
+    if not os.path.exists(draft_path):
+        logger.warning(f"Draft model {drafter} not found; speculative decoding disabled")
+        return None
+    target_vocab = (model_info(model_path) or {}).get("vocab_size")
+    draft_vocab = (model_info(draft_path) or {}).get("vocab_size")
+    if target_vocab and draft_vocab and target_vocab != draft_vocab:
+        logger.warning(f"Draft model {drafter} has a different vocabulary ({draft_vocab} vs {target_vocab} tokens); "
+                       f"speculative decoding disabled")
+        return None
+    logger.info(f"Speculative decoding for {os.path.basename(str(model_path))} with {drafter} ({n} tokens)")
+    return ModelDrafter(draft_path, n, n_ctx)
+
+
+def drafter_stats(llm) -> Optional[Dict[str, Any]]:
+    drafter = getattr(llm, "draft_model", None)
+    if drafter is None or not hasattr(drafter, "acceptance"):
+        return None
+    return {"drafter": drafter.kind, **drafter.acceptance.stats()}
@@ -808,6 +808,15 @@ export default function DashboardPage() {
     }, [input]);
 
     const handleStopGeneration = () => {
+        if (currentSessionId) {
+            // Ask the server to stop decoding and keep the partial answer
+            const token = localStorage.getItem('access_token');
+            const API_URL = process.env.NEXT_PUBLIC_API_URL || '';
+            fetch(`${API_URL}/api/chat/sessions/${currentSessionId}/stop`, {
+                method: 'POST',
+                headers: { 'Authorization': `Bearer ${token}` }
+            }).catch(() => { });
+        }
         if (abortController) {
             abortController.abort();
             setAbortController(null);
@@ -0,0 +1,96 @@
+"""Run blocking token iterators off the event loop.
+
+llama.cpp decoding is synchronous: iterating `create_chat_completion(stream=True)`
+on the event-loop thread stalls every other request until the answer is
+finished. `iterate_in_thread` runs the iterator on a generation thread and
+hands items to the async consumer through an asyncio.Queue. The producer
+blocks once `maxsize` items are waiting (backpressure for slow clients), and
+stops and closes the iterator as soon as the consumer goes away. Setting the
+optional `cancel` event ends the stream cleanly after the current item, so
+decoding stops within one token.
+
+The consumer does not finish (return, raise or close) before the generation
+thread has closed the iterator and exited. Callers can therefore release
+the model as soon as their `async for` is done: nothing is still decoding
+on it.
+"""
+import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, AsyncIterator, Any, Optional
+
+STREAM_QUEUE_SIZE = int(os.environ.get("STREAM_QUEUE_SIZE", "64"))
+
+# Generations are long-running; keep them off the default executor used for short blocking calls
+_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("GENERATION_THREADS", "16")),
+                               thread_name_prefix="generation")
+
+_DONE = object()
+
+
+async def iterate_in_thread(make_iter: Callable[[], Iterable[Any]], maxsize: int = STREAM_QUEUE_SIZE,
+                            cancel: Optional[threading.Event] = None) -> AsyncIterator[Any]:
+    """Async-iterate `make_iter()`, which is created and consumed on a generation thread."""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    free = threading.Semaphore(maxsize)
+    stop = threading.Event()
+
+    def put(item, error=None):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+        except RuntimeError:
+            stop.set()  # Event loop already closed
+
+    def produce():
+        it = None
+        try:
+            it = iter(make_iter())
+            for item in it:
+                while not free.acquire(timeout=0.1):
+                    if stop.is_set():
+                        return
+                if stop.is_set():
+                    return
+                put(item)
+                if cancel is not None and cancel.is_set():
+                    break
+            put(_DONE)
+        except BaseException as e:
+            put(_DONE, e)
+        finally:
+            close = getattr(it, "close", None)
+            if close:
+                close()
+
+    producer = loop.run_in_executor(_executor, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is _DONE:
+                if error:
+                    raise error
+                return
+            free.release()
+            yield item
+    finally:
+        stop.set()
+        # The thread may still be inside next(it) (mid-prefill or mid-token); wait for it to
+        # close the iterator, even if we are being cancelled, and re-raise the cancellation after
+        cancelled = False
+        while not producer.done():
+            try:
+                await asyncio.shield(producer)
+            except asyncio.CancelledError:
+                cancelled = True
+            except BaseException:
+                break
+        if cancelled:
+            raise asyncio.CancelledError()
+
+
+async def run_in_generation_thread(fn: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run one blocking model call (e.g. a non-streaming completion) on a generation thread."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, lambda: fn(*args, **kwargs))
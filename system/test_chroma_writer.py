@@ -0,0 +1,55 @@
+from chroma_writer import ChromaWriter
+
+
+class FakeCollection:
+    """Records calls and keeps {id: metadata} like a collection would."""
+
+    def __init__(self, fail_ids=()):
+        self.rows = {}
+        self.calls = []
+        self.fail_ids = set(fail_ids)
+
+    def upsert(self, ids, documents, metadatas, embeddings):
+        self.calls.append(("upsert", list(ids)))
+        if self.fail_ids & set(ids):
+            raise RuntimeError("upsert failed")
+        self.rows.update(zip(ids, metadatas))
+
+    def delete(self, where):
+        (field, cond), = where.items()
+        self.calls.append(("delete", list(cond["$in"])))
+        self.rows = {i: m for i, m in self.rows.items() if m.get(field) not in cond["$in"]}
+
+
+def test_delete_then_upsert_in_one_batch():
+    collection = FakeCollection()
+    with ChromaWriter(collection, flush_interval=60) as writer:
+        writer.delete("content_hash", "h1")
+        writer.upsert("h1-0", "new", {"content_hash": "h1"}, [0.0])
+    # Both were pending in the same round: the delete must not remove the new chunk
+    assert collection.calls == [("delete", ["h1"]), ("upsert", ["h1-0"])]
+    assert set(collection.rows) == {"h1-0"}
+
+
+def test_delete_after_pending_upsert_flushes_it_first():
+    collection = FakeCollection()
+    with ChromaWriter(collection, flush_interval=60) as writer:
+        writer.upsert("h1-old", "old", {"content_hash": "h1"}, [0.0])
+        writer.upsert("h2-0", "other", {"content_hash": "h2"}, [0.0])
+        writer.delete("content_hash", "h1")
+        writer.upsert("h1-new", "new", {"content_hash": "h1"}, [0.0])
+    assert collection.calls == [("upsert", ["h1-old", "h2-0"]), ("delete", ["h1"]), ("upsert", ["h1-new"])]
+    assert set(collection.rows) == {"h1-new", "h2-0"}
+
+
+def test_take_results_reports_failed_batches():
+    collection = FakeCollection(fail_ids={"b-0"})
+    writer = ChromaWriter(collection, max_batch=2, flush_interval=60, track_results=True, log=lambda msg: None)
+    for chunk_id in ("a-0", "a-1", "b-0", "b-1", "c-0"):
+        writer.upsert(chunk_id, "text", {"content_hash": chunk_id[0]}, [0.0])
+    writer.flush()
+    written, failed = writer.take_results()
+    assert written == ["a-0", "a-1", "c-0"]
+    assert failed == ["b-0", "b-1"]
+    assert writer.take_results() == ([], [])
+    writer.close()
@@ -0,0 +1,100 @@
+import struct
+from pathlib import Path
+
+import gguf_metadata
+from gguf_metadata import read_gguf_header, summarize_header, model_info, runtime_params, GGUFError
+
+# GGUF value types
+UINT32, STRING, ARRAY = 4, 8, 9
+F16, Q4_K = 1, 12
+
+
+def _string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return struct.pack("<Q", len(data)) + data
+
+
+def _kv(key: str, vtype: int, payload: bytes) -> bytes:
+    return _string(key) + struct.pack("<I", vtype) + payload
+
+
+def _string_array(items) -> bytes:
+    return struct.pack("<IQ", STRING, len(items)) + b"".join(_string(i) for i in items)
+
+
+def write_gguf(path: Path, tokens, context_length=4096, block_count=2, tensors=(("blk.0.weight", [64, 32], Q4_K),),
+               padding=0) -> Path:
+    """A header-only GGUF: metadata and tensor table, then `padding` bytes standing in for weights."""
+    kvs = [
+        _kv("general.architecture", STRING, _string("llama")),
+        _kv("general.name", STRING, _string("synthetic")),
+        _kv("llama.context_length", UINT32, struct.pack("<I", context_length)),
+        _kv("llama.block_count", UINT32, struct.pack("<I", block_count)),
+        _kv("llama.embedding_length", UINT32, struct.pack("<I", 256)),
+        _kv("llama.attention.head_count", UINT32, struct.pack("<I", 8)),
+        _kv("llama.attention.head_count_kv", UINT32, struct.pack("<I", 2)),
+        _kv("tokenizer.ggml.model", STRING, _string("llama")),
+        _kv("tokenizer.ggml.tokens", ARRAY, _string_array(tokens)),
+    ]
+    table = b"".join(_string(name) + struct.pack("<I", len(shape)) + b"".join(struct.pack("<Q", d) for d in shape)
+                     + struct.pack("<IQ", ggml_type, 0) for name, shape, ggml_type in tensors)
+    header = b"GGUF" + struct.pack("<IQQ", 3, len(tensors), len(kvs)) + b"".join(kvs) + table
+    path.write_bytes(header + b"\0" * padding)
+    return path
+
+
+def test_header_summary(tmp_path):
+    tokens = [f"tok{i}" for i in range(100)]  # Longer than the inline array limit
+    path = write_gguf(tmp_path / "m.gguf", tokens, tensors=(("a", [64, 32], Q4_K), ("b", [10], F16)))
+    header = read_gguf_header(path)
+    assert header["metadata"]["tokenizer.ggml.tokens"]["length"] == 100
+    assert header["tensors"] == [("a", [64, 32], Q4_K), ("b", [10], F16)]
+
+    info = summarize_header(header)
+    assert info["architecture"] == "llama"
+    assert info["parameters"] == 64 * 32 + 10
+    assert info["quantization"] == "Q4_K"  # By tensor type, with no general.file_type
+    assert info["context_length"] == 4096
+    assert info["vocab_size"] == 100
+    # 2 layers x 2 KV heads x (32 + 32) head dims x 2 bytes
+    assert info["kv_bytes_per_token"] == 2 * 2 * 64 * 2
+
+
+def test_tokenizer_identity_follows_the_token_list(tmp_path):
+    a = summarize_header(read_gguf_header(write_gguf(tmp_path / "a.gguf", [f"a{i}" for i in range(100)])))
+    b = summarize_header(read_gguf_header(write_gguf(tmp_path / "b.gguf", [f"b{i}" for i in range(100)])))
+    a2 = summarize_header(read_gguf_header(write_gguf(tmp_path / "a2.gguf", [f"a{i}" for i in range(100)],
+                                                      context_length=8192)))
+    assert a["vocab_size"] == b["vocab_size"]
+    assert a["tokenizer"] != b["tokenizer"]
+    assert a["tokenizer"] == a2["tokenizer"]
+
+
+def test_not_gguf(tmp_path):
+    path = tmp_path / "x.gguf"
+    path.write_bytes(b"GGML" + b"\0" * 32)
+    try:
+        read_gguf_header(path)
+        raise AssertionError("accepted a non-GGUF file")
+    except GGUFError:
+        pass
+    assert model_info(path) is None
+
+
+def test_runtime_params_halve_context_to_fit_budget(tmp_path, monkeypatch):
+    monkeypatch.setattr(gguf_metadata, "known_sha256", lambda path: None)
+    monkeypatch.setattr(gguf_metadata, "MODEL_MAX_CTX", 8192)
+    path = write_gguf(tmp_path / "m.gguf", ["x"] * 100, context_length=32768, padding=1024 * 1024)
+    kv = model_info(path)["kv_bytes_per_token"]
+
+    roomy = runtime_params(path, "chat", budget_bytes=10 * 1024 ** 3)
+    assert roomy["n_ctx"] == 8192  # Trained context capped by MODEL_MAX_CTX
+    assert roomy["n_batch"] == 512
+
+    weights = path.stat().st_size
+    budget = weights + 2048 * kv + gguf_metadata.COMPUTE_OVERHEAD_BYTES
+    tight = runtime_params(path, "chat", budget_bytes=budget)
+    assert tight["n_ctx"] == 2048
+
+    embed = runtime_params(path, "embed", budget_bytes=10 * 1024 ** 3)
+    assert embed["n_batch"] == embed["n_ubatch"] == embed["n_ctx"] == gguf_metadata.EMBED_MAX_CTX
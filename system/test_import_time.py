@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import subprocess
+from pathlib import Path
+
+import pytest
+
+from lazy_import import lazy, available, LazyModule
+
+SYSTEM_DIR = Path(__file__).parent.absolute()
+
+# Libraries that must only be imported when something uses them
+HEAVY = ["llama_cpp", "chromadb", "docx", "openpyxl", "pypdf", "psutil", "passlib", "jose", "numpy"]
+
+# Generous enough for a loaded CI box; an eager chromadb or llama_cpp import alone blows through these
+BUDGETS = {"indexer": 1.0, "backend": 3.0}
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def _import_in_subprocess(module: str, tmp_path: Path) -> dict:
+    (tmp_path / "logs").mkdir(exist_ok=True)  # The indexer logs to logs/ relative to its cwd
+    env = dict(os.environ, PYTHONPATH=str(SYSTEM_DIR), EMBED_SERVICE="0")
+    result = subprocess.run([sys.executable, "-c", PROBE.format(module=module, heavy=HEAVY)],
+                            cwd=tmp_path, env=env, capture_output=True, text=True, timeout=120)
+    assert result.returncode == 0, result.stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_indexer_import_defers_heavy_libraries(tmp_path):
+    report = _import_in_subprocess("indexer", tmp_path)
+    assert report["loaded"] == []
+    assert report["seconds"] < BUDGETS["indexer"], report
+
+
+def test_backend_import_defers_heavy_libraries(tmp_path):
+    pytest.importorskip("fastapi")
+    report = _import_in_subprocess("backend", tmp_path)
+    assert report["loaded"] == []
+    assert report["seconds"] < BUDGETS["backend"], report
+
+
+def test_lazy_module_imports_on_first_attribute(tmp_path, monkeypatch):
+    (tmp_path / "heavy_probe.py").write_text("VALUE = 42\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.delitem(sys.modules, "heavy_probe", raising=False)
+
+    assert available("heavy_probe")
+    assert not available("no_such_module_here")
+    module = lazy("heavy_probe")
+    assert isinstance(module, LazyModule)
+    assert "heavy_probe" not in sys.modules
+    assert module.VALUE == 42
+    assert "heavy_probe" in sys.modules
+    monkeypatch.delitem(sys.modules, "heavy_probe")
+
+
+def test_lazy_module_missing_library_raises_on_use():
+    module = lazy("no_such_module_here")
+    with pytest.raises(ImportError):
+        module.anything
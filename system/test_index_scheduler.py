@@ -0,0 +1,54 @@
+from datetime import datetime
+
+from index_scheduler import parse_days, current_window, validate_schedule
+
+# 2024-06-07 is a Friday (cron day 5), 2024-06-08 a Saturday (6)
+FRIDAY = datetime(2024, 6, 7)
+
+
+def test_parse_days():
+    assert parse_days("*") == set(range(7))
+    assert parse_days("1-5") == {1, 2, 3, 4, 5}
+    assert parse_days("0,6") == {0, 6}
+    assert parse_days("7") == {0}  # Sunday either way
+    assert parse_days("*/2") == {0, 2, 4, 6}
+    assert parse_days("1-5/2") == {1, 3, 5}
+    for bad in ("8", "5-1", "*/0", "mon"):
+        try:
+            parse_days(bad)
+            raise AssertionError(f"accepted {bad!r}")
+        except ValueError:
+            pass
+
+
+def test_window_within_a_day():
+    schedule = {"days": "*", "start_time": "01:00", "end_time": "05:00"}
+    assert current_window(schedule, FRIDAY.replace(hour=0, minute=59)) is None
+    assert current_window(schedule, FRIDAY.replace(hour=1)) == (FRIDAY.replace(hour=1), FRIDAY.replace(hour=5))
+    assert current_window(schedule, FRIDAY.replace(hour=5)) is None  # The end is exclusive
+
+
+def test_window_crossing_midnight():
+    schedule = {"days": "5", "start_time": "22:00", "end_time": "04:00"}  # Opens on Fridays only
+    opened = FRIDAY.replace(hour=22)
+    closes = datetime(2024, 6, 8, 4)
+    assert current_window(schedule, FRIDAY.replace(hour=21, minute=59)) is None
+    assert current_window(schedule, FRIDAY.replace(hour=23, minute=30)) == (opened, closes)
+    # After midnight it is Saturday, but the window opened on Friday
+    assert current_window(schedule, datetime(2024, 6, 8, 3, 59)) == (opened, closes)
+    assert current_window(schedule, datetime(2024, 6, 8, 4, 0)) is None
+    # Saturday night's window doesn't open, and Thursday's doesn't spill into Friday morning
+    assert current_window(schedule, datetime(2024, 6, 8, 23)) is None
+    assert current_window(schedule, FRIDAY.replace(hour=2)) is None
+
+
+def test_validate_schedule():
+    validate_schedule({"days": "1-5", "start_time": "22:00", "end_time": "04:00", "max_runtime_minutes": 60})
+    for bad in ({"start_time": "02:00", "end_time": "02:00"},
+                {"start_time": "02:00", "end_time": "03:00", "storage_mode": "s3"},
+                {"start_time": "02:00", "end_time": "03:00", "max_runtime_minutes": 0}):
+        try:
+            validate_schedule(bad)
+            raise AssertionError(f"accepted {bad}")
+        except ValueError:
+            pass
@@ -0,0 +1,90 @@
+import os
+
+from inference_scheduler import (InferenceScheduler, QueueFull, INTERACTIVE, AGENT, SUMMARY, INDEXING,
+                                 foreground_busy)
+
+MODEL = "/models/m.gguf"
+
+
+def grant_order(scheduler, tickets):
+    """Release the running ticket repeatedly and record who gets the slot next."""
+    order = []
+    pending = list(tickets)
+    while pending:
+        granted = [t for t in pending if t.granted.is_set()]
+        assert len(granted) == 1
+        order.append(granted[0])
+        pending.remove(granted[0])
+        granted[0].release()
+    return order
+
+
+def test_priority_classes_first():
+    scheduler = InferenceScheduler()
+    running = scheduler.enqueue(MODEL, INDEXING, "a")
+    summary = scheduler.enqueue(MODEL, SUMMARY, "b")
+    agent = scheduler.enqueue(MODEL, AGENT, "c")
+    chat = scheduler.enqueue(MODEL, INTERACTIVE, "d")
+    assert running.granted.is_set() and not chat.granted.is_set()
+    assert [chat.position(), agent.position(), summary.position()] == [1, 2, 3]
+    running.release()
+    assert grant_order(scheduler, [chat, agent, summary]) == [chat, agent, summary]
+
+
+def test_round_robin_between_users_within_a_class():
+    scheduler = InferenceScheduler()
+    first = scheduler.enqueue(MODEL, INTERACTIVE, "alice")
+    burst = [scheduler.enqueue(MODEL, INTERACTIVE, "alice") for _ in range(3)]
+    bob = scheduler.enqueue(MODEL, INTERACTIVE, "bob")
+    carol = scheduler.enqueue(MODEL, INTERACTIVE, "carol")
+    # Alice was just served: Bob and Carol go ahead of the rest of her burst
+    assert [bob.position(), carol.position(), burst[0].position()] == [1, 2, 3]
+    first.release()
+    assert grant_order(scheduler, burst + [bob, carol]) == [bob, carol] + burst
+
+
+def test_slots_and_queue_depth():
+    scheduler = InferenceScheduler(max_queue_depth=2, slots_per_model=2)
+    a, b = scheduler.enqueue(MODEL, SUMMARY), scheduler.enqueue(MODEL, SUMMARY)
+    assert a.granted.is_set() and b.granted.is_set()
+    scheduler.enqueue(MODEL, SUMMARY)
+    scheduler.enqueue(MODEL, SUMMARY)
+    try:
+        scheduler.enqueue(MODEL, SUMMARY)
+        raise AssertionError("queue depth not enforced")
+    except QueueFull:
+        pass
+    scheduler.set_slots("/models/other.gguf", 3)
+    assert scheduler.status()[MODEL]["slots"] == 2
+
+
+def test_preempts_the_least_urgent_newest_background_work():
+    scheduler = InferenceScheduler(slots_per_model=2)
+    summary = scheduler.enqueue(MODEL, SUMMARY, "s", preemptible=True)
+    indexing = scheduler.enqueue(MODEL, INDEXING, "i", preemptible=True)
+    assert not summary.preempt.is_set() and not indexing.preempt.is_set()
+
+    # Background work queueing behind them preempts nothing
+    scheduler.enqueue(MODEL, SUMMARY, "s2", preemptible=True).release()
+    assert not indexing.preempt.is_set()
+
+    chat = scheduler.enqueue(MODEL, INTERACTIVE, "u")
+    assert indexing.preempt.is_set() and not summary.preempt.is_set()
+    indexing.yield_turn()
+    assert chat.granted.is_set() and not indexing.granted.is_set()
+    assert indexing.preemptions == 1 and not indexing.preempt.is_set()
+
+    chat.release()
+    assert indexing.granted.is_set()
+
+
+def test_busy_marker(tmp_path):
+    marker = str(tmp_path / "run" / "foreground.busy")
+    scheduler = InferenceScheduler(busy_marker=marker)
+    background = scheduler.enqueue(MODEL, INDEXING)
+    assert not foreground_busy(marker)
+    chat = scheduler.enqueue(MODEL, INTERACTIVE)
+    assert foreground_busy(marker)
+    background.release()
+    chat.release()
+    assert not os.path.exists(marker) and not foreground_busy(marker)
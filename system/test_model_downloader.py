@@ -0,0 +1,217 @@
+import os
+import asyncio
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from model_downloader import DownloadManager
+
+DATA = os.urandom(1024 * 1024 + 12345)
+DIGEST = hashlib.sha256(DATA).hexdigest()
+SEGMENT = 64 * 1024
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Serves DATA with optional Range support and optional dropped connections."""
+    ranges = True
+    drop_after = None  # Cut the first response of each range after this many bytes
+    dropped = set()
+    requests = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        start, end = 0, len(DATA) - 1
+        header = self.headers.get("Range")
+        partial = self.ranges and header is not None
+        if partial:
+            first, _, last = header.split("=", 1)[1].partition("-")
+            start, end = int(first), int(last) if last else len(DATA) - 1
+        type(self).requests.append(header)
+        body = DATA[start:end + 1]
+        self.send_response(206 if partial else 200)
+        if partial:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.drop_after is not None and len(body) > self.drop_after and start not in self.dropped:
+            type(self).dropped.add(start)
+            self.wfile.write(body[:self.drop_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def serve(**options):
+    handler = type("Handler", (StandIn,), {"dropped": set(), "requests": [], **options})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler, f"http://127.0.0.1:{server.server_port}/model.gguf"
+
+
+async def wait_done(manager, task_id, timeout=30):
+    for _ in range(int(timeout * 20)):
+        status = manager.status(task_id)
+        if status["status"] in ("completed", "error"):
+            return status
+        await asyncio.sleep(0.05)
+    raise TimeoutError(manager.status(task_id))
+
+
+def run_download(url, expected=None, **manager_options):
+    with tempfile.TemporaryDirectory() as tmp:
+        published = []
+
+        async def on_complete(path, sha256):
+            published.append((path.name, sha256))
+
+        async def main():
+            manager = DownloadManager(Path(tmp) / "test.db", Path(tmp), on_complete=on_complete,
+                                      segment_bytes=SEGMENT, **manager_options)
+            status = await wait_done(manager, manager.start(url, "model.gguf", expected))
+            await manager.shutdown()
+            return status
+
+        status = asyncio.run(main())
+        target = Path(tmp) / "model.gguf"
+        content = target.read_bytes() if target.exists() else None
+        return status, content, published
+
+
+def test_parallel_ranges():
+    server, handler, url = serve()
+    try:
+        status, content, published = run_download(url, DIGEST)
+        assert status["status"] == "completed", status
+        assert content == DATA
+        assert status["sha256"] == DIGEST
+        assert published == [("model.gguf", DIGEST)]
+        assert len(handler.requests) > len(DATA) // SEGMENT  # Probe + one request per range
+    finally:
+        server.shutdown()
+
+
+def test_dropped_connections_resume_range():
+    server, handler, url = serve(drop_after=10000)
+    try:
+        status, content, _ = run_download(url, DIGEST)
+        assert status["status"] == "completed", status
+        assert content == DATA
+        # Retries continue each range where it was cut off
+        assert f"bytes={10000}-{SEGMENT - 1}" in handler.requests
+    finally:
+        server.shutdown()
+
+
+def test_checksum_mismatch():
+    server, _, url = serve()
+    try:
+        status, content, published = run_download(url, "0" * 64)
+        assert status["status"] == "error"
+        assert "Checksum mismatch" in status["error"]
+        assert content is None and published == []
+    finally:
+        server.shutdown()
+
+
+def test_server_without_ranges():
+    server, handler, url = serve(ranges=False)
+    try:
+        status, content, _ = run_download(url, DIGEST)
+        assert status["status"] == "completed", status
+        assert content == DATA
+    finally:
+        server.shutdown()
+
+
+def test_resume_after_restart():
+    server, handler, url = serve()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            async def interrupted():
+                # ~2 seconds for the whole file, stopped half way
+                manager = DownloadManager(Path(tmp) / "test.db", Path(tmp), segment_bytes=SEGMENT, max_mbps=0.5)
+                task_id = manager.start(url, "model.gguf", DIGEST)
+                await asyncio.sleep(1)
+                await manager.shutdown()
+                return task_id, manager.status(task_id)["downloaded"]
+
+            async def resumed():
+                manager = DownloadManager(Path(tmp) / "test.db", Path(tmp), segment_bytes=SEGMENT)
+                assert manager.resume_pending() == [task_id]
+                status = await wait_done(manager, task_id)
+                await manager.shutdown()
+                return status
+
+            task_id, downloaded = asyncio.run(interrupted())
+            assert 0 < downloaded < len(DATA)
+            handler.requests.clear()
+            status = asyncio.run(resumed())
+            assert status["status"] == "completed", status
+            assert (Path(tmp) / "model.gguf").read_bytes() == DATA
+            # Finished ranges were not fetched again
+            assert "bytes=0-65535" not in handler.requests
+    finally:
+        server.shutdown()
+
+
+def test_one_active_download_per_filename():
+    server, _, url = serve()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            async def main():
+                manager = DownloadManager(Path(tmp) / "test.db", Path(tmp), segment_bytes=SEGMENT, max_mbps=0.5)
+                task_id = manager.start(url, "model.gguf", DIGEST)
+                assert manager.start(url, "model.gguf", DIGEST) == task_id
+                try:
+                    manager.start(url + "?mirror=2", "model.gguf", DIGEST)
+                    raise AssertionError("second URL for the same file was accepted")
+                except ValueError as e:
+                    assert "already being downloaded" in str(e)
+                await manager.shutdown()
+
+            asyncio.run(main())
+    finally:
+        server.shutdown()
+
+
+def test_resume_unfinished_publish():
+    with tempfile.TemporaryDirectory() as tmp:
+        published = []
+
+        async def on_complete(path, sha256):
+            published.append((path.name, sha256))
+
+        async def main():
+            manager = DownloadManager(Path(tmp) / "test.db", Path(tmp), on_complete=on_complete)
+            # As left by a crash inside on_complete: the file is in place, the row still publishing
+            (Path(tmp) / "model.gguf").write_bytes(DATA)
+            conn = manager._connect()
+            conn.execute("INSERT INTO model_downloads (id, url, filename, sha256, total, status, created_at, updated_at) "
+                         "VALUES ('t1', 'http://127.0.0.1:9/model.gguf', 'model.gguf', ?, ?, 'publishing', '', '')",
+                         (DIGEST, len(DATA)))
+            conn.commit()
+            conn.close()
+            try:
+                manager.start("http://127.0.0.1:9/other.gguf", "model.gguf")
+                raise AssertionError("download accepted while the file is being published")
+            except ValueError:
+                pass
+            assert manager.resume_pending() == ["t1"]
+            status = await wait_done(manager, "t1")
+            await manager.shutdown()
+            return status
+
+        status = asyncio.run(main())
+        assert status["status"] == "completed", status
+        assert published == [("model.gguf", DIGEST)]
+
+
+if __name__ == "__main__":
+    for name, fn in list(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+            print(f"{name}: ok")
@@ -0,0 +1,61 @@
+import os
+
+import model_store
+
+
+def use_tmp_store(monkeypatch, tmp_path):
+    models = tmp_path / "models"
+    models.mkdir()
+    monkeypatch.setattr(model_store, "BASE_DIR", tmp_path)
+    monkeypatch.setattr(model_store, "MODELS_DIR", models)
+    monkeypatch.setattr(model_store, "STORE_DIR", models / ".store")
+    monkeypatch.setattr(model_store, "BLOBS_DIR", models / ".store" / "blobs")
+    monkeypatch.setattr(model_store, "MANIFEST_DB", models / ".store" / "manifest.db")
+    monkeypatch.setattr(model_store, "USER_VIEWS_DIR", models / "users")
+    return models
+
+
+def test_user_view_migrates_legacy_copy(tmp_path, monkeypatch):
+    models = use_tmp_store(monkeypatch, tmp_path)
+    (models / "shared.gguf").write_bytes(b"shared weights")
+    legacy = tmp_path / "models_alice"
+    legacy.mkdir()
+    (legacy / "copy.gguf").write_bytes(b"shared weights")  # Same content under another name
+    (legacy / "own.gguf").write_bytes(b"alice's weights")
+
+    shared = model_store.sync_shared_models()
+    view = model_store.ensure_user_view("alice", shared)
+
+    assert not legacy.exists()
+    assert sorted(p.name for p in view.iterdir()) == ["copy.gguf", "own.gguf", "shared.gguf"]
+    assert os.path.samefile(view / "copy.gguf", models / "shared.gguf")
+    assert len(list(model_store.BLOBS_DIR.iterdir())) == 2  # The duplicate is stored once
+    # Blob, MODELS_DIR entry and two view entries share one inode
+    assert (models / "shared.gguf").stat().st_nlink == 4
+    assert model_store.known_sha256(view / "own.gguf") == model_store.file_sha256(view / "own.gguf")
+
+    # Without `shared`, a new view gets what the store already knows, without hashing
+    bob = model_store.ensure_user_view("bob")
+    assert [p.name for p in bob.iterdir()] == ["shared.gguf"]
+
+
+def test_collect_garbage_keeps_linked_blobs(tmp_path, monkeypatch):
+    models = use_tmp_store(monkeypatch, tmp_path)
+    (models / "shared.gguf").write_bytes(b"shared weights")
+    legacy = tmp_path / "models_alice"
+    legacy.mkdir()
+    (legacy / "own.gguf").write_bytes(b"alice's weights")
+    model_store.ensure_user_view("alice", model_store.sync_shared_models())
+
+    assert model_store.collect_garbage() == 0
+
+    # Alice's own model goes with her view; the shared one is still linked from MODELS_DIR
+    model_store.remove_user_view("alice")
+    assert [p.parent.name for p in model_store.BLOBS_DIR.glob("*/*")] == [model_store.known_sha256(
+        models / "shared.gguf")]
+
+    # Not in any view, but hardlinked: st_nlink keeps it
+    assert model_store.collect_garbage() == 0
+    (models / "shared.gguf").unlink()
+    assert model_store.collect_garbage() == len(b"shared weights")
+    assert model_store.store_status()["blobs"] == 0
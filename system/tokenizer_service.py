@@ -0,0 +1,140 @@
+"""Token counting without loading a model's weights.
+
+Prompt budgets are in tokens, but loading a chat model just to count them
+is far too expensive. This module opens GGUF files with llama.cpp's
+`vocab_only`, which reads the tokenizer and skips the tensors, and keeps one
+such vocabulary per tokenizer (tokenizer model, pre-tokenizer and a digest of
+the token list from the GGUF header), so every quantization of the same model
+shares it. Files whose header has no tokenizer digest get their own.
+
+Counts are cached by text hash, since the same stored chat messages and
+retrieved chunks are counted again on every turn. When llama_cpp or the
+model file is unavailable, counts fall back to a conservative estimate from
+the UTF-8 length.
+"""
+import os
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Any, List, Optional, Tuple, Union
+
+from gguf_metadata import model_info
+from model_store import canonical_model_path
+
+logger = logging.getLogger("tokenizer_service")
+
+TOKEN_COUNT_CACHE_SIZE = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", "20000"))
+# ~1 token per CJK character (3 bytes), ~4 bytes per English token: erring towards too many is safe
+ESTIMATE_BYTES_PER_TOKEN = 3
+# Upper bound on characters per token for truncation; real vocabularies average 1-5
+MAX_CHARS_PER_TOKEN = 8
+# A vocabulary that failed to load (e.g. a file still being published) is tried again after this
+VOCAB_RETRY_SECONDS = 60
+
+_lock = threading.Lock()
+_vocabs: Dict[Tuple, Any] = {}
+_vocab_locks: Dict[Tuple, threading.Lock] = {}
+_vocab_failed: Dict[Tuple, float] = {}  # family -> time of the last failed load
+_counts: "OrderedDict[Tuple, int]" = OrderedDict()
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text.encode("utf-8")) // ESTIMATE_BYTES_PER_TOKEN)
+
+
+def tokenizer_family(model_path: Union[str, Path]) -> Tuple:
+    """Models with the same key tokenize identically."""
+    info = model_info(model_path) or {}
+    if not info.get("tokenizer"):
+        # Headers cached before the digest was recorded, or unreadable: don't share
+        return ("file", os.path.realpath(str(model_path)))
+    return tuple(info["tokenizer"])
+
+
+def _vocab(model_path: Union[str, Path], family: Tuple):
+    with _lock:
+        if family in _vocabs:
+            return _vocabs[family]
+        if time.monotonic() - _vocab_failed.get(family, float("-inf")) < VOCAB_RETRY_SECONDS:
+            return None
+    vocab = None
+    path = canonical_model_path(model_path)
+    if os.path.exists(path):
+        try:
+            from llama_cpp import Llama
+            vocab = Llama(model_path=path, vocab_only=True, verbose=False)
+            logger.info(f"Loaded vocabulary of {os.path.basename(path)} for {family}")
+        except Exception as e:
+            logger.warning(f"Could not load vocabulary of {path}, estimating token counts: {e}")
+    with _lock:
+        if vocab is None:
+            _vocab_failed[family] = time.monotonic()
+            return None
+        _vocab_failed.pop(family, None)
+        _vocab_locks.setdefault(family, threading.Lock())
+        return _vocabs.setdefault(family, vocab)
+
+
+def _tokenize(model_path: Union[str, Path], family: Tuple, text: str) -> Optional[List[int]]:
+    vocab = _vocab(model_path, family)
+    if vocab is None:
+        return None
+    with _vocab_locks[family]:
+        return vocab.tokenize(text.encode("utf-8"), add_bos=False, special=False)
+
+
+def count_tokens(model_path: Union[str, Path], text: str) -> int:
+    """Number of tokens `text` takes in the model's prompt (without BOS)."""
+    if not text:
+        return 0
+    family = tokenizer_family(model_path)
+    key = (family, hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest())
+    with _lock:
+        if key in _counts:
+            _counts.move_to_end(key)
+            return _counts[key]
+    tokens = _tokenize(model_path, family, text)
+    if tokens is None:
+        # Not cached: the vocabulary may load on a later try
+        return estimate_tokens(text)
+    n = len(tokens)
+    with _lock:
+        _counts[key] = n
+        while len(_counts) > TOKEN_COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+    return n
+
+
+def count_message_tokens(model_path: Union[str, Path], messages: List[Dict[str, Any]],
+                         per_message: int = 4) -> int:
+    """Tokens of a chat message list, with `per_message` for the chat template's role markers."""
+    return sum(count_tokens(model_path, m.get("content") or "") + per_message for m in messages)
+
+
+def truncate_tokens(model_path: Union[str, Path], text: str, max_tokens: int) -> str:
+    """A prefix of `text` that is at most `max_tokens` tokens (the longest, barring tokens over 8 chars)."""
+    if max_tokens <= 0 or not text:
+        return ""
+    # Only the head can end up in the result: don't tokenize a whole document to keep its start
+    text = text[:max_tokens * MAX_CHARS_PER_TOKEN]
+    family = tokenizer_family(model_path)
+    tokens = _tokenize(model_path, family, text)
+    if tokens is None:
+        # Estimated: cut by UTF-8 bytes, dropping a partial character at the end
+        return text.encode("utf-8")[:max_tokens * ESTIMATE_BYTES_PER_TOKEN].decode("utf-8", "ignore")
+    if len(tokens) <= max_tokens:
+        return text
+    with _vocab_locks[family]:
+        data = _vocabs[family].detokenize(tokens[:max_tokens])
+    return data.decode("utf-8", "ignore")
+
+
+def tokenizer_stats() -> Dict[str, Any]:
+    with _lock:
+        return {
+            "families": [list(f) for f in _vocabs],
+            "cached_counts": len(_counts)
+        }